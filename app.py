@@ -2,17 +2,41 @@
 """Ollama Intel iGPU Monitoring Dashboard v1.0 — Backend + API Proxy"""
 
 from flask import Flask, jsonify, render_template, request as flask_request, Response, session, redirect, url_for
-from functools import wraps
+from werkzeug.wsgi import ClosingIterator
+from functools import wraps, lru_cache
+from contextlib import contextmanager
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+import http.cookiejar
+import urllib.parse
+import weakref
+import asyncio
 import json
 import os
 import time
 import threading
 import re
 import hashlib
+import math
+import base64
+import csv
+import io
+import zlib
+import codecs
+import itertools
 import secrets
+import sqlite3
+import queue
+import atexit
+import signal
+import sys
 from datetime import datetime, timedelta
 
+import gin_parser
+
 # ── Two Flask apps: Dashboard (8088) + Proxy (11434) ────────────
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', secrets.token_hex(32))
@@ -20,10 +44,16 @@ proxy_app = Flask(__name__ + '_proxy')
 
 # ── Configuration ────────────────────────────────────────────────
 OLLAMA_URL = os.environ.get('OLLAMA_URL', 'http://localhost:11434')
+# Several Ollama instances behind one proxy: comma-separated, first is the primary
+OLLAMA_URLS = [u.strip().rstrip('/') for u in os.environ.get('OLLAMA_URLS', OLLAMA_URL).split(',') if u.strip()] or [OLLAMA_URL]
 OLLAMA_CONTAINER = os.environ.get('OLLAMA_CONTAINER', 'ollama-intel')
 DATA_DIR = os.environ.get('DATA_DIR', '/data')
-HISTORY_FILE = os.path.join(DATA_DIR, 'history.json')
+HISTORY_FILE = os.path.join(DATA_DIR, 'history.json')  # legacy, migrated into HISTORY_DB
+HISTORY_DB = os.path.join(DATA_DIR, 'history.db')
 POLL_INTERVAL = int(os.environ.get('POLL_INTERVAL', 5))
+POLL_TAGS_INTERVAL = float(os.environ.get('POLL_TAGS_INTERVAL', 60))
+POLL_TAGS_INTERVAL_MAX = float(os.environ.get('POLL_TAGS_INTERVAL_MAX', 600))
+POLL_VERSION_INTERVAL = float(os.environ.get('POLL_VERSION_INTERVAL', 300))
 PROXY_PORT = int(os.environ.get('PROXY_PORT', 11434))
 
 # Authentication — empty = no auth required
@@ -52,20 +82,49 @@ except:
 # Settings file (persisted to /data volume)
 SETTINGS_FILE = os.path.join(DATA_DIR, 'settings.json')
 
-def load_settings():
+# Parsed settings are cached and only re-read when the file's mtime/size
+# changes, so the poll loop and hot endpoints don't hit the disk.
+_settings_cache = {"stamp": None, "data": {}}
+_settings_lock = threading.Lock()
+
+def _settings_stamp():
     try:
-        if os.path.exists(SETTINGS_FILE):
-            with open(SETTINGS_FILE, 'r') as f:
-                return json.load(f)
-    except:
-        pass
-    return {}
+        st = os.stat(SETTINGS_FILE)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+def load_settings():
+    """Current settings (a copy). Cached; invalidated by save_settings or an mtime change."""
+    stamp = _settings_stamp()
+    with _settings_lock:
+        if stamp != _settings_cache["stamp"]:
+            data = {}
+            if stamp is not None:
+                try:
+                    with open(SETTINGS_FILE, 'r') as f:
+                        data = json.load(f)
+                except Exception as e:
+                    # Keep the last good settings rather than silently reverting to defaults
+                    print(f"[SETTINGS] Load error, keeping cached settings: {e}")
+                    data = _settings_cache["data"]
+            _settings_cache["stamp"] = stamp
+            _settings_cache["data"] = data
+        return dict(_settings_cache["data"])
 
 def save_settings(data):
+    """Atomic write (temp file + rename) so readers never see a partial file."""
     try:
         os.makedirs(DATA_DIR, exist_ok=True)
-        with open(SETTINGS_FILE, 'w') as f:
+        tmp = f"{SETTINGS_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'w') as f:
             json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, SETTINGS_FILE)
+        with _settings_lock:
+            _settings_cache["stamp"] = _settings_stamp()
+            _settings_cache["data"] = dict(data)
     except Exception as e:
         print(f"[SETTINGS] Save error: {e}")
 
@@ -81,10 +140,6 @@ history_lock = threading.Lock()
 current_status = {"status": "starting", "running": {"models": []}, "models": {"models": []}}
 start_time = datetime.now().isoformat()
 
-# Track seen log entries to prevent duplicates
-seen_entries = set()
-MAX_SEEN = 5000
-
 # Track currently active model (from API, not logs)
 active_model = "—"
 
@@ -92,137 +147,2144 @@ active_model = "—"
 proxy_self_ip = None
 
 # ── History persistence ──────────────────────────────────────────
-def load_history():
+# Append-only SQLite store (WAL). One row per entry, so appending costs the
+# same no matter how much history exists. history.json is migrated on startup.
+#
+# Request rows are stored column-wise rather than as one JSON document each:
+# model, client, path and source are dictionary-encoded through the strings
+# table, the numeric fields are plain columns and only the remaining optional
+# fields stay in `data`, as compact JSON. time, time_display, duration and
+# total_tokens are not stored; decode_entry derives them when rows are read.
+HISTORY_KINDS = ("requests", "benchmarks", "events", "sweeps")
+WAL_SIZE_LIMIT = 64 * 1024 * 1024  # the WAL is truncated back to this after a checkpoint
+
+REQUEST_STRING_COLUMNS = (("model", "model_id"), ("client_ip", "client_id"), ("path", "path_id"),
+                          ("source", "source_id"))
+REQUEST_NUMBER_COLUMNS = (("status", int), ("duration_ms", float), ("tokens", int), ("prompt_tokens", int),
+                          ("tokens_per_sec", float))
+REQUEST_DERIVED_FIELDS = ("time", "time_display", "duration", "total_tokens")
+# Kept out of `data`: the columns, the derived fields and a row id an export may carry
+REQUEST_OMITTED_FIELDS = frozenset([f for f, _ in REQUEST_STRING_COLUMNS + REQUEST_NUMBER_COLUMNS]
+                                   + list(REQUEST_DERIVED_FIELDS) + ["id"])
+REQUEST_SELECT = ("requests.ts, m.value, c.value, p.value, s.value, status, duration_ms, tokens, "
+                  "prompt_tokens, tokens_per_sec, requests.data FROM requests "
+                  "JOIN strings m ON m.id = model_id JOIN strings c ON c.id = client_id "
+                  "JOIN strings p ON p.id = path_id JOIN strings s ON s.id = source_id")
+_db_local = threading.local()
+
+def get_db():
+    """Per-thread SQLite connection to the history store."""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        conn = sqlite3.connect(HISTORY_DB, timeout=30, isolation_level=None)
+        # Only takes effect on a new file (before WAL and the first table);
+        # lets retention hand freed pages back a step at a time
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA journal_size_limit={WAL_SIZE_LIMIT}")
+        _db_local.conn = conn
+    return conn
+
+@contextmanager
+def db_transaction(conn=None):
+    """BEGIN IMMEDIATE … COMMIT on the thread's connection, ROLLBACK on error."""
+    conn = conn or get_db()
+    conn.execute("BEGIN IMMEDIATE")
     try:
-        if os.path.exists(HISTORY_FILE):
-            with open(HISTORY_FILE, 'r') as f:
-                data = json.load(f)
-                for key in ["requests", "benchmarks", "events"]:
-                    if key not in data:
-                        data[key] = []
-                return data
+        yield conn
+        conn.execute("COMMIT")
     except:
-        pass
-    return {"requests": [], "benchmarks": [], "events": []}
+        conn.execute("ROLLBACK")
+        raise
+
+def _entry_ts(entry):
+    """Epoch seconds for an entry's ISO `time` field (now if unparseable)."""
+    try:
+        return datetime.fromisoformat(entry.get("time", "")).timestamp()
+    except:
+        return time.time()
+
+def _compact_json(obj):
+    return json.dumps(obj, separators=(',', ':'), default=str)
+
+def _number(value, cast):
+    try:
+        return cast(value or 0)
+    except (TypeError, ValueError):
+        return cast(0)
+
+def string_ids(conn, values):
+    """Dictionary ids for strings, adding new ones (caller holds a transaction)."""
+    values = list(set(values))
+    conn.executemany("INSERT OR IGNORE INTO strings (value) VALUES (?)", [(v,) for v in values])
+    ids = {}
+    for i in range(0, len(values), 500):
+        chunk = values[i:i + 500]
+        ids.update((v, n) for n, v in conn.execute(
+            f"SELECT id, value FROM strings WHERE value IN ({','.join('?' * len(chunk))})", chunk))
+    return ids
+
+def _encode_requests(conn, rows):
+    """Column tuples for (ts, request entry) rows."""
+    strings = [[str(e.get(field) or "") for field, _ in REQUEST_STRING_COLUMNS] for _, e in rows]
+    ids = string_ids(conn, [v for row in strings for v in row])
+    return [
+        (ts, *[ids[v] for v in values], *[_number(e.get(field), cast) for field, cast in REQUEST_NUMBER_COLUMNS],
+         _compact_json({k: v for k, v in e.items() if k not in REQUEST_OMITTED_FIELDS}))
+        for (ts, e), values in zip(rows, strings)
+    ]
+
+def entry_select(kind):
+    """Column list and FROM clause for `SELECT {kind}.id, ...`; decode_entry turns the columns back into a dict."""
+    return REQUEST_SELECT if kind == "requests" else f"{kind}.ts, {kind}.data FROM {kind}"
+
+@lru_cache(maxsize=1024)
+def _minute_prefixes(minute):
+    """(ISO, display) prefixes up to the minute for an epoch minute (UTC offsets are whole minutes)."""
+    t = time.localtime(minute * 60)
+    return time.strftime("%Y-%m-%dT%H:%M", t), time.strftime("%Y/%m/%d - %H:%M", t)
+
+def _time_fields(ts):
+    """(ISO time, display time) for an epoch ts, as datetime.fromtimestamp would render them."""
+    sec = math.floor(ts)
+    us = round((ts - sec) * 1e6)
+    if us >= 1000000:
+        sec, us = sec + 1, us - 1000000
+    minute, s = divmod(sec, 60)
+    iso, display = _minute_prefixes(minute)
+    return (f"{iso}:{s:02d}.{us:06d}" if us else f"{iso}:{s:02d}"), f"{display}:{s:02d}"
+
+# Residual JSON repeats a lot (every direct entry is {"method":"POST"}). Only
+# flat objects are cached, as tuples of items, so every row gets its own dict
+# and nothing can be shared between entries; nested values are decoded afresh.
+@lru_cache(maxsize=4096)
+def _decode_flat(data):
+    value = json.loads(data)
+    if any(isinstance(v, (dict, list)) for v in value.values()):
+        return None
+    return tuple(value.items())
+
+def _decode_data(data):
+    items = _decode_flat(data)
+    return json.loads(data) if items is None else items
+
+def decode_entry(kind, row):
+    """The entry dict for the columns of entry_select (without the leading id)."""
+    if kind != "requests":
+        return json.loads(row[1])
+    ts, model, client_ip, path, source, status, duration_ms, tokens, prompt_tokens, tps, data = row
+    iso, display = _time_fields(ts)
+    entry = {
+        "time": iso,
+        "time_display": display,
+        "status": status,
+        "duration": _fmt_duration(duration_ms),
+        "duration_ms": duration_ms,
+        "client_ip": client_ip,
+        "path": path,
+        "model": model,
+        "tokens": tokens,
+        "prompt_tokens": prompt_tokens,
+        "total_tokens": tokens + prompt_tokens,
+        "tokens_per_sec": tps,
+        "source": source,
+    }
+    entry.update(_decode_data(data))
+    return entry
+
+def _insert_entries(conn, kind, entries):
+    """Insert entries and return their ids (contiguous: we hold the write lock)."""
+    rows = [(_entry_ts(e), e) for e in entries]
+    if not rows:
+        return []
+    if kind == "requests":
+        conn.executemany(
+            "INSERT INTO requests (ts, model_id, client_id, path_id, source_id, status, duration_ms, "
+            "tokens, prompt_tokens, tokens_per_sec, data) VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+            _encode_requests(conn, rows)
+        )
+    else:
+        conn.executemany(
+            f"INSERT INTO {kind} (ts, data) VALUES (?, ?)",
+            [(ts, _compact_json(e)) for ts, e in rows]
+        )
+    last = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+    _apply_aggregates(conn, kind, rows)
+    return list(range(last - len(rows) + 1, last + 1))
+
+# ── Rollups & counters ───────────────────────────────────────────
+# Running totals, per-minute/hour/day buckets (by model, client, source) and
+# quantile sketches are updated in the same transaction as each insert, so
+# stats never rescan raw history. Bumping AGGREGATES_VERSION rebuilds them
+# from raw rows.
+AGGREGATES_VERSION = 4
+ROLLUP_GRANULARITIES = {"minute": 60, "hour": 3600, "day": 86400}
+# Sources answered without Ollama generating anything (cache hits, coalesced
+# followers): their tokens count as saved, not processed
+SAVED_SOURCES = ("cache", "coalesced")
+
+def _bucket_start(ts, granularity):
+    if granularity == "day":
+        # Local calendar day, matching the dashboard's daily charts
+        return int(datetime.fromtimestamp(ts).replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+    step = ROLLUP_GRANULARITIES[granularity]
+    return int(ts // step * step)
+
+def _entry_counters(kind, rows):
+    """Counter increments for (ts, entry) rows of one kind."""
+    counters = {kind: len(rows)}
+    if kind == "requests":
+        for _, e in rows:
+            gen, prompt = e.get("tokens", 0) or 0, e.get("prompt_tokens", 0) or 0
+            source = e.get("source", "") or ""
+            if source not in SAVED_SOURCES:
+                counters["req_gen_tokens"] = counters.get("req_gen_tokens", 0) + gen
+                counters["req_prompt_tokens"] = counters.get("req_prompt_tokens", 0) + prompt
+            counters[f"source:{source}"] = counters.get(f"source:{source}", 0) + 1
+            counters[f"source_tokens:{source}"] = counters.get(f"source_tokens:{source}", 0) + gen + prompt
+    elif kind == "benchmarks":
+        counters["bench_gen_tokens"] = sum(e.get("eval_count", 0) or 0 for _, e in rows)
+        counters["bench_prompt_tokens"] = sum(e.get("prompt_eval_count", 0) or 0 for _, e in rows)
+    return counters
+
+def _apply_aggregates(conn, kind, rows, floors=None):
+    """Fold (ts, entry) rows into counters and, for requests, rollups.
+
+    floors ({granularity: bucket}) skips buckets older than the given start."""
+    if not rows:
+        return
+    if kind == "requests":
+        floors = floors or {}
+        buckets = {}
+        for ts, e in rows:
+            gen, prompt = e.get("tokens", 0) or 0, e.get("prompt_tokens", 0) or 0
+            source = e.get("source", "") or ""
+            is_error = 1 if (e.get("status") or 0) >= 400 else 0
+            for granularity in ROLLUP_GRANULARITIES:
+                bucket = _bucket_start(ts, granularity)
+                if bucket < floors.get(granularity, bucket):
+                    continue
+                key = (granularity, bucket, e.get("model") or "", e.get("client_ip") or "", source)
+                b = buckets.setdefault(key, [0, 0, 0, 0, 0.0])
+                b[0] += 1
+                b[1] += is_error
+                b[2] += gen
+                b[3] += prompt
+                b[4] += e.get("duration_ms", 0) or 0
+        conn.executemany(
+            "INSERT INTO rollups (granularity, bucket, model, client_ip, source, "
+            "requests, errors, gen_tokens, prompt_tokens, duration_ms) VALUES (?,?,?,?,?,?,?,?,?,?) "
+            "ON CONFLICT(granularity, bucket, model, client_ip, source) DO UPDATE SET "
+            "requests = requests + excluded.requests, errors = errors + excluded.errors, "
+            "gen_tokens = gen_tokens + excluded.gen_tokens, "
+            "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+            "duration_ms = duration_ms + excluded.duration_ms",
+            [k + tuple(v) for k, v in buckets.items()]
+        )
+        _apply_sketches(conn, rows, floors)
+    conn.executemany(
+        "INSERT INTO counters (name, value) VALUES (?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+        list(_entry_counters(kind, rows).items())
+    )
+
+def _aggregate_floors(conn):
+    """{granularity: first bucket start} that raw requests still fully cover, or None if all do.
+
+    Retention records the newest timestamp it deleted as retention_floor.
+    Stores trimmed before that was recorded are recognised by day rollups
+    that predate the oldest raw row."""
+    row = conn.execute("SELECT value FROM meta WHERE key = 'retention_floor'").fetchone()
+    floor = float(row[0]) if row else None
+    if floor is None:
+        first = conn.execute("SELECT MIN(ts) FROM requests").fetchone()[0]
+        oldest = conn.execute("SELECT MIN(bucket) FROM rollups WHERE granularity = 'day'").fetchone()[0]
+        if oldest is not None and (first is None or oldest < _bucket_start(first, "day")):
+            floor = first if first is not None else time.time()
+    if floor is None:
+        return None
+    floors = {}
+    for granularity, step in ROLLUP_GRANULARITIES.items():
+        start = _bucket_start(floor, granularity)
+        # The bucket the floor cuts through lost rows too: start at the next one
+        floors[granularity] = start if start >= floor else _bucket_start(start + step * 1.5, granularity)
+    return floors
+
+def rebuild_aggregates(conn, full=False):
+    """Recompute counters, rollups and sketches from raw rows (caller holds a transaction).
+
+    Hour/day rollups and sketches outlive the raw rows retention deletes, so
+    buckets before the retention floor are left as they are; full=True
+    (clearing the store) starts from nothing."""
+    floors = None
+    if full:
+        conn.execute("DELETE FROM meta WHERE key = 'retention_floor'")
+    else:
+        floors = _aggregate_floors(conn)
+    conn.execute("DELETE FROM counters")
+    for table in ("rollups", "sketches"):
+        if floors is None:
+            conn.execute(f"DELETE FROM {table}")
+        else:
+            for granularity, start in floors.items():
+                conn.execute(f"DELETE FROM {table} WHERE granularity = ? AND bucket >= ?", (granularity, start))
+    for kind in HISTORY_KINDS:
+        cur = conn.execute(f"SELECT {kind}.id, {entry_select(kind)} ORDER BY {kind}.id")
+        while True:
+            chunk = cur.fetchmany(5000)
+            if not chunk:
+                break
+            _apply_aggregates(conn, kind, [(row[1], decode_entry(kind, row[1:])) for row in chunk], floors)
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('aggregates_version', ?)",
+                 (str(AGGREGATES_VERSION),))
+
+def get_counters():
+    return {name: value for name, value in get_db().execute("SELECT name, value FROM counters")}
+
+def query_rollups(granularity, since=None, until=None, group_by=("model",)):
+    """Sum rollup buckets in [since, until) grouped by bucket plus group_by columns.
+
+    gen_tokens/prompt_tokens are what Ollama processed; tokens of SAVED_SOURCES
+    entries are reported as saved_tokens instead."""
+    cols = [c for c in group_by if c in ("model", "client_ip", "source")]
+    select = ", ".join(["bucket"] + cols)
+    saved = f"source IN ({','.join('?' * len(SAVED_SOURCES))})"
+    where, params = ["granularity = ?"], list(SAVED_SOURCES) * 3 + [granularity]
+    if since is not None:
+        where.append("bucket >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("bucket < ?")
+        params.append(until)
+    rows = get_db().execute(
+        f"SELECT {select}, SUM(requests), SUM(errors), "
+        f"SUM(CASE WHEN {saved} THEN 0 ELSE gen_tokens END), "
+        f"SUM(CASE WHEN {saved} THEN 0 ELSE prompt_tokens END), "
+        f"SUM(CASE WHEN {saved} THEN gen_tokens + prompt_tokens ELSE 0 END), "
+        f"SUM(duration_ms) FROM rollups WHERE {' AND '.join(where)} GROUP BY {select} ORDER BY bucket",
+        params
+    ).fetchall()
+    keys = ["bucket"] + cols + ["requests", "errors", "gen_tokens", "prompt_tokens", "saved_tokens", "duration_ms"]
+    return [dict(zip(keys, r)) for r in rows]
+
+# Latency/speed percentiles: one DDSketch per (granularity, bucket, model,
+# client, metric), merged on insert like the rollups. A sketch keeps counts in
+# log-spaced bins, so any quantile is within SKETCH_ACCURACY relative error and
+# merging two sketches is adding their bins — p99 over a month merges a few
+# hundred day sketches instead of sorting every entry. Cache hits and
+# coalesced followers (SAVED_SOURCES) are left out.
+SKETCH_ACCURACY = 0.01
+SKETCH_GRANULARITIES = ("hour", "day")
+SKETCH_METRICS = ("duration_ms", "ttft_ms", "tokens_per_sec")
+
+class QuantileSketch:
+    """DDSketch with relative accuracy SKETCH_ACCURACY; bins beyond MAX_BINS collapse from the low end."""
+    GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+    LOG_GAMMA = math.log(GAMMA)
+    MIN_VALUE = 1e-3  # smaller values are counted as zero
+    MAX_BINS = 2048
+    __slots__ = ("bins", "zero", "count", "sum", "min", "max")
+
+    def __init__(self):
+        self.bins = {}
+        self.zero = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value, n=1):
+        value = float(value)
+        self.count += n
+        self.sum += value * n
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if value <= self.MIN_VALUE:
+            self.zero += n
+            return
+        i = math.ceil(math.log(value) / self.LOG_GAMMA)
+        self.bins[i] = self.bins.get(i, 0) + n
+        if len(self.bins) > self.MAX_BINS:
+            self._collapse()
+
+    def merge(self, other):
+        if not other.count:
+            return self
+        for i, n in other.bins.items():
+            self.bins[i] = self.bins.get(i, 0) + n
+        self.zero += other.zero
+        self.count += other.count
+        self.sum += other.sum
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        if len(self.bins) > self.MAX_BINS:
+            self._collapse()
+        return self
+
+    def _collapse(self):
+        keys = sorted(self.bins)
+        folded = sum(self.bins.pop(i) for i in keys[:len(keys) - self.MAX_BINS + 1])
+        self.bins[keys[len(keys) - self.MAX_BINS + 1]] += folded
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zero:
+            return 0.0
+        seen = self.zero
+        for i in sorted(self.bins):
+            seen += self.bins[i]
+            if seen > rank:
+                value = 2 * self.GAMMA ** i / (self.GAMMA + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_json(self):
+        return json.dumps({"b": self.bins, "z": self.zero, "n": self.count, "s": self.sum,
+                           "lo": self.min, "hi": self.max}, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, raw):
+        d = json.loads(raw)
+        sketch = cls()
+        sketch.bins = {int(i): n for i, n in d["b"].items()}
+        sketch.zero, sketch.count, sketch.sum = d["z"], d["n"], d["s"]
+        sketch.min, sketch.max = d["lo"], d["hi"]
+        return sketch
+
+def _apply_sketches(conn, rows, floors=None):
+    """Fold (ts, request entry) rows into the stored sketches (caller holds a transaction)."""
+    floors = floors or {}
+    sketches = {}
+    for ts, e in rows:
+        if e.get("source") in SAVED_SOURCES:
+            continue
+        values = [(m, e.get(m)) for m in SKETCH_METRICS if e.get(m) is not None]
+        # tokens/s of 0 means "not measured" (direct GIN entries, errors)
+        values = [(m, v) for m, v in values if v > 0 or m != "tokens_per_sec"]
+        if not values:
+            continue
+        for granularity in SKETCH_GRANULARITIES:
+            bucket = _bucket_start(ts, granularity)
+            if bucket < floors.get(granularity, bucket):
+                continue
+            key = (granularity, bucket, e.get("model") or "", e.get("client_ip") or "")
+            for metric, value in values:
+                sketches.setdefault(key + (metric,), QuantileSketch()).add(value)
+    for key, sketch in sketches.items():
+        row = conn.execute("SELECT data FROM sketches WHERE granularity = ? AND bucket = ? AND model = ? "
+                           "AND client_ip = ? AND metric = ?", key).fetchone()
+        if row:
+            sketch.merge(QuantileSketch.from_json(row[0]))
+        conn.execute("INSERT OR REPLACE INTO sketches (granularity, bucket, model, client_ip, metric, data) "
+                     "VALUES (?,?,?,?,?,?)", key + (sketch.to_json(),))
+
+def query_percentiles(metric, granularity, since=None, until=None, model=None, client_ip=None,
+                      group_by=(), quantiles=(0.5, 0.95, 0.99)):
+    """Merge the sketches in [since, until) (bucket starts) and read quantiles, per group_by group."""
+    cols = [c for c in group_by if c in ("bucket", "model", "client_ip")]
+    where, params = ["granularity = ?", "metric = ?"], [granularity, metric]
+    if since is not None:
+        where.append("bucket >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("bucket < ?")
+        params.append(until)
+    for col, value in (("model", model), ("client_ip", client_ip)):
+        if value:
+            where.append(f"{col} = ?")
+            params.append(value)
+    groups = {}
+    cur = get_db().execute(f"SELECT bucket, model, client_ip, data FROM sketches WHERE {' AND '.join(where)}",
+                           params)
+    for bucket, m, ip, data in cur:
+        row = {"bucket": bucket, "model": m, "client_ip": ip}
+        key = tuple(row[c] for c in cols)
+        groups.setdefault(key, QuantileSketch()).merge(QuantileSketch.from_json(data))
+    results = []
+    for key, sketch in sorted(groups.items()):
+        r = dict(zip(cols, key))
+        r.update(count=sketch.count, mean=round(sketch.sum / sketch.count, 2),
+                 min=round(sketch.min, 2), max=round(sketch.max, 2))
+        for q in quantiles:
+            r[f"p{q * 100:g}"] = round(sketch.quantile(q), 2)
+        results.append(r)
+    return results
+
+# Schema migrations, applied in order on startup (PRAGMA user_version = count applied).
+def _request_column(name, path, default):
+    return (f"ALTER TABLE requests ADD COLUMN {name} GENERATED ALWAYS AS "
+            f"(COALESCE(json_extract(data, '$.{path}'), {default})) VIRTUAL")
+
+SCHEMA_MIGRATIONS = [
+    # v1: indexed request columns for server-side filtering, sorting and paging
+    [
+        _request_column("model", "model", "''"),
+        _request_column("client_ip", "client_ip", "''"),
+        _request_column("source", "source", "''"),
+        _request_column("status", "status", "0"),
+        _request_column("duration_ms", "duration_ms", "0"),
+        _request_column("tokens", "tokens", "0"),
+        _request_column("prompt_tokens", "prompt_tokens", "0"),
+        _request_column("tokens_per_sec", "tokens_per_sec", "0"),
+        "CREATE INDEX IF NOT EXISTS idx_requests_model ON requests(model, ts)",
+        "CREATE INDEX IF NOT EXISTS idx_requests_client ON requests(client_ip, ts)",
+        "CREATE INDEX IF NOT EXISTS idx_requests_source ON requests(source, ts)",
+        "CREATE INDEX IF NOT EXISTS idx_requests_status ON requests(status, ts)",
+        "CREATE INDEX IF NOT EXISTS idx_requests_duration ON requests(duration_ms)",
+        "CREATE INDEX IF NOT EXISTS idx_requests_tokens ON requests(tokens)",
+        "CREATE INDEX IF NOT EXISTS idx_requests_prompt_tokens ON requests(prompt_tokens)",
+        "CREATE INDEX IF NOT EXISTS idx_requests_tps ON requests(tokens_per_sec)",
+    ],
+    # v2: per-bucket quantile sketches (filled by the aggregates rebuild this triggers)
+    [
+        "CREATE TABLE IF NOT EXISTS sketches (granularity TEXT NOT NULL, bucket INTEGER NOT NULL, "
+        "model TEXT NOT NULL, client_ip TEXT NOT NULL, metric TEXT NOT NULL, data TEXT NOT NULL, "
+        "PRIMARY KEY (granularity, metric, bucket, model, client_ip)) WITHOUT ROWID",
+    ],
+    # v3: column-wise request rows with dictionary-encoded strings (see History persistence).
+    # Ids and the AUTOINCREMENT sequence carry over, so sync cursors stay valid.
+    [
+        "CREATE TABLE IF NOT EXISTS strings (id INTEGER PRIMARY KEY, value TEXT NOT NULL UNIQUE)",
+        "INSERT OR IGNORE INTO strings (value) "
+        "SELECT CAST(model AS TEXT) FROM requests UNION SELECT CAST(client_ip AS TEXT) FROM requests "
+        "UNION SELECT CAST(COALESCE(json_extract(data, '$.path'), '') AS TEXT) FROM requests "
+        "UNION SELECT CAST(source AS TEXT) FROM requests",
+        "CREATE TABLE requests_v3 (id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL NOT NULL, "
+        "model_id INTEGER NOT NULL, client_id INTEGER NOT NULL, path_id INTEGER NOT NULL, "
+        "source_id INTEGER NOT NULL, status INTEGER NOT NULL, duration_ms REAL NOT NULL, "
+        "tokens INTEGER NOT NULL, prompt_tokens INTEGER NOT NULL, tokens_per_sec REAL NOT NULL, "
+        "data TEXT NOT NULL)",
+        "INSERT INTO requests_v3 SELECT r.id, r.ts, m.id, c.id, p.id, s.id, CAST(r.status AS INTEGER), "
+        "CAST(r.duration_ms AS REAL), CAST(r.tokens AS INTEGER), CAST(r.prompt_tokens AS INTEGER), "
+        "CAST(r.tokens_per_sec AS REAL), json_remove(r.data, '$.time', '$.time_display', '$.duration', "
+        "'$.total_tokens', '$.id', '$.model', '$.client_ip', '$.path', '$.source', '$.status', "
+        "'$.duration_ms', '$.tokens', '$.prompt_tokens', '$.tokens_per_sec') FROM requests r "
+        "JOIN strings m ON m.value = CAST(r.model AS TEXT) "
+        "JOIN strings c ON c.value = CAST(r.client_ip AS TEXT) "
+        "JOIN strings p ON p.value = CAST(COALESCE(json_extract(r.data, '$.path'), '') AS TEXT) "
+        "JOIN strings s ON s.value = CAST(r.source AS TEXT) ORDER BY r.id",
+        "DELETE FROM sqlite_sequence WHERE name = 'requests_v3'",
+        "INSERT INTO sqlite_sequence (name, seq) SELECT 'requests_v3', seq FROM sqlite_sequence "
+        "WHERE name = 'requests'",
+        "DROP TABLE requests",
+        "ALTER TABLE requests_v3 RENAME TO requests",
+        "CREATE INDEX idx_requests_ts ON requests(ts)",
+        "CREATE INDEX idx_requests_model ON requests(model_id, ts)",
+        "CREATE INDEX idx_requests_client ON requests(client_id, ts)",
+        "CREATE INDEX idx_requests_source ON requests(source_id, ts)",
+        "CREATE INDEX idx_requests_status ON requests(status, ts)",
+        "CREATE INDEX idx_requests_duration ON requests(duration_ms)",
+        "CREATE INDEX idx_requests_tokens ON requests(tokens)",
+        "CREATE INDEX idx_requests_prompt_tokens ON requests(prompt_tokens)",
+        "CREATE INDEX idx_requests_tps ON requests(tokens_per_sec)",
+        # Entries now read back with derived display fields
+        "INSERT INTO meta (key, value) VALUES ('generation', '1') "
+        "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1",
+    ],
+]
+
+def init_history_store():
+    """Create the schema and import a legacy history.json if present."""
+    conn = get_db()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        # Converting takes a full VACUUM that would hold the store for the whole
+        # rewrite; freed pages are reused by new rows instead.
+        print("[HISTORY] Incremental vacuum off for this file: retention frees pages for reuse "
+              "but does not shrink it")
+    for kind in HISTORY_KINDS:
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {kind} ("
+                     "id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL NOT NULL, data TEXT NOT NULL)")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{kind}_ts ON {kind}(ts)")
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value REAL NOT NULL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS rollups ("
+                 "granularity TEXT NOT NULL, bucket INTEGER NOT NULL, model TEXT NOT NULL, "
+                 "client_ip TEXT NOT NULL, source TEXT NOT NULL, requests INTEGER NOT NULL, "
+                 "errors INTEGER NOT NULL, gen_tokens INTEGER NOT NULL, prompt_tokens INTEGER NOT NULL, "
+                 "duration_ms REAL NOT NULL, "
+                 "PRIMARY KEY (granularity, bucket, model, client_ip, source)) WITHOUT ROWID")
+
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, statements in enumerate(SCHEMA_MIGRATIONS[version:], start=version + 1):
+        with db_transaction(conn):
+            for sql in statements:
+                conn.execute(sql)
+            conn.execute(f"PRAGMA user_version = {target}")
+        print(f"[HISTORY] Schema migrated to v{target}")
+    if version < len(SCHEMA_MIGRATIONS):
+        # Hand back the pages of any rewritten tables
+        incremental_vacuum()
+
+    with history_lock:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'aggregates_version'").fetchone()
+        if not row or row[0] != str(AGGREGATES_VERSION):
+            with db_transaction(conn):
+                rebuild_aggregates(conn)
+            print("[HISTORY] Rebuilt rollups and counters from raw history")
+
+    if os.path.exists(HISTORY_FILE):
+        try:
+            with open(HISTORY_FILE, 'r') as f:
+                legacy = json.load(f)
+            with history_lock, db_transaction(conn):
+                for kind in HISTORY_KINDS:
+                    _insert_entries(conn, kind, legacy.get(kind, []))
+            os.replace(HISTORY_FILE, HISTORY_FILE + '.migrated')
+            print(f"[HISTORY] Migrated {HISTORY_FILE} → {HISTORY_DB} "
+                  f"({len(legacy.get('requests', []))} requests)")
+        except Exception as e:
+            print(f"[HISTORY] Migration of {HISTORY_FILE} failed: {e}")
+
+def load_history():
+    conn = get_db()
+    data = {}
+    for kind in HISTORY_KINDS:
+        rows = conn.execute(f"SELECT {kind}.id, {entry_select(kind)} ORDER BY {kind}.id").fetchall()
+        data[kind] = [decode_entry(kind, r[1:]) for r in rows]
+    return data
 
 def save_history(data):
-    os.makedirs(DATA_DIR, exist_ok=True)
-    with open(HISTORY_FILE, 'w') as f:
-        json.dump(data, f, indent=2, default=str)
+    """Replace the whole store (trim/clear). Normal writes go through append_history."""
+    with db_transaction() as conn:
+        for kind in HISTORY_KINDS:
+            conn.execute(f"DELETE FROM {kind}")
+            _insert_entries(conn, kind, data.get(kind, []))
+        rebuild_aggregates(conn, full=True)
+        bump_generation(conn)
+    broadcaster.publish("resync", {})
+
+# ── Incremental sync cursors ─────────────────────────────────────
+# A cursor is "<generation>.<last request id>.<last benchmark id>.<last event id>.<last sweep id>".
+# Ids only grow (AUTOINCREMENT); the generation is bumped whenever existing rows
+# are removed, telling clients to drop their copy and resync.
+def bump_generation(conn):
+    conn.execute("INSERT INTO meta (key, value) VALUES ('generation', '1') "
+                 "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+
+def history_cursor():
+    conn = get_db()
+    row = conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+    seqs = dict(conn.execute("SELECT name, seq FROM sqlite_sequence").fetchall())
+    return ".".join([row[0] if row else "0"] + [str(seqs.get(kind, 0)) for kind in HISTORY_KINDS])
+
+def parse_cursor(cursor):
+    """(generation, {kind: last_id}) or None if malformed."""
+    try:
+        parts = cursor.split(".")
+        if len(parts) != len(HISTORY_KINDS) + 1:
+            return None
+        return parts[0], {kind: int(p) for kind, p in zip(HISTORY_KINDS, parts[1:])}
+    except:
+        return None
+
+def load_history_since(last_ids=None, limit=None):
+    """Entries (with their `id`) newer than last_ids; everything when None.
+
+    With limit, only the newest `limit` of those per kind."""
+    conn = get_db()
+    data = {}
+    for kind in HISTORY_KINDS:
+        after = (last_ids or {}).get(kind, 0)
+        if limit is None:
+            rows = conn.execute(f"SELECT {kind}.id, {entry_select(kind)} WHERE {kind}.id > ? ORDER BY {kind}.id",
+                                (after,)).fetchall()
+        else:
+            rows = conn.execute(f"SELECT {kind}.id, {entry_select(kind)} WHERE {kind}.id > ? "
+                                f"ORDER BY {kind}.id DESC LIMIT ?", (after, limit)).fetchall()[::-1]
+        data[kind] = [dict(decode_entry(kind, r[1:]), id=r[0]) for r in rows]
+    return data
+
+def append_history(kind, entries):
+    """Append entries to one history list in a single transaction."""
+    if not entries:
+        return
+    with db_transaction() as conn:
+        ids = _insert_entries(conn, kind, entries)
+    publish_new_entries({kind: list(zip(ids, entries))})
+
+def history_size_bytes():
+    total = 0
+    for path in (HISTORY_DB, HISTORY_DB + '-wal'):
+        try:
+            total += os.path.getsize(path)
+        except:
+            pass
+    return total
+
+# ── Retention ────────────────────────────────────────────────────
+# A background worker enforces the retention_months setting (off unless the
+# user saved one). Expired raw
+# entries are deleted oldest first, RETENTION_CHUNK rows per short transaction
+# with a pause in between, so the history writer is never held up for long.
+# Counters are adjusted for the deleted rows. Hour/day rollups and sketches
+# are kept as the downsampled long-term history; minute rollups are kept for
+# RETENTION_MINUTE_ROLLUP_DAYS. Freed pages go back to the filesystem through
+# incremental vacuum, again in small steps, where the file was created with it
+# (see get_db). /api/trim uses the same path.
+RETENTION_INTERVAL = float(os.environ.get('RETENTION_INTERVAL', 21600))
+RETENTION_CHUNK = int(os.environ.get('RETENTION_CHUNK', 500))
+RETENTION_PAUSE = float(os.environ.get('RETENTION_PAUSE', 0.05))
+RETENTION_MINUTE_ROLLUP_DAYS = float(os.environ.get('RETENTION_MINUTE_ROLLUP_DAYS', 7))
+DEFAULT_RETENTION_MONTHS = 0  # nothing is deleted until a retention period is saved
+VACUUM_STEP_PAGES = 1024
+
+retention_stats = {"runs": 0, "running": False, "last_run": None, "last_duration_ms": None,
+                   "last_deleted": {}, "last_reclaimed_bytes": 0, "deleted_total": 0,
+                   "reclaimed_bytes_total": 0, "retention_months": None, "cutoff": None, "last_error": None}
+_retention_lock = threading.Lock()
+
+def delete_history_chunked(kind, where, params):
+    """Delete the rows of one kind matching `where`, oldest first by (ts, id), one chunk per transaction."""
+    conn = get_db()
+    deleted = 0
+    while True:
+        with history_lock:
+            # Read and decode outside the write transaction; history_lock keeps the rows stable
+            rows = conn.execute(f"SELECT {kind}.id, {entry_select(kind)} WHERE {where} "
+                                f"ORDER BY {kind}.ts, {kind}.id LIMIT ?",
+                                list(params) + [RETENTION_CHUNK]).fetchall()
+            if not rows:
+                break
+            counters = _entry_counters(kind, [(r[1], decode_entry(kind, r[1:])) for r in rows])
+            with db_transaction(conn):
+                conn.execute(f"DELETE FROM {kind} WHERE ({kind}.ts, {kind}.id) <= (?, ?) AND {where}",
+                             [rows[-1][1], rows[-1][0]] + list(params))
+                conn.executemany("UPDATE counters SET value = value - ? WHERE name = ?",
+                                 [(v, name) for name, v in counters.items()])
+                if kind == "requests":
+                    # Rollups before this point can no longer be rebuilt from raw rows
+                    conn.execute("INSERT INTO meta (key, value) VALUES ('retention_floor', ?) "
+                                 "ON CONFLICT(key) DO UPDATE SET value = "
+                                 "MAX(CAST(value AS REAL), CAST(excluded.value AS REAL))",
+                                 (str(max(r[1] for r in rows)),))
+        deleted += len(rows)
+        _retention_checkpoint(conn)
+    return deleted
+
+def _retention_checkpoint(conn):
+    """Checkpoint the WAL from this thread so the history writer's next commit
+    does not inherit the auto-checkpoint of pages we just wrote."""
+    conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+    time.sleep(RETENTION_PAUSE)
+
+def _thin_minute_rollups():
+    """Drop minute rollups past RETENTION_MINUTE_ROLLUP_DAYS, a day of buckets per transaction."""
+    conn = get_db()
+    cutoff = _bucket_start(time.time() - RETENTION_MINUTE_ROLLUP_DAYS * 86400, "minute")
+    first = conn.execute("SELECT MIN(bucket) FROM rollups WHERE granularity = 'minute'").fetchone()[0]
+    while first is not None and first < cutoff:
+        first = min(first + 86400, cutoff)
+        with db_transaction(conn):
+            conn.execute("DELETE FROM rollups WHERE granularity = 'minute' AND bucket < ?", (first,))
+        _retention_checkpoint(conn)
+
+def incremental_vacuum():
+    """Return free pages to the filesystem in VACUUM_STEP_PAGES steps. Pages released."""
+    conn = get_db()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    released = 0
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    while free:
+        # executescript steps the pragma to completion; execute() would free a single page
+        conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES});")
+        remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if remaining >= free:
+            break
+        released += free - remaining
+        free = remaining
+        _retention_checkpoint(conn)
+    return released
+
+def _history_rows_removed(deleted):
+    """Tell sync clients to drop their copy when existing rows went away."""
+    if not any(deleted.values()):
+        return
+    with db_transaction() as conn:
+        bump_generation(conn)
+    broadcaster.publish("resync", {})
+
+def run_retention(months=None, keep=None):
+    """One retention pass; months defaults to the retention_months setting (0 = keep everything).
+
+    With keep, only the newest `keep` entries of each kind are kept instead
+    (/api/trim count mode). Returns the run summary, or None if a pass is
+    already running."""
+    if not _retention_lock.acquire(blocking=False):
+        return None
+    t0 = time.perf_counter()
+    size_before = history_size_bytes()
+    retention_stats["running"] = True
+    deleted = {}
+    try:
+        if keep is not None:
+            # Newest by timestamp, not id: imported entries get new ids for old times
+            for kind in HISTORY_KINDS:
+                row = get_db().execute(f"SELECT ts, id FROM {kind} ORDER BY ts DESC, id DESC LIMIT 1 OFFSET ?",
+                                       (max(int(keep), 1) - 1,)).fetchone()
+                deleted[kind] = (delete_history_chunked(kind, f"({kind}.ts, {kind}.id) < (?, ?)", list(row))
+                                 if row else 0)
+        else:
+            if months is None:
+                months = load_settings().get('retention_months', DEFAULT_RETENTION_MONTHS)
+            months = float(months or 0)
+            retention_stats.update(retention_months=months, cutoff=None)
+            if months > 0:
+                cutoff = time.time() - months * 30 * 86400
+                retention_stats["cutoff"] = datetime.fromtimestamp(cutoff).isoformat()
+                for kind in HISTORY_KINDS:
+                    deleted[kind] = delete_history_chunked(kind, "ts < ?", [cutoff])
+            _thin_minute_rollups()
+        _history_rows_removed(deleted)
+        pages = incremental_vacuum()
+        retention_stats["last_error"] = None
+    except Exception as e:
+        retention_stats["last_error"] = str(e)
+        print(f"[RETENTION] Run failed: {e}")
+        raise
+    finally:
+        reclaimed = max(0, size_before - history_size_bytes())
+        elapsed_ms = round((time.perf_counter() - t0) * 1000, 1)
+        retention_stats.update(running=False, last_run=datetime.now().isoformat(),
+                               last_duration_ms=elapsed_ms, last_deleted=deleted,
+                               last_reclaimed_bytes=reclaimed)
+        retention_stats["runs"] += 1
+        retention_stats["deleted_total"] += sum(deleted.values())
+        retention_stats["reclaimed_bytes_total"] += reclaimed
+        _retention_lock.release()
+    if any(deleted.values()) or pages:
+        print(f"[RETENTION] Deleted {sum(deleted.values())} entries, released {pages} pages "
+              f"({_fmt_bytes(reclaimed)}) in {elapsed_ms:.0f}ms")
+    return {"deleted": deleted, "reclaimed_bytes": reclaimed, "duration_ms": elapsed_ms}
+
+def retention_loop():
+    time.sleep(60)  # let startup (log backfill, first polls) settle first
+    while True:
+        try:
+            run_retention()
+        except Exception:
+            pass  # recorded in retention_stats
+        time.sleep(RETENTION_INTERVAL)
+
+# ── Server-Sent Events ───────────────────────────────────────────
+# One producer (poller / history writer) → every open dashboard tab. Each event
+# is serialized once; subscribers get a bounded queue, and one that falls too
+# far behind is told to resync instead of blocking the producer.
+SSE_QUEUE_SIZE = 256
+SSE_HEARTBEAT = 15
+
+class EventBroadcaster:
+    def __init__(self, max_queue=SSE_QUEUE_SIZE):
+        self.max_queue = max_queue
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=self.max_queue)
+        with self._lock:
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    @staticmethod
+    def format(event, data):
+        return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n".encode()
+
+    def publish(self, event, data):
+        if not self._subscribers:
+            return
+        payload = self.format(event, data)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(payload)
+            except queue.Full:
+                # Slow consumer: drop its backlog and tell it to refetch
+                try:
+                    while True:
+                        q.get_nowait()
+                except queue.Empty:
+                    pass
+                q.put_nowait(self.format("resync", {}))
+
+broadcaster = EventBroadcaster()
+
+def publish_new_entries(written):
+    """Push freshly stored entries ({kind: [(id, entry)]}) to SSE subscribers."""
+    payload = {kind: [dict(e, id=i) for i, e in rows] for kind, rows in written.items() if rows}
+    if payload:
+        broadcaster.publish("history", payload)
+
+# ── Request queries (filter / sort / page) ──────────────────────
+REQUEST_SORT_COLUMNS = {
+    "time": "requests.ts", "duration_ms": "duration_ms", "model": "m.value", "client_ip": "c.value",
+    "status": "status", "tokens": "tokens", "prompt_tokens": "prompt_tokens",
+    "tokens_per_sec": "tokens_per_sec",
+}
+REQUEST_PAGE_MAX = 1000
+
+def _parse_time_arg(value):
+    """Epoch seconds from an epoch number or ISO timestamp query arg."""
+    if value in (None, ''):
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+def query_requests(since=None, until=None, model=None, client_ip=None, source=None, status=None,
+                   sort="time", direction="desc", limit=50, offset=0, after=None, with_total=True):
+    """One page of request entries plus the keyset token for the next page.
+
+    `status` is an exact code, "ok" (<400) or "error" (>=400). `after` is the
+    `next` token from a previous page and takes precedence over `offset`.
+    """
+    column = REQUEST_SORT_COLUMNS.get(sort)
+    if column is None:
+        raise ValueError(f"sort must be one of {', '.join(REQUEST_SORT_COLUMNS)}")
+    desc = direction != "asc"
+    where, params = [], []
+    if since is not None:
+        where.append("ts >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("ts < ?")
+        params.append(until)
+    for col, value in (("model_id", model), ("client_id", client_ip), ("source_id", source)):
+        if value:
+            where.append(f"{col} = (SELECT id FROM strings WHERE value = ?)")
+            params.append(value)
+    if status == "ok":
+        where.append("status < 400")
+    elif status == "error":
+        where.append("status >= 400")
+    elif status not in (None, ''):
+        where.append("status = ?")
+        params.append(int(status))
+
+    conn = get_db()
+    total = None
+    if with_total:
+        total = conn.execute(f"SELECT COUNT(*) FROM requests {'WHERE ' + ' AND '.join(where) if where else ''}",
+                             params).fetchone()[0]
+
+    page_where, page_params = list(where), list(params)
+    if after:
+        value, last_id = json.loads(base64.urlsafe_b64decode(after.encode()))
+        page_where.append(f"({column}, requests.id) {'<' if desc else '>'} (?, ?)")
+        page_params += [value, last_id]
+        offset = 0
+    order = "DESC" if desc else "ASC"
+    sql = (f"SELECT requests.id, {column}, {REQUEST_SELECT} "
+           f"{'WHERE ' + ' AND '.join(page_where) if page_where else ''} "
+           f"ORDER BY {column} {order}, requests.id {order} LIMIT ? OFFSET ?")
+    limit = max(1, min(int(limit), REQUEST_PAGE_MAX))
+    rows = conn.execute(sql, page_params + [limit, int(offset)]).fetchall()
+
+    next_token = None
+    if len(rows) == limit:
+        last = rows[-1]
+        next_token = base64.urlsafe_b64encode(json.dumps([last[1], last[0]]).encode()).decode()
+    return {
+        "requests": [dict(decode_entry("requests", r[2:]), id=r[0]) for r in rows],
+        "total": total,
+        "next": next_token,
+    }
+
+# ── Export & import ──────────────────────────────────────────────
+# Exports stream straight from the store: each kind is read EXPORT_CHUNK rows
+# at a time by id (a short read per chunk, so WAL checkpoints aren't held
+# back) and encoded as it goes, so memory stays flat however large the history
+# is. NDJSON carries every kind, one entry per line tagged with "kind", and is
+# what /api/history/import reads back — streamed and inserted a chunk per
+# transaction. CSV holds one kind. Either can be gzip- or, with the optional
+# zstandard package, zstd-compressed on the fly.
+EXPORT_CHUNK = 1000
+EXPORT_BUFFER = 64 * 1024
+EXPORT_FORMATS = ("json", "ndjson", "csv")
+EXPORT_COMPRESSIONS = ("gzip", "zstd")
+REQUEST_CSV_FIELDS = ("time", "status", "duration_ms", "client_ip", "method", "path", "model",
+                      "tokens", "prompt_tokens", "tokens_per_sec", "prompt_tok_per_sec", "ttft_ms",
+                      "inter_token_ms", "inter_token_max_ms", "queue_ms", "done_reason", "source",
+                      "backend", "coalesced")
+
+def iter_history(kind, since=None, until=None, model=None, client_ip=None):
+    """Entries of one kind in id order, optionally filtered like query_requests."""
+    where, params = [f"{kind}.id > ?"], []
+    if since is not None:
+        where.append(f"{kind}.ts >= ?")
+        params.append(since)
+    if until is not None:
+        where.append(f"{kind}.ts < ?")
+        params.append(until)
+    for col, value in (("model", model), ("client_ip", client_ip)):
+        if value:
+            # Indexed columns on requests; the other kinds only have the JSON
+            if kind == "requests":
+                where.append(f"{dict(REQUEST_STRING_COLUMNS)[col]} = (SELECT id FROM strings WHERE value = ?)")
+            else:
+                where.append(f"json_extract(data, '$.{col}') = ?")
+            params.append(value)
+    sql = (f"SELECT {kind}.id, {entry_select(kind)} WHERE {' AND '.join(where)} "
+           f"ORDER BY {kind}.id LIMIT {EXPORT_CHUNK}")
+    conn = get_db()
+    last = 0
+    while True:
+        rows = conn.execute(sql, [last] + params).fetchall()
+        for r in rows:
+            yield decode_entry(kind, r[1:])
+        if len(rows) < EXPORT_CHUNK:
+            return
+        last = rows[-1][0]
+
+def _export_json(kinds, filters):
+    """The original {"requests": [...], ...} export document, written piecewise."""
+    yield "{"
+    for n, kind in enumerate(kinds):
+        yield f'{", " if n else ""}"{kind}": ['
+        sep = ""
+        for e in iter_history(kind, **filters):
+            yield sep + json.dumps(e, default=str)
+            sep = ", "
+        yield "]"
+    yield "}"
+
+def _export_ndjson(kinds, filters):
+    for kind in kinds:
+        for e in iter_history(kind, **filters):
+            yield json.dumps({"kind": kind, **e}, default=str) + "\n"
+
+def _export_csv(kind, filters):
+    """One kind as CSV; requests get fixed columns, other kinds the first entry's keys."""
+    out = io.StringIO()
+    writer = None
+    if kind == "requests":
+        writer = csv.DictWriter(out, REQUEST_CSV_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+    for e in iter_history(kind, **filters):
+        if writer is None:
+            writer = csv.DictWriter(out, list(e), extrasaction='ignore')
+            writer.writeheader()
+        writer.writerow({k: json.dumps(v) if isinstance(v, (dict, list)) else v for k, v in e.items()})
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    if out.tell():
+        yield out.getvalue()
+
+def export_compressor(compress):
+    """(compress, flush) for an export encoding; zstd needs the zstandard package."""
+    if compress == "gzip":
+        c = zlib.compressobj(6, zlib.DEFLATED, 31)
+    else:
+        import zstandard
+        c = zstandard.ZstdCompressor(level=3).compressobj()
+    return c.compress, c.flush
+
+def export_stream(chunks, compressor=None):
+    """Join encoded text into EXPORT_BUFFER-sized byte blocks, compressing them if asked."""
+    compress, flush = compressor or (None, None)
+    buf, size = [], 0
+    for text in chunks:
+        buf.append(text)
+        size += len(text)
+        if size >= EXPORT_BUFFER:
+            block = "".join(buf).encode()
+            buf, size = [], 0
+            block = compress(block) if compress else block
+            if block:
+                yield block
+    block = "".join(buf).encode()
+    if compress:
+        block = compress(block) + flush()
+    if block:
+        yield block
+
+def _iter_upload_blocks(stream):
+    """Decompressed blocks of an upload; gzip and zstd are recognised by their magic bytes."""
+    head = stream.read(EXPORT_BUFFER)
+    if head[:2] == b'\x1f\x8b':
+        d = zlib.decompressobj(47)
+        block = head
+        while block:
+            yield d.decompress(block)
+            block = stream.read(EXPORT_BUFFER)
+        yield d.flush()
+    elif head[:4] == b'\x28\xb5\x2f\xfd':
+        import zstandard
+        reader = zstandard.ZstdDecompressor().stream_reader(io.BufferedReader(_Prepend(head, stream)))
+        block = reader.read(EXPORT_BUFFER)
+        while block:
+            yield block
+            block = reader.read(EXPORT_BUFFER)
+    else:
+        block = head
+        while block:
+            yield block
+            block = stream.read(EXPORT_BUFFER)
+
+class _Prepend(io.RawIOBase):
+    """A read-only stream that replays `head` before continuing with `stream`."""
+    def __init__(self, head, stream):
+        self.head, self.stream = head, stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.head[:len(b)] if self.head else self.stream.read(len(b))
+        self.head = self.head[len(data):] if self.head else b''
+        b[:len(data)] = data
+        return len(data)
+
+IMPORT_MAX_ENTRY = 16 * 1024 * 1024
+_JSON_WS = re.compile(r'[ \t\n\r]*')
+# A JSON export document starts {"<kind>": [ ; NDJSON lines are flat objects
+_JSON_DOCUMENT = re.compile(r'\s*(\[|\{\s*"(?:[^"\\]|\\.)*"\s*:\s*\[)')
+
+class _JSONEntryReader:
+    """(kind, entry) pairs from a JSON export document or array, one entry at a time.
+
+    The brackets, keys and commas around the entries are stepped over by hand
+    and each entry is parsed with raw_decode, so only the current entry and
+    the unread rest of one block are ever buffered."""
+    def __init__(self, text, blocks, decoder):
+        self.buf, self.pos = text, 0
+        self.blocks, self.decoder = blocks, decoder
+        self.json = json.JSONDecoder()
+
+    def _fill(self):
+        """Append the next block (dropping what was consumed); False at the end of the upload."""
+        for block in self.blocks:
+            text = self.decoder.decode(block)
+            if text:
+                self.buf = self.buf[self.pos:] + text
+                self.pos = 0
+                return True
+        return False
+
+    def peek(self):
+        """The next non-whitespace character, or '' at the end."""
+        while True:
+            self.pos = _JSON_WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        ch = self.peek()
+        if ch == '' or ch not in chars:
+            raise ValueError(f"expected one of {chars!r} at {ch!r}")
+        self.pos += 1
+        return ch
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.json.raw_decode(self.buf, self.pos)
+                # A number or literal at the end of the buffer may continue in the next block
+                if end < len(self.buf) or not self._fill():
+                    self.pos = end
+                    return value
+                continue
+            except ValueError:
+                if len(self.buf) - self.pos > IMPORT_MAX_ENTRY or not self._fill():
+                    raise
+
+    def _array(self, kind):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield kind, self.value()
+            if self.expect(',]') == ']':
+                return
+
+    def __iter__(self):
+        if self.peek() == '[':
+            for _, e in self._array(None):
+                yield (e.pop("kind", "requests") if isinstance(e, dict) else None), e
+            return
+        self.expect('{')
+        if self.peek() == '}':
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            if self.peek() == '[':
+                yield from self._array(key)
+            else:
+                self.value()  # not a history list
+            if self.expect(',}') == '}':
+                return
+
+def _iter_import_entries(stream):
+    """(kind, entry) pairs of an upload, or (None, None) for each unparseable NDJSON line.
+
+    JSON documents and arrays are decoded entry by entry; anything else is
+    read as NDJSON, one entry per line."""
+    blocks = _iter_upload_blocks(stream)
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    head = ''
+    for block in blocks:
+        head += decoder.decode(block)
+        if len(head.lstrip()) >= 256:
+            break
+    match = _JSON_DOCUMENT.match(head)
+    if match:
+        yield from _JSONEntryReader(head, blocks, decoder)
+        return
+    rest = (decoder.decode(block) for block in blocks)
+    for line in _iter_log_lines(itertools.chain([head], rest), sep='\n'):
+        if not line.strip():
+            continue
+        try:
+            e = json.loads(line)
+        except ValueError:
+            yield None, None
+            continue
+        yield (e.pop("kind", "requests") if isinstance(e, dict) else None), e
+
+def _stored_key(kind, row):
+    """What identifies an entry, from the columns of entry_select (without the id)."""
+    return tuple(row[1:10]) if kind == "requests" else (row[1],)
+
+def _entry_key(kind, entry):
+    """_stored_key for an entry about to be inserted."""
+    if kind == "requests":
+        return (tuple(str(entry.get(f) or "") for f, _ in REQUEST_STRING_COLUMNS)
+                + tuple(_number(entry.get(f), cast) for f, cast in REQUEST_NUMBER_COLUMNS))
+    return (_compact_json(entry),)
+
+def _new_entries(conn, kind, entries):
+    """The entries not already stored, nor repeated earlier in `entries`.
+
+    Two entries are the same when they have the same time and the same
+    columns (requests) or document (other kinds); each check is one lookup on
+    the ts index, so importing an export twice, or one that overlaps the
+    current history, doesn't count anything twice."""
+    seen, fresh = set(), []
+    for entry in entries:
+        ts = _entry_ts(entry)
+        key = (round(ts, 6), _entry_key(kind, entry))
+        if key in seen:
+            continue
+        seen.add(key)
+        # ts round-trips through the ISO time, to the microsecond
+        rows = conn.execute(f"SELECT {entry_select(kind)} WHERE {kind}.ts BETWEEN ? AND ?",
+                            (ts - 5e-7, ts + 5e-7)).fetchall()
+        if key[1] not in {_stored_key(kind, r) for r in rows}:
+            fresh.append(entry)
+    return fresh
+
+def import_history(stream):
+    """Stream entries of an ndjson export (or a json export document) into the store.
+
+    Entries are inserted EXPORT_CHUNK per transaction with their aggregates, so
+    the upload is never held in memory; entries already in the store are left
+    out (see _new_entries). Returns per-kind counts, the number of duplicates
+    and the number of entries skipped as unparseable or of an unknown kind."""
+    imported = {kind: 0 for kind in HISTORY_KINDS}
+    pending = {}
+    skipped = 0
+    duplicates = 0
+
+    def flush(kind):
+        nonlocal duplicates
+        entries = pending.pop(kind, [])
+        if entries:
+            with history_lock, db_transaction() as conn:
+                fresh = _new_entries(conn, kind, entries)
+                _insert_entries(conn, kind, fresh)
+            imported[kind] += len(fresh)
+            duplicates += len(entries) - len(fresh)
+
+    for kind, entry in _iter_import_entries(stream):
+        if kind not in HISTORY_KINDS or not isinstance(entry, dict):
+            skipped += 1
+            continue
+        entry.pop("id", None)
+        pending.setdefault(kind, []).append(entry)
+        if len(pending[kind]) >= EXPORT_CHUNK:
+            flush(kind)
+    for kind in HISTORY_KINDS:
+        flush(kind)
+
+    if any(imported.values()):
+        # Imported rows get new ids but old timestamps: have clients reload rather than append
+        with db_transaction() as conn:
+            bump_generation(conn)
+        broadcaster.publish("resync", {})
+    return {"imported": imported, "duplicates": duplicates, "skipped": skipped}
+
+# ── Prometheus metrics ───────────────────────────────────────────
+# Updated in memory as entries are produced (enqueue_history), never derived
+# from stored history at scrape time. Rendered in the Prometheus text format
+# by /metrics. Model/VRAM gauges are read from the latest poll.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TTFT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+TOKENS_PER_SEC_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 150, 200, 400)
+PROMPT_TOKENS_PER_SEC_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+class MetricsRegistry:
+    """Minimal thread-safe counter/gauge/histogram store with text exposition."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _declare(self, name, kind, help_text, labels, buckets=None):
+        self._metrics[name] = {"type": kind, "help": help_text, "labels": labels,
+                               "buckets": buckets, "series": {}}
+
+    def counter(self, name, help_text, labels=()):
+        self._declare(name, "counter", help_text, labels)
+
+    def histogram(self, name, help_text, labels, buckets):
+        self._declare(name, "histogram", help_text, labels, buckets)
+
+    def inc(self, name, label_values=(), amount=1):
+        with self._lock:
+            series = self._metrics[name]["series"]
+            series[label_values] = series.get(label_values, 0) + amount
+
+    def observe(self, name, label_values, value):
+        m = self._metrics[name]
+        with self._lock:
+            s = m["series"].get(label_values)
+            if s is None:
+                s = m["series"][label_values] = [0] * len(m["buckets"]) + [0.0, 0]
+            for i, bound in enumerate(m["buckets"]):
+                if value <= bound:
+                    s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    @staticmethod
+    def _labels(names, values, extra=None):
+        pairs = list(zip(names, values)) + ([extra] if extra else [])
+        if not pairs:
+            return ""
+        esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+    def render(self):
+        out = []
+        with self._lock:
+            for name, m in self._metrics.items():
+                out.append(f"# HELP {name} {m['help']}")
+                out.append(f"# TYPE {name} {m['type']}")
+                for values, s in m["series"].items():
+                    if m["type"] != "histogram":
+                        out.append(f"{name}{self._labels(m['labels'], values)} {s}")
+                        continue
+                    for bound, n in zip(m["buckets"], s):
+                        out.append(f"{name}_bucket{self._labels(m['labels'], values, ('le', bound))} {n}")
+                    out.append(f"{name}_bucket{self._labels(m['labels'], values, ('le', '+Inf'))} {s[-1]}")
+                    out.append(f"{name}_sum{self._labels(m['labels'], values)} {round(s[-2], 6)}")
+                    out.append(f"{name}_count{self._labels(m['labels'], values)} {s[-1]}")
+        return out
+
+metrics = MetricsRegistry()
+_REQ_LABELS = ("model", "client", "path")
+metrics.histogram("ollama_request_duration_seconds", "Request latency as seen by the proxy or GIN log",
+                  _REQ_LABELS + ("source",), LATENCY_BUCKETS)
+metrics.histogram("ollama_ttft_seconds", "Time to first streamed token", _REQ_LABELS, TTFT_BUCKETS)
+metrics.histogram("ollama_queue_seconds", "Time spent waiting for admission in the proxy", _REQ_LABELS, TTFT_BUCKETS)
+metrics.histogram("ollama_tokens_per_second", "Generation speed (eval tokens/s)", _REQ_LABELS, TOKENS_PER_SEC_BUCKETS)
+metrics.histogram("ollama_prompt_tokens_per_second", "Prompt processing speed (prompt tokens/s)",
+                  _REQ_LABELS, PROMPT_TOKENS_PER_SEC_BUCKETS)
+metrics.counter("ollama_requests_total", "Requests by status", _REQ_LABELS + ("source", "status"))
+metrics.counter("ollama_request_errors_total", "Requests answered with status >= 400", _REQ_LABELS + ("status",))
+metrics.counter("ollama_tokens_total", "Tokens processed", ("model", "client", "type"))
+metrics.counter("ollama_tokens_saved_total", "Tokens served from the cache or a coalesced request",
+                ("model", "client", "source"))
+metrics.counter("ollama_model_loads_total", "Model load events", ("model",))
+metrics.counter("ollama_model_unloads_total", "Model unload events", ("model",))
+
+def observe_entries(kind, entries):
+    """Fold freshly produced history entries into the in-memory metrics."""
+    if kind == "events":
+        for e in entries:
+            if e.get("type") in ("load", "unload"):
+                metrics.inc(f"ollama_model_{e['type']}s_total", (e.get("model", ""),))
+        return
+    if kind != "requests":
+        return
+    client_map = get_client_map()
+    for e in entries:
+        model = e.get("model") or "—"
+        ip = e.get("client_ip", "unknown")
+        mapped = client_map.get(ip)
+        # CLIENT_MAP values are either a plain name or {"name": ..., "icon": ...}
+        client = (mapped.get("name") if isinstance(mapped, dict) else mapped) or ip
+        labels = (model, client, e.get("path", ""))
+        status = e.get("status", 0)
+        metrics.inc("ollama_requests_total", labels + (e.get("source", ""), str(status)))
+        if isinstance(status, int) and status >= 400:
+            metrics.inc("ollama_request_errors_total", labels + (str(status),))
+        metrics.observe("ollama_request_duration_seconds", labels + (e.get("source", ""),),
+                        (e.get("duration_ms") or 0) / 1000)
+        if e.get("ttft_ms") is not None:
+            metrics.observe("ollama_ttft_seconds", labels, e["ttft_ms"] / 1000)
+        if e.get("queue_ms") is not None:
+            metrics.observe("ollama_queue_seconds", labels, e["queue_ms"] / 1000)
+        if e.get("tokens_per_sec"):
+            metrics.observe("ollama_tokens_per_second", labels, e["tokens_per_sec"])
+        if e.get("prompt_tok_per_sec"):
+            metrics.observe("ollama_prompt_tokens_per_second", labels, e["prompt_tok_per_sec"])
+        if e.get("source") in SAVED_SOURCES:
+            metrics.inc("ollama_tokens_saved_total", (model, client, e["source"]),
+                        (e.get("tokens") or 0) + (e.get("prompt_tokens") or 0))
+            continue
+        if e.get("tokens"):
+            metrics.inc("ollama_tokens_total", (model, client, "generated"), e["tokens"])
+        if e.get("prompt_tokens"):
+            metrics.inc("ollama_tokens_total", (model, client, "prompt"), e["prompt_tokens"])
+
+def _gauge_lines(name, help_text, samples):
+    """samples: [(labels dict, value)]"""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    for labels, value in samples:
+        lines.append(f"{name}{MetricsRegistry._labels(list(labels), list(labels.values()))} {value}")
+    return lines
+
+def render_metrics():
+    lines = metrics.render()
+    status = current_status
+    details = status.get("model_details", [])
+    lines += _gauge_lines("ollama_up", "1 if the last poll reached Ollama",
+                          [({}, 1 if status.get("status") == "online" else 0)])
+    lines += _gauge_lines("ollama_models_loaded", "Models currently loaded", [({}, len(details))])
+    lines += _gauge_lines("ollama_model_vram_bytes", "VRAM used by a loaded model",
+                          [({"model": m["name"]}, m.get("size_vram", 0)) for m in details])
+    lines += _gauge_lines("ollama_model_size_bytes", "Total size of a loaded model",
+                          [({"model": m["name"]}, m.get("size", 0)) for m in details])
+    w = get_writer_stats()
+    lines += _gauge_lines("ollama_dashboard_history_queue_depth", "Entries waiting for the history writer",
+                          [({}, w["queue_depth"])])
+    lines += [f"# HELP ollama_dashboard_history_dropped_total History entries dropped on a full queue",
+              f"# TYPE ollama_dashboard_history_dropped_total counter",
+              f"ollama_dashboard_history_dropped_total {w['dropped']}"]
+    adm = admission.snapshot()
+    lines += _gauge_lines("ollama_proxy_active_requests", "Generations admitted and in flight", [({}, adm["active"])])
+    lines += _gauge_lines("ollama_proxy_queued_requests", "Generations waiting for admission", [({}, adm["waiting"])])
+    lines += ["# HELP ollama_proxy_rejected_total Generations rejected by admission control",
+              "# TYPE ollama_proxy_rejected_total counter",
+              f'ollama_proxy_rejected_total{{status="429"}} {adm["rejected_429"]}',
+              f'ollama_proxy_rejected_total{{status="503"}} {adm["rejected_503"]}']
+    co = coalescer.snapshot()
+    lines += ["# HELP ollama_proxy_coalesced_total Requests served from an identical in-flight request",
+              "# TYPE ollama_proxy_coalesced_total counter",
+              f"ollama_proxy_coalesced_total {co['followers']}"]
+    wu = warmup.snapshot()
+    if wu["enabled"]:
+        lines += ["# HELP ollama_warmup_loads_total Model loads by warm-up outcome",
+                  "# TYPE ollama_warmup_loads_total counter",
+                  f'ollama_warmup_loads_total{{result="hit"}} {wu["hits"]}',
+                  f'ollama_warmup_loads_total{{result="miss"}} {wu["misses"]}',
+                  f'ollama_warmup_loads_total{{result="wasted"}} {wu["wasted"]}']
+    poll = get_poll_stats()
+    lines += _gauge_lines("ollama_dashboard_poll_seconds", "Latest upstream poll latency",
+                          [({"endpoint": k}, round(v["last_ms"] / 1000, 4)) for k, v in poll.items()
+                           if isinstance(v, dict) and v["last_ms"] is not None])
+    return "\n".join(lines) + "\n"
+
+# ── Batched history writer ───────────────────────────────────────
+# Proxy workers only enqueue; a single background thread writes batches so
+# response latency never waits on disk. Bounded queue: when full, callers
+# wait up to LOG_ENQUEUE_TIMEOUT (backpressure) and the entry is then dropped.
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+LOG_BATCH_SIZE = int(os.environ.get('LOG_BATCH_SIZE', 200))
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', 1.0))
+LOG_ENQUEUE_TIMEOUT = float(os.environ.get('LOG_ENQUEUE_TIMEOUT', 0.05))
+
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+writer_stats = {"enqueued": 0, "written": 0, "dropped": 0, "batches": 0,
+                "errors": 0, "last_batch_size": 0, "last_flush_ms": 0}
+_writer_stats_lock = threading.Lock()
+_writer_thread = None
+_WRITER_STOP = object()
+
+def _count(key, n=1):
+    with _writer_stats_lock:
+        writer_stats[key] += n
+
+def enqueue_history(kind, entries):
+    """Hand entries to the writer thread. Returns the number dropped."""
+    try:
+        observe_entries(kind, entries)
+        if kind == "requests":
+            warmup.observe_requests(entries)
+    except Exception as e:
+        print(f"[METRICS] Failed to record {kind}: {e}")
+    dropped = 0
+    for entry in entries:
+        try:
+            log_queue.put((kind, entry), timeout=LOG_ENQUEUE_TIMEOUT)
+        except queue.Full:
+            dropped += 1
+    if dropped:
+        _count("dropped", dropped)
+        print(f"[HISTORY] Writer queue full — dropped {dropped} {kind} entries")
+    if len(entries) > dropped:
+        _count("enqueued", len(entries) - dropped)
+    return dropped
 
 def log_request(entry):
-    """Thread-safe append to request history"""
-    with history_lock:
-        history = load_history()
-        history["requests"].append(entry)
-        save_history(history)
+    """Queue a request entry for the background writer (non-blocking)."""
+    enqueue_history("requests", [entry])
+
+def _flush_batch(batch):
+    t0 = time.time()
+    by_kind = {}
+    for kind, entry in batch:
+        by_kind.setdefault(kind, []).append(entry)
+    written = {}
+    try:
+        with history_lock, db_transaction() as conn:
+            for kind, entries in by_kind.items():
+                if kind == "meta":
+                    # (key, value) bookkeeping that must commit with the entries, e.g. the log cursor
+                    conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", entries)
+                    continue
+                written[kind] = list(zip(_insert_entries(conn, kind, entries), entries))
+    except Exception as e:
+        _count("errors")
+        print(f"[HISTORY] Writer flush failed ({len(batch)} entries lost): {e}")
+        return
+    publish_new_entries(written)
+    with _writer_stats_lock:
+        writer_stats["written"] += len(batch)
+        writer_stats["batches"] += 1
+        writer_stats["last_batch_size"] = len(batch)
+        writer_stats["last_flush_ms"] = round((time.time() - t0) * 1000, 2)
+
+def history_writer_loop():
+    """Drain log_queue, flushing every LOG_BATCH_SIZE entries or LOG_FLUSH_INTERVAL seconds."""
+    batch = []
+    last_flush = time.monotonic()
+    while True:
+        wait = max(0.0, LOG_FLUSH_INTERVAL - (time.monotonic() - last_flush))
+        try:
+            item = log_queue.get(timeout=wait)
+        except queue.Empty:
+            item = None
+        if item is _WRITER_STOP:
+            # Drain anything that raced in behind the sentinel, then exit
+            while True:
+                try:
+                    extra = log_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if extra is not _WRITER_STOP:
+                    batch.append(extra)
+            if batch:
+                _flush_batch(batch)
+            return
+        if item is not None:
+            batch.append(item)
+        due = time.monotonic() - last_flush >= LOG_FLUSH_INTERVAL
+        if len(batch) >= LOG_BATCH_SIZE or (batch and due):
+            _flush_batch(batch)
+            batch = []
+            last_flush = time.monotonic()
+        elif not batch:
+            last_flush = time.monotonic()
+
+def start_history_writer():
+    global _writer_thread
+    _writer_thread = threading.Thread(target=history_writer_loop, name="history-writer", daemon=True)
+    _writer_thread.start()
+
+def stop_history_writer(timeout=10):
+    """Flush everything still queued. Registered with atexit."""
+    if _writer_thread is None or not _writer_thread.is_alive():
+        return
+    log_queue.put(_WRITER_STOP)
+    _writer_thread.join(timeout)
+    print(f"[HISTORY] Writer stopped — {writer_stats['written']} written, "
+          f"{writer_stats['dropped']} dropped")
+
+def get_writer_stats():
+    with _writer_stats_lock:
+        stats = dict(writer_stats)
+    stats["queue_depth"] = log_queue.qsize()
+    stats["queue_size"] = LOG_QUEUE_SIZE
+    return stats
 
 # ── Request tracking from Docker logs (GIN lines only) ───────────
-last_log_ts = time.time()
+# A single follower thread holds one Docker client and tails the Ollama
+# container's log stream. Each line carries a Docker timestamp; the newest one
+# seen is the cursor, persisted in the meta table through the writer queue (so
+# it commits in the same transaction as the entries it covers). On restart or
+# reconnect the stream resumes from the cursor, and lines at or before it are
+# skipped, so nothing is read twice and nothing falls between poll windows.
+DOCKER_LOG_CURSOR_KEY = 'docker_log_cursor'
+DOCKER_LOG_CURSOR_INTERVAL = 1.0   # seconds between cursor saves
+DOCKER_LOG_RECONNECT_MAX = 30      # backoff cap in seconds
+
+log_follower_stats = {"connected": False, "lines": 0, "entries": 0, "reconnects": 0,
+                      "cursor": None, "last_error": None}
 
 def entry_hash(entry):
     """Create unique hash for a log entry to prevent duplicates"""
-    key = f"{entry.get('time','')}|{entry.get('path','')}|{entry.get('client_ip','')}|{entry.get('duration','')}"
+    key = f"{entry.get('time','')}|{entry.get('path','')}|{entry.get('client_ip','')}|{entry.get('duration_ms','')}"
     return hashlib.md5(key.encode()).hexdigest()[:16]
 
-def parse_duration(dur_str):
-    """Parse GIN duration string to milliseconds"""
-    dur_str = dur_str.strip()
-    try:
-        if '\u00b5s' in dur_str:
-            return float(dur_str.replace('\u00b5s', '').strip()) / 1000
-        elif 'ms' in dur_str:
-            return float(dur_str.replace('ms', '').strip())
-        elif 's' in dur_str:
-            parts = dur_str.replace('s', '').strip()
-            if 'm' in parts:
-                mp = parts.split('m')
-                return (float(mp[0]) * 60 + float(mp[1])) * 1000
-            else:
-                return float(parts) * 1000
+class DedupIndex:
+    """Fixed-capacity, insertion-ordered set of entry hashes.
+
+    Evicts the oldest hash once full, so lookups and inserts stay O(1) and
+    memory stays bounded no matter how long the service runs.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        """Record key; False if it was already present."""
+        with self._lock:
+            if key in self._keys:
+                return False
+            self._keys[key] = None
+            if len(self._keys) > self.capacity:
+                self._keys.popitem(last=False)
+            return True
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+# Track seen log entries to prevent duplicates (only direct/GIN entries can repeat)
+MAX_SEEN = int(os.environ.get('LOG_DEDUP_SIZE', 5000))
+seen_entries = DedupIndex(MAX_SEEN)
+
+def seed_seen_entries():
+    """Pre-load the newest direct entries from the store so a restart doesn't re-log them."""
+    rows = get_db().execute(
+        f"SELECT requests.id, {REQUEST_SELECT} WHERE source_id = (SELECT id FROM strings WHERE value = 'direct') "
+        "ORDER BY requests.id DESC LIMIT ?",
+        (MAX_SEEN,)
+    ).fetchall()
+    for r in reversed(rows):
+        seen_entries.add(entry_hash(decode_entry("requests", r[1:])))
+    print(f"[DASHBOARD] Loaded {len(seen_entries)} existing entry hashes for dedup")
+
+def parse_gin_line(line):
+    """Build a "direct" request entry from one GIN log line, or None if it isn't one we track."""
+    entry = gin_parser.parse_line(line, skip_ip=proxy_self_ip)
+    if entry is None:
+        return None
+    entry.update({
+        "model": active_model,
+        "tokens": 0,
+        "prompt_tokens": 0,
+        "total_tokens": 0,
+        "source": "direct",
+    })
+    return entry
+
+def load_log_cursor():
+    try:
+        row = get_db().execute("SELECT value FROM meta WHERE key = ?", (DOCKER_LOG_CURSOR_KEY,)).fetchone()
+        return int(row[0]) if row else None
     except:
-        pass
-    return 0
+        return None
 
-def parse_docker_logs():
-    """Parse GIN request lines from Docker logs for direct-to-Ollama traffic."""
-    global last_log_ts, seen_entries
+def _iter_log_lines(stream, sep=b'\n'):
+    """Re-split docker's multiplexed frames (or any bytes/str chunks) into complete lines."""
+    partial = []  # pieces of a line longer than one chunk, joined once it ends
+    for chunk in stream:
+        *lines, tail = chunk.split(sep)
+        if lines:
+            lines[0] = chunk[:0].join(partial) + lines[0]
+            partial = []
+            for line in lines:
+                yield line if isinstance(line, str) else line.decode('utf-8', errors='replace')
+        if tail:
+            partial.append(tail)
+    if partial:
+        line = partial[0][:0].join(partial)
+        yield line if isinstance(line, str) else line.decode('utf-8', errors='replace')
+
+def follow_docker_logs():
+    """Tail the Ollama container's logs forever, reconnecting with backoff."""
     try:
         import docker
-        client = docker.from_env()
-        container = client.containers.get(OLLAMA_CONTAINER)
-        since = int(last_log_ts - 2)
-        last_log_ts = time.time()
-        logs = container.logs(since=since, timestamps=False).decode('utf-8', errors='replace')
+    except ImportError:
+        print("[LOGS] docker package not installed — direct-to-Ollama requests will not be tracked")
+        return
 
-        lines = logs.split('\n')
-        found = []
+    cursor = load_log_cursor()
+    if cursor is None:
+        # First run: only pick up traffic from now on, like the old poll window did
+        cursor = time.time_ns()
+    log_follower_stats["cursor"] = cursor
+    client = None
+    backoff = 1
 
-        for line in lines:
-            gin = re.search(
-                r'\[GIN\]\s+(\d{4}/\d{2}/\d{2}\s+-\s+\d{2}:\d{2}:\d{2})\s+\|\s+(\d+)\s+\|\s+(.+?)\s+\|\s+(.+?)\s+\|\s+(\w+)\s+"(.+?)"',
-                line
+    while True:
+        try:
+            if client is None:
+                client = docker.from_env()
+            container = client.containers.get(OLLAMA_CONTAINER)
+            stream = container.logs(stream=True, follow=True, timestamps=True,
+                                    since=cursor / 1_000_000_000)
+            log_follower_stats["connected"] = True
+            print(f"[LOGS] Following {OLLAMA_CONTAINER} logs from "
+                  f"{datetime.fromtimestamp(cursor / 1_000_000_000).isoformat()}")
+            backoff = 1
+            saved_at = time.monotonic()
+            saved_cursor = cursor
+            try:
+                for line in _iter_log_lines(stream):
+                    ts, _, text = line.partition(' ')
+                    try:
+                        line_ns = gin_parser.parse_docker_ts(ts)
+                    except ValueError:
+                        continue
+                    # `since` has coarse resolution; drop everything already covered by the cursor
+                    if line_ns <= cursor:
+                        continue
+                    cursor = line_ns
+                    log_follower_stats["lines"] += 1
+                    log_follower_stats["cursor"] = cursor
+
+                    entry = parse_gin_line(text)
+                    if entry:
+                        # Container restarts can replay lines with new timestamps
+                        if seen_entries.add(entry_hash(entry)):
+                            enqueue_history("requests", [entry])
+                            log_follower_stats["entries"] += 1
+
+                    if time.monotonic() - saved_at >= DOCKER_LOG_CURSOR_INTERVAL:
+                        enqueue_history("meta", [(DOCKER_LOG_CURSOR_KEY, str(cursor))])
+                        saved_at = time.monotonic()
+                        saved_cursor = cursor
+            finally:
+                stream.close()
+                if cursor != saved_cursor:
+                    enqueue_history("meta", [(DOCKER_LOG_CURSOR_KEY, str(cursor))])
+            # Stream ended: the container stopped or is being recreated
+            log_follower_stats["last_error"] = "log stream ended"
+        except Exception as e:
+            log_follower_stats["last_error"] = str(e)
+            if not isinstance(e, docker.errors.NotFound):
+                # Connection-level problem — rebuild the client on the next attempt
+                client = None
+        log_follower_stats["connected"] = False
+        log_follower_stats["reconnects"] += 1
+        time.sleep(backoff)
+        backoff = min(backoff * 2, DOCKER_LOG_RECONNECT_MAX)
+
+def start_log_follower():
+    threading.Thread(target=follow_docker_logs, name="docker-log-follower", daemon=True).start()
+
+# ── Upstream connection pool ─────────────────────────────────────
+# One keep-alive Session shared by the proxy, poller and benchmarks.
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 32))
+UPSTREAM_POOL_BLOCK = os.environ.get('UPSTREAM_POOL_BLOCK', 'false').lower() in ('1', 'true', 'yes')
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 3.05))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 600))
+
+pool_stats = {"checkouts": 0, "in_use": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0}
+_pool_stats_lock = threading.Lock()
+_upstream_pools = weakref.WeakSet()
+
+class _MeteredPoolMixin:
+    """Counts checkouts, in-use connections and time spent waiting for one."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        _upstream_pools.add(self)
+
+    def _get_conn(self, timeout=None):
+        t0 = time.perf_counter()
+        conn = super()._get_conn(timeout)
+        waited = (time.perf_counter() - t0) * 1000
+        with _pool_stats_lock:
+            pool_stats["checkouts"] += 1
+            pool_stats["in_use"] += 1
+            pool_stats["wait_ms_total"] += waited
+            pool_stats["wait_ms_max"] = max(pool_stats["wait_ms_max"], waited)
+        return conn
+
+    def _put_conn(self, conn):
+        with _pool_stats_lock:
+            pool_stats["in_use"] = max(0, pool_stats["in_use"] - 1)
+        return super()._put_conn(conn)
+
+class _MeteredHTTPConnectionPool(_MeteredPoolMixin, urllib3.HTTPConnectionPool):
+    pass
+
+class _MeteredHTTPSConnectionPool(_MeteredPoolMixin, urllib3.HTTPSConnectionPool):
+    pass
+
+class _MeteredAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _MeteredHTTPConnectionPool,
+            "https": _MeteredHTTPSConnectionPool,
+        }
+
+def _make_upstream_session():
+    sess = requests.Session()
+    adapter = _MeteredAdapter(pool_connections=max(4, len(OLLAMA_URLS)), pool_maxsize=UPSTREAM_POOL_SIZE,
+                              pool_block=UPSTREAM_POOL_BLOCK, max_retries=0)
+    sess.mount('http://', adapter)
+    sess.mount('https://', adapter)
+    # Transparent proxy: never carry one client's cookies into another's request
+    sess.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    return sess
+
+upstream = _make_upstream_session()
+
+def upstream_timeout(read):
+    return (UPSTREAM_CONNECT_TIMEOUT, read)
+
+def get_pool_stats():
+    with _pool_stats_lock:
+        stats = dict(pool_stats)
+    pools = list(_upstream_pools)
+    opened = sum(p.num_connections for p in pools)
+    served = sum(p.num_requests for p in pools)
+    stats["wait_ms_total"] = round(stats["wait_ms_total"], 2)
+    stats["wait_ms_max"] = round(stats["wait_ms_max"], 2)
+    stats["wait_ms_avg"] = round(stats["wait_ms_total"] / stats["checkouts"], 3) if stats["checkouts"] else 0
+    stats["connections_opened"] = opened
+    stats["requests"] = served
+    stats["reused"] = max(0, served - opened)
+    stats["pool_size"] = UPSTREAM_POOL_SIZE
+    return stats
+
+# ── Upstream backends ────────────────────────────────────────────
+# Every Ollama instance in OLLAMA_URLS. Requests naming a model go to a
+# backend whose /api/tags lists it (any live backend if none does), preferring
+# one whose last /api/ps showed it loaded, then the one with the fewest
+# requests in flight; requests without a model go to the first live backend.
+# A backend that refuses connections is skipped for BACKEND_RETRY_AFTER
+# seconds (the request fails over to the next one) or until the poller
+# reaches it again.
+BACKEND_RETRY_AFTER = float(os.environ.get('BACKEND_RETRY_AFTER', 30))
+
+class Backend:
+    def __init__(self, url):
+        self.url = url
+        self.name = urllib.parse.urlsplit(url).netloc or url
+        self.online = None          # last poll result (None = not polled yet)
+        self.down_until = 0.0       # skipped by the proxy until then
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.loaded = set()         # model names from the last /api/ps
+        self.installed = set()      # model names from the last /api/tags
+        self.last_error = None
+        self.ps_ms = None
+        self.poll = {"ps": {"models": []}, "tags": {"models": []}, "tags_sig": None, "tags_next": 0.0,
+                     "tags_interval": POLL_TAGS_INTERVAL, "version": "unknown", "version_next": 0.0}
+
+    def available(self):
+        return time.monotonic() >= self.down_until
+
+    def snapshot(self):
+        return {
+            "name": self.name, "url": self.url, "online": bool(self.online),
+            "available": self.available(), "outstanding": self.outstanding,
+            "requests": self.requests, "errors": self.errors,
+            "loaded": sorted(self.loaded), "version": self.poll["version"],
+            "ps_ms": self.ps_ms, "last_error": self.last_error,
+        }
+
+backends = [Backend(u) for u in OLLAMA_URLS]
+_backends_lock = threading.Lock()
+
+def _model_key(name):
+    return name if ':' in name else f"{name}:latest"
+
+def pick_backend(model=None, exclude=()):
+    """Reserve a backend for one request (release with release_backend), or None if all were tried."""
+    with _backends_lock:
+        pool = [b for b in backends if b not in exclude]
+        if not pool:
+            return None
+        live = [b for b in pool if b.available()] or pool
+        if model:
+            key = _model_key(model)
+            having = [b for b in live if key in b.installed or key in b.loaded] or live
+            warm = [b for b in having if key in b.loaded]
+            chosen = min(warm or having, key=lambda b: (b.outstanding, b.requests))
+        else:
+            chosen = live[0]
+        chosen.outstanding += 1
+        chosen.requests += 1
+        return chosen
+
+def release_backend(backend, error=None):
+    """End a request on backend; a connection error takes it out of rotation for a while."""
+    with _backends_lock:
+        backend.outstanding = max(0, backend.outstanding - 1)
+        if error is not None:
+            backend.errors += 1
+            backend.last_error = str(error)
+            backend.down_until = time.monotonic() + BACKEND_RETRY_AFTER
+    if error is not None:
+        print(f"[PROXY] Backend {backend.name} unreachable, failing over: {error}")
+
+def forward_to_backend(method, path, headers, body, model=None):
+    """Send a proxied request, failing over to the next backend on connection errors.
+    Returns (backend, streamed response); the caller must release_backend(backend)."""
+    tried = []
+    while True:
+        backend = pick_backend(model, exclude=tried)
+        if backend is None:
+            raise last_error
+        tried.append(backend)
+        try:
+            return backend, upstream.request(
+                method=method,
+                url=f"{backend.url}/{path}",
+                headers=headers,
+                data=body,
+                stream=True,
+                timeout=upstream_timeout(UPSTREAM_READ_TIMEOUT)
             )
-            if not gin:
-                continue
+        except requests.exceptions.ConnectionError as e:
+            release_backend(backend, error=e)
+            last_error = e
+        except Exception:
+            release_backend(backend)
+            raise
 
-            ts, status, duration, client_ip, method, path = gin.groups()
+def get_backends_status():
+    with _backends_lock:
+        return [b.snapshot() for b in backends]
 
-            # Skip polling/status endpoints
-            if path.strip() in ['/', '/api/tags', '/api/ps', '/api/version', '/api/show']:
-                continue
+# ── Admission control ────────────────────────────────────────────
+# Chat/generate requests pass through a scheduler before reaching a backend:
+# at most ADMISSION_MAX_CONCURRENT in flight overall and
+# ADMISSION_MAX_PER_CLIENT per client IP, the rest wait in per-client queues.
+# Queues are served in weighted fair order (start-time fair queueing; the
+# weight comes from the client's CLIENT_MAP entry, default 1), so a client
+# flooding the proxy only delays itself. A full client queue answers 429, a
+# full global queue or a wait longer than ADMISSION_QUEUE_TIMEOUT answers 503,
+# both with Retry-After. Both limits default to 0 (off).
+ADMISSION_MAX_CONCURRENT = int(os.environ.get('ADMISSION_MAX_CONCURRENT', 0))
+ADMISSION_MAX_PER_CLIENT = int(os.environ.get('ADMISSION_MAX_PER_CLIENT', 0))
+ADMISSION_QUEUE_SIZE = int(os.environ.get('ADMISSION_QUEUE_SIZE', 100))
+ADMISSION_CLIENT_QUEUE_SIZE = int(os.environ.get('ADMISSION_CLIENT_QUEUE_SIZE', 20))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 60))
 
-            # Skip requests that came from the proxy (we already logged those with full data)
-            if proxy_self_ip and client_ip.strip() == proxy_self_ip:
-                continue
+class AdmissionRejected(Exception):
+    def __init__(self, status, reason, retry_after):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+class AdmissionTicket:
+    __slots__ = ("client", "tag", "enqueued", "granted_at", "event", "loop", "future")
+
+    def __init__(self, client, tag):
+        self.client = client
+        self.tag = tag
+        self.enqueued = time.monotonic()
+        self.granted_at = None
+        self.event = threading.Event()
+        self.loop = None
+        self.future = None
+
+    @property
+    def queue_ms(self):
+        return round(((self.granted_at or time.monotonic()) - self.enqueued) * 1000, 1)
+
+class AdmissionScheduler:
+    def __init__(self, max_concurrent, max_per_client, queue_size, client_queue_size, timeout):
+        self.max_concurrent = max_concurrent
+        self.max_per_client = max_per_client
+        self.queue_size = queue_size
+        self.client_queue_size = client_queue_size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._queues = {}      # client → deque of waiting tickets
+        self._active = {}      # client → requests in flight
+        self._last_tag = {}    # client → virtual finish tag of its newest ticket
+        self._vtime = 0.0
+        self._waiting = 0
+        self._service_s = 5.0  # EWMA of how long an admitted request holds its slot
+        self.stats = {"admitted": 0, "queued": 0, "rejected_429": 0, "rejected_503": 0,
+                      "timeouts": 0, "queue_ms_max": 0.0, "queue_ms_total": 0.0}
+
+    @property
+    def enabled(self):
+        return self.max_concurrent > 0 or self.max_per_client > 0
 
-            dur_str = duration.strip()
-            dur_ms = parse_duration(dur_str)
+    def _can_run(self, client):
+        total = sum(self._active.values())
+        if self.max_concurrent and total >= self.max_concurrent:
+            return False
+        return not (self.max_per_client and self._active.get(client, 0) >= self.max_per_client)
 
+    def _retry_after(self):
+        slots = self.max_concurrent or max(1, len(self._active)) * (self.max_per_client or 1)
+        return max(1, min(60, int(self._service_s * (self._waiting + 1) / slots) + 1))
+
+    def _grant(self, ticket):
+        ticket.granted_at = time.monotonic()
+        self._active[ticket.client] = self._active.get(ticket.client, 0) + 1
+        self._vtime = max(self._vtime, ticket.tag)
+        waited = (ticket.granted_at - ticket.enqueued) * 1000
+        self.stats["admitted"] += 1
+        self.stats["queue_ms_total"] += waited
+        self.stats["queue_ms_max"] = round(max(self.stats["queue_ms_max"], waited), 1)
+        ticket.event.set()
+        if ticket.future is not None:
+            ticket.loop.call_soon_threadsafe(_resolve_future, ticket.future)
+
+    def _dispatch(self):
+        """Admit waiting heads in tag order while slots are free. Caller holds the lock."""
+        while self._waiting:
+            heads = [q[0] for c, q in self._queues.items() if q and self._can_run(c)]
+            if not heads:
+                return
+            ticket = min(heads, key=lambda t: t.tag)
+            self._queues[ticket.client].popleft()
+            self._waiting -= 1
+            self._grant(ticket)
+
+    def submit(self, client, weight=1.0, loop=None):
+        """Queue a request; the returned ticket may already be granted. Raises AdmissionRejected."""
+        with self._lock:
+            q = self._queues.setdefault(client, deque())
+            if q and self.client_queue_size and len(q) >= self.client_queue_size:
+                self.stats["rejected_429"] += 1
+                raise AdmissionRejected(429, "too many queued requests from this client", self._retry_after())
+            if not q and self._can_run(client):
+                ticket = AdmissionTicket(client, self._vtime)
+                self._grant(ticket)
+                return ticket
+            if self.queue_size and self._waiting >= self.queue_size:
+                self.stats["rejected_503"] += 1
+                raise AdmissionRejected(503, "proxy queue is full", self._retry_after())
+            tag = max(self._vtime, self._last_tag.get(client, 0.0)) + 1.0 / max(weight, 0.01)
+            self._last_tag[client] = tag
+            ticket = AdmissionTicket(client, tag)
+            if loop is not None:
+                ticket.loop, ticket.future = loop, loop.create_future()
+            q.append(ticket)
+            self._waiting += 1
+            self.stats["queued"] += 1
+            return ticket
+
+    def _abandon(self, ticket):
+        """Drop a ticket that gave up waiting. False if it was granted meanwhile."""
+        with self._lock:
+            if ticket.granted_at is not None:
+                return False
             try:
-                dt = datetime.strptime(ts.strip(), "%Y/%m/%d - %H:%M:%S")
-                iso_time = dt.isoformat()
-            except:
-                iso_time = ts.strip()
-
-            entry = {
-                "time": iso_time,
-                "time_display": ts.strip(),
-                "status": int(status.strip()),
-                "duration": dur_str,
-                "duration_ms": round(dur_ms, 1),
-                "client_ip": client_ip.strip(),
-                "method": method.strip(),
-                "path": path.strip(),
-                "model": active_model,
-                "tokens": 0,
-                "prompt_tokens": 0,
-                "total_tokens": 0,
-                "source": "direct",
-            }
+                self._queues[ticket.client].remove(ticket)
+                self._waiting -= 1
+            except (KeyError, ValueError):
+                pass
+            self.stats["timeouts"] += 1
+            return True
 
-            # Dedup check
-            h = entry_hash(entry)
-            if h not in seen_entries:
-                seen_entries.add(h)
-                found.append(entry)
-                if len(seen_entries) > MAX_SEEN:
-                    seen_entries = set(list(seen_entries)[-3000:])
+    def _timeout_error(self):
+        with self._lock:
+            self.stats["rejected_503"] += 1
+            return AdmissionRejected(503, "timed out waiting in the proxy queue", self._retry_after())
 
-        return found
-    except Exception as e:
-        return []
+    def acquire(self, client, weight=1.0):
+        """Blocking admission for the threaded proxy."""
+        ticket = self.submit(client, weight)
+        if not ticket.event.wait(self.timeout) and self._abandon(ticket):
+            raise self._timeout_error()
+        return ticket
 
-# ── Ollama API helpers ───────────────────────────────────────────
-def get_ollama_version():
+    async def acquire_async(self, client, weight=1.0):
+        """Admission for the async proxy; waits without holding a thread."""
+        ticket = self.submit(client, weight, loop=asyncio.get_running_loop())
+        if ticket.future is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(ticket.future), self.timeout)
+            except asyncio.TimeoutError:
+                if self._abandon(ticket):
+                    raise self._timeout_error()
+            except BaseException:
+                # Client went away while queued
+                if not self._abandon(ticket):
+                    self.release(ticket)
+                raise
+        return ticket
+
+    def release(self, ticket):
+        if ticket is None:
+            return
+        with self._lock:
+            held = time.monotonic() - ticket.granted_at
+            self._service_s = self._service_s * 0.9 + held * 0.1
+            n = self._active.get(ticket.client, 0) - 1
+            if n > 0:
+                self._active[ticket.client] = n
+            else:
+                self._active.pop(ticket.client, None)
+                if not self._queues.get(ticket.client):
+                    # Forget idle clients so the maps stay bounded
+                    self._queues.pop(ticket.client, None)
+                    self._last_tag.pop(ticket.client, None)
+            self._dispatch()
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            total_ms = stats.pop("queue_ms_total")
+            stats.update(
+                enabled=self.enabled,
+                active=sum(self._active.values()),
+                waiting=self._waiting,
+                max_concurrent=self.max_concurrent,
+                max_per_client=self.max_per_client,
+                queue_ms_avg=round(total_ms / stats["admitted"], 1) if stats["admitted"] else 0,
+                clients={c: {"active": self._active.get(c, 0), "waiting": len(self._queues.get(c, ()))}
+                         for c in set(self._active) | {c for c, q in self._queues.items() if q}},
+            )
+            return stats
+
+def _resolve_future(fut):
+    if not fut.done():
+        fut.set_result(True)
+
+admission = AdmissionScheduler(ADMISSION_MAX_CONCURRENT, ADMISSION_MAX_PER_CLIENT, ADMISSION_QUEUE_SIZE,
+                               ADMISSION_CLIENT_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT)
+
+def client_weight(client_ip):
+    mapped = get_client_map().get(client_ip)
     try:
-        resp = requests.get(f"{OLLAMA_URL}/api/version", timeout=3)
-        if resp.ok:
-            return resp.json().get("version", "unknown")
-    except:
-        pass
-    return "unknown"
+        return float(mapped.get("weight", 1)) if isinstance(mapped, dict) else 1.0
+    except (TypeError, ValueError):
+        return 1.0
 
+# ── Ollama API helpers ───────────────────────────────────────────
 def get_model_details(ps_data):
     models = []
     for m in ps_data.get("models", []):
@@ -250,174 +2312,732 @@ def _fmt_bytes(b):
         b /= 1024
     return f"{b:.1f} TB"
 
-def _fmt_duration(ms):
-    if ms < 1000:
-        return f"{ms:.0f}ms"
-    s = ms / 1000
-    if s < 60:
-        return f"{int(round(s))}s"
-    m = int(s // 60)
-    s = int(round(s % 60))
-    return f"{m}m{s}s"
+def _fmt_duration(ms):
+    if ms < 1000:
+        return f"{ms:.0f}ms"
+    s = ms / 1000
+    if s < 60:
+        return f"{int(round(s))}s"
+    m = int(s // 60)
+    s = int(round(s % 60))
+    return f"{m}m{s}s"
+
+# ══════════════════════════════════════════════════════════════════
+#  OLLAMA API PROXY — runs on port 11434
+#  Forwards all requests to Ollama, captures token stats
+# ══════════════════════════════════════════════════════════════════
+
+class NDJSONStreamStats:
+    """Incremental parser for an Ollama NDJSON stream.
+
+    Holds only the current partial line, keeps the final `done` frame and
+    running token timing (TTFT, inter-token gaps) — constant memory per stream.
+    """
+
+    def __init__(self, start_ts):
+        self.start_ts = start_ts
+        self.final = None
+        self.frames = 0
+        self.first_frame_ts = None
+        self.last_frame_ts = None
+        self.gap_sum = 0.0
+        self.gap_max = 0.0
+        self._partial = []
+
+    def feed(self, chunk):
+        now = time.time()
+        self._partial.append(chunk)
+        if b'\n' not in chunk:
+            return
+        lines = b''.join(self._partial).split(b'\n')
+        tail = lines.pop()
+        self._partial = [tail] if tail else []
+        for line in lines:
+            self._line(line, now)
+
+    def close(self):
+        if self._partial:
+            self._line(b''.join(self._partial), time.time())
+            self._partial = []
+
+    def _line(self, line, now):
+        if not line.strip():
+            return
+        # Only the done frame needs decoding; token frames are just timed
+        if b'"done":true' in line or b'"done": true' in line:
+            try:
+                self.final = json.loads(line)
+            except:
+                pass
+            return
+        if self.first_frame_ts is None:
+            self.first_frame_ts = now
+        else:
+            gap = now - self.last_frame_ts
+            self.gap_sum += gap
+            if gap > self.gap_max:
+                self.gap_max = gap
+        self.last_frame_ts = now
+        self.frames += 1
+
+    def timing(self):
+        if self.first_frame_ts is None:
+            return {}
+        timing = {"ttft_ms": round((self.first_frame_ts - self.start_ts) * 1000, 1)}
+        if self.frames > 1:
+            timing["inter_token_ms"] = round(self.gap_sum / (self.frames - 1) * 1000, 2)
+            timing["inter_token_max_ms"] = round(self.gap_max * 1000, 2)
+        return timing
+
+PROXY_SKIP_HEADERS = {'host', 'transfer-encoding', 'connection'}
+
+def classify_proxy_request(path, body):
+    """(is_trackable, body_json, is_streaming) for a proxied request."""
+    is_trackable = path in ('api/chat', 'api/generate')
+    body_json = None
+    is_streaming = True  # Ollama defaults to streaming
+    if body and is_trackable:
+        try:
+            body_json = json.loads(body)
+            is_streaming = body_json.get('stream', True)
+        except:
+            pass
+    return is_trackable, body_json, is_streaming
+
+# Inference endpoints whose body names the model, used to pick a backend that has it
+MODEL_ROUTED_PATHS = ('api/chat', 'api/generate', 'api/embed', 'api/embeddings',
+                      'v1/chat/completions', 'v1/completions', 'v1/embeddings')
+
+def request_model(path, body, body_json=None):
+    """Model named by an inference request (body_json: the body if already parsed), or None."""
+    if path not in MODEL_ROUTED_PATHS:
+        return None
+    if body_json is None:
+        try:
+            body_json = json.loads(body)
+        except Exception:
+            return None
+    model = body_json.get('model') if isinstance(body_json, dict) else None
+    return model if isinstance(model, str) and model else None
+
+def build_proxy_entry(data, body_json, status, start_ts, client_ip, method, req_path, timing=None,
+                      backend=None, queue_ms=None, coalesced=None, cancelled=False):
+    """History entry for a proxied chat/generate call from Ollama's final stats frame."""
+    elapsed_ms = (time.time() - start_ts) * 1000
+    data = data if isinstance(data, dict) else {}
+    model_name = body_json.get('model', '—') if body_json else '—'
+    eval_tokens = data.get('eval_count', 0)
+    prompt_tokens = data.get('prompt_eval_count', 0)
+    eval_dur = data.get('eval_duration', 0)
+    prompt_dur = data.get('prompt_eval_duration', 0)
+    tok_per_sec = 0
+    prompt_tok_per_sec = 0
+    if eval_dur > 0:
+        tok_per_sec = round(eval_tokens / max(eval_dur / 1e9, 0.001), 2)
+    if prompt_dur > 0:
+        prompt_tok_per_sec = round(prompt_tokens / max(prompt_dur / 1e9, 0.001), 2)
+
+    entry = {
+        "time": datetime.now().isoformat(),
+        "time_display": datetime.now().strftime("%Y/%m/%d - %H:%M:%S"),
+        "status": status,
+        "duration": _fmt_duration(elapsed_ms),
+        "duration_ms": round(elapsed_ms, 1),
+        "client_ip": client_ip,
+        "method": method,
+        "path": req_path,
+        "model": data.get('model', model_name),
+        "tokens": eval_tokens,
+        "prompt_tokens": prompt_tokens,
+        "total_tokens": eval_tokens + prompt_tokens,
+        "tokens_per_sec": tok_per_sec,
+        "prompt_tok_per_sec": prompt_tok_per_sec,
+        "done_reason": data.get('done_reason', ''),
+        "source": "proxy",
+    }
+    if timing:
+        entry.update(timing)
+    if backend and len(backends) > 1:
+        entry["backend"] = backend
+    if queue_ms is not None:
+        entry["queue_ms"] = queue_ms
+    if coalesced is not None:
+        entry["coalesced"] = coalesced
+    if cancelled:
+        # The client hung up and the upstream call was abandoned; token stats are partial or missing
+        entry["cancelled"] = True
+    return entry
+
+# ── Response cache ───────────────────────────────────────────────
+# Opt-in (RESPONSE_CACHE_MB > 0). Identical requests are answered from memory
+# instead of reaching the GPU: embeddings always, chat/generate only when
+# sampling is deterministic (temperature 0 or a fixed seed). The key is a hash
+# of the path and the request body minus keep_alive. Entries expire after
+# RESPONSE_CACHE_TTL seconds and the least recently used are evicted to stay
+# under the size budget. Cached streams are replayed line by line as NDJSON.
+# Hits are logged with source "cache", so their tokens count as saved.
+RESPONSE_CACHE_MB = float(os.environ.get('RESPONSE_CACHE_MB', 0))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 3600))
+CACHE_GENERATION_PATHS = ('api/chat', 'api/generate')
+CACHE_EMBEDDING_PATHS = ('api/embed', 'api/embeddings')
+# Fields of Ollama's final frame worth keeping for the history entry of a hit
+_CACHE_FINAL_KEYS = ('model', 'eval_count', 'prompt_eval_count', 'eval_duration',
+                     'prompt_eval_duration', 'done_reason')
+
+def request_fingerprint(path, body):
+    """(key, parsed body) when the response is fully determined by the request, else (None, None).
+
+    Shared by the response cache and request coalescing."""
+    if path not in CACHE_GENERATION_PATHS + CACHE_EMBEDDING_PATHS:
+        return None, None
+    try:
+        req = json.loads(body)
+    except Exception:
+        return None, None
+    if not isinstance(req, dict):
+        return None, None
+    normalized = {k: v for k, v in req.items() if k != 'keep_alive'}
+    if path in CACHE_GENERATION_PATHS:
+        options = req.get('options') or {}
+        if not isinstance(options, dict):
+            # Malformed; let Ollama answer it rather than caching or coalescing it
+            return None, None
+        if options.get('temperature') != 0 and options.get('seed') is None:
+            return None, None
+        normalized['stream'] = bool(req.get('stream', True))
+    raw = json.dumps([path, normalized], sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(raw.encode()).hexdigest(), req
+
+CachedResponse = namedtuple('CachedResponse', 'body content_type final streamed expires')
+
+class ResponseCache:
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = int(max_bytes)
+        self.max_item_bytes = self.max_bytes // 4
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0}
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item.expires < time.monotonic():
+                self._drop(key)
+                self.stats["expired"] += 1
+                item = None
+            if item is None:
+                self.stats["misses"] += 1
+                return None
+            self._items.move_to_end(key)
+            self.stats["hits"] += 1
+            return item
+
+    def put(self, key, body, content_type, final, streamed):
+        if len(body) > self.max_item_bytes:
+            return
+        final = {k: final[k] for k in _CACHE_FINAL_KEYS if isinstance(final, dict) and k in final}
+        with self._lock:
+            if key in self._items:
+                self._drop(key)
+            self._items[key] = CachedResponse(body, content_type, final, streamed,
+                                              time.monotonic() + self.ttl)
+            self._bytes += len(body)
+            self.stats["stores"] += 1
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._items)))
+                self.stats["evictions"] += 1
+
+    def _drop(self, key):
+        self._bytes -= len(self._items.pop(key).body)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, enabled=self.enabled, entries=len(self._items),
+                        bytes=self._bytes, max_bytes=self.max_bytes, ttl_s=self.ttl)
+
+response_cache = ResponseCache(RESPONSE_CACHE_MB * 1024 * 1024, RESPONSE_CACHE_TTL)
+
+def iter_ndjson_lines(body):
+    """Replay a cached NDJSON stream one frame at a time."""
+    for line in body.splitlines(keepends=True):
+        if line.strip():
+            yield line
+
+def cache_hit_entry(item, req, start_ts, client_ip, method, req_path):
+    """History entry for a request answered from the cache; its tokens were not regenerated."""
+    entry = build_proxy_entry(item.final, req, 200, start_ts, client_ip, method, req_path)
+    entry.update(source="cache", tokens_per_sec=0, prompt_tok_per_sec=0)
+    return entry
+
+class CacheCapture:
+    """Collects a response body for the cache, giving up once it outgrows an entry."""
+    def __init__(self, key, status):
+        self.key = key if status == 200 else None
+        self.parts = []
+        self.size = 0
+
+    def feed(self, chunk):
+        if self.key is None:
+            return
+        self.size += len(chunk)
+        if self.size > response_cache.max_item_bytes:
+            self.key, self.parts = None, []
+        else:
+            self.parts.append(chunk)
+
+    def store(self, content_type, final=None, streamed=False):
+        if self.key is None:
+            return
+        body = b''.join(self.parts)
+        if final is None:
+            try:
+                final = json.loads(body)
+            except Exception:
+                return
+        response_cache.put(self.key, body, content_type, final, streamed)
+
+# ── Request coalescing ───────────────────────────────────────────
+# Identical deterministic requests (same fingerprint as the response cache)
+# that arrive while one is already upstream share that single call: the first
+# becomes the leader of a Flight, later ones subscribe and get the response
+# chunks fanned out as they arrive. The upstream read runs in its own pump
+# (a thread, or a task in async mode) so a leader hanging up does not cut off
+# its followers, but once every subscriber has gone the upstream call is
+# closed. The first COALESCE_REPLAY_BYTES are kept so late followers can
+# replay the start; past that, chunks every subscriber has read are dropped
+# and the flight takes no new followers (the next identical request starts
+# its own). Followers skip admission; their entries
+# carry source "coalesced" and, like cache hits, count as saved tokens.
+PROXY_COALESCE = os.environ.get('PROXY_COALESCE', 'false').lower() in ('1', 'true', 'yes')
+COALESCE_REPLAY_BYTES = 256 * 1024
+
+class Flight:
+    """One upstream response shared by every identical request that joined it."""
+    def __init__(self, key):
+        self.key = key
+        self.cond = threading.Condition()
+        self.status = None
+        self.content_type = None
+        self.backend = None
+        self.queue_ms = None
+        self.error = None  # (status, message, retry_after) when upstream never answered
+        self.chunks = []
+        self.base = 0         # response index of chunks[0]; earlier chunks were read by everyone
+        self.held = 0         # bytes in chunks
+        self.done = False
+        self.joinable = True
+        self.abandoned = False
+        self.task = None      # async pump, cancelled when the last subscriber leaves
+        self._positions = {}  # subscriber → index of its next chunk
+        self._next_sub = 0
+        self._async_waiters = []
+        self._capture = None
+        self._stats = None
+
+    def _notify(self):
+        self.cond.notify_all()
+        for loop, event in self._async_waiters:
+            loop.call_soon_threadsafe(event.set)
+        self._async_waiters = []
+
+    # ── Leader (pump) side ──
+    def start(self, status, content_type, backend, queue_ms, cache_key, streamed):
+        self._capture = CacheCapture(cache_key, status)
+        self._stats = NDJSONStreamStats(time.time()) if streamed else None
+        with self.cond:
+            self.status, self.content_type = status, content_type
+            self.backend, self.queue_ms = backend, queue_ms
+            self._notify()
+
+    def publish(self, chunk):
+        """Fan chunk out; False once every subscriber has left (stop reading upstream)."""
+        self._capture.feed(chunk)
+        if self._stats:
+            self._stats.feed(chunk)
+        with self.cond:
+            if self.abandoned:
+                return False
+            self.chunks.append(chunk)
+            self.held += len(chunk)
+            self._notify()
+        return True
+
+    def store(self):
+        """Cache the completed response (no-op unless the cache is enabled)."""
+        if self.abandoned:
+            return
+        if self._stats is None:
+            self._capture.store(self.content_type)
+            return
+        self._stats.close()
+        if self._stats.final and self._stats.final.get('done'):
+            self._capture.store(self.content_type, self._stats.final, streamed=True)
+
+    def fail(self, status, message, retry_after=None):
+        with self.cond:
+            self.error = (status, message, retry_after)
+            self.done = True
+            self._notify()
+
+    def finish(self):
+        with self.cond:
+            self.done = True
+            self._notify()
+
+    # ── Subscriber side ──
+    def subscribe(self):
+        """Register a reader; None if chunks were already dropped (caller holds self.cond)."""
+        if not self.joinable:
+            return None
+        sub = self._next_sub
+        self._next_sub += 1
+        self._positions[sub] = 0
+        return sub
+
+    def leave(self, sub):
+        """Unregister sub; the last one out abandons a still-running flight."""
+        with self.cond:
+            if self._positions.pop(sub, None) is None:
+                return
+            self._trim()
+            if self._positions or self.done:
+                return
+            self.abandoned = True
+            self.joinable = False
+            task = self.task
+        if task is not None:
+            task.get_loop().call_soon_threadsafe(task.cancel)
+
+    def _trim(self):
+        if self.joinable and self.held <= COALESCE_REPLAY_BYTES:
+            return
+        low = min(self._positions.values(), default=self.base + len(self.chunks))
+        if low > self.base:
+            self.held -= sum(len(c) for c in self.chunks[:low - self.base])
+            del self.chunks[:low - self.base]
+            self.base = low
+            self.joinable = False
+
+    def _take(self, sub):
+        """Unread chunks for sub and whether the response is complete (caller holds self.cond)."""
+        batch = self.chunks[self._positions[sub] - self.base:]
+        self._positions[sub] += len(batch)
+        self._trim()
+        return batch, self.done
+
+    def failure(self):
+        """(status, message, retry_after) if upstream never answered, else None."""
+        if self.status is not None:
+            return None
+        return self.error or (500, "Upstream request failed", None)
+
+    def wait_started(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.status is not None or self.done)
+
+    def _ready(self, sub):
+        return self._positions[sub] < self.base + len(self.chunks) or self.done
+
+    def iter_chunks(self, sub):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self._ready(sub))
+                batch, done = self._take(sub)
+            yield from batch
+            if done:
+                return
+
+    async def _wait_async(self, ready):
+        loop = asyncio.get_running_loop()
+        while True:
+            event = asyncio.Event()
+            with self.cond:
+                if ready():
+                    return
+                self._async_waiters.append((loop, event))
+            await event.wait()
+
+    async def await_started(self):
+        await self._wait_async(lambda: self.status is not None or self.done)
+
+    async def aiter_chunks(self, sub):
+        while True:
+            await self._wait_async(lambda: self._ready(sub))
+            with self.cond:
+                batch, done = self._take(sub)
+            for chunk in batch:
+                yield chunk
+            if done:
+                return
+
+class RequestCoalescer:
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.stats = {"leaders": 0, "followers": 0}
+
+    def join(self, key):
+        """(flight, subscriber, is_leader): the in-flight request for key, or a new one this
+        caller must run. The subscriber must leave() the flight once done with it."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                with flight.cond:
+                    sub = flight.subscribe()
+                if sub is not None:
+                    self.stats["followers"] += 1
+                    return flight, sub, False
+            flight = self._flights[key] = Flight(key)
+            with flight.cond:
+                sub = flight.subscribe()
+            self.stats["leaders"] += 1
+            return flight, sub, True
+
+    def done(self, flight):
+        """Stop handing out flight to new requests (later ones go upstream or hit the cache)."""
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, enabled=self.enabled, in_flight=len(self._flights))
+
+coalescer = RequestCoalescer(PROXY_COALESCE)
+
+def run_flight(flight, method, path, headers, body, model, ticket, cache_key, streamed):
+    """Pump thread: one upstream call for every subscriber of flight."""
+    try:
+        try:
+            backend, ollama_resp = forward_to_backend(method, path, headers, body, model)
+        except requests.exceptions.ConnectionError:
+            return flight.fail(502, "Cannot connect to Ollama")
+        except requests.exceptions.Timeout:
+            return flight.fail(504, "Ollama request timed out")
+        default_ct = 'application/x-ndjson' if streamed else 'application/json'
+        try:
+            flight.start(ollama_resp.status_code, ollama_resp.headers.get('Content-Type', default_ct),
+                         backend.name, ticket.queue_ms if ticket else None, cache_key, streamed)
+            for chunk in ollama_resp.iter_content(chunk_size=None):
+                # Every subscriber gone: closing upstream below stops the generation
+                if chunk and not flight.publish(chunk):
+                    break
+        finally:
+            ollama_resp.close()
+            release_backend(backend)
+        flight.store()
+    except Exception as e:
+        if flight.status is None:
+            flight.fail(500, str(e))
+    finally:
+        admission.release(ticket)
+        coalescer.done(flight)
+        flight.finish()
+
+def flight_entry(data, body_json, flight, is_leader, start_ts, client_ip, method, req_path,
+                 timing=None, cancelled=False):
+    """History entry for one subscriber; followers generated nothing themselves."""
+    entry = build_proxy_entry(data, body_json, flight.status, start_ts, client_ip, method, req_path,
+                              timing=timing, backend=flight.backend,
+                              queue_ms=flight.queue_ms if is_leader else None,
+                              coalesced=not is_leader, cancelled=cancelled)
+    if not is_leader:
+        entry.update(source="coalesced", tokens_per_sec=0, prompt_tok_per_sec=0)
+    return entry
+
+def flight_response(flight, sub, is_leader, is_trackable, is_streaming, body_json,
+                    start_ts, client_ip, method, req_path):
+    """Serve one subscriber (leader or follower) of a Flight, leaving it once done."""
+    def fan_out():
+        stats = NDJSONStreamStats(start_ts) if is_trackable else None
+        try:
+            for chunk in flight.iter_chunks(sub):
+                yield chunk
+                if stats:
+                    stats.feed(chunk)
+        except GeneratorExit:
+            # Client hung up; the last subscriber out closes the upstream call
+            if stats:
+                stats.close()
+                log_request(flight_entry(stats.final, body_json, flight, is_leader, start_ts, client_ip,
+                                         method, req_path, timing=stats.timing(), cancelled=True))
+            raise
+        finally:
+            flight.leave(sub)
+        if stats:
+            stats.close()
+            log_request(flight_entry(stats.final, body_json, flight, is_leader, start_ts, client_ip,
+                                     method, req_path, timing=stats.timing()))
 
-# ══════════════════════════════════════════════════════════════════
-#  OLLAMA API PROXY — runs on port 11434
-#  Forwards all requests to Ollama, captures token stats
-# ══════════════════════════════════════════════════════════════════
+    streaming = False
+    try:
+        flight.wait_started()
+        failure = flight.failure()
+        if failure:
+            status, message, retry_after = failure
+            return jsonify({"error": message}), status, {"Retry-After": str(retry_after)} if retry_after else {}
+
+        if is_trackable and not is_streaming:
+            resp_data = b''.join(flight.iter_chunks(sub))
+            try:
+                data = json.loads(resp_data)
+            except:
+                data = None
+            log_request(flight_entry(data, body_json, flight, is_leader, start_ts, client_ip, method, req_path))
+            return Response(resp_data, status=flight.status, content_type=flight.content_type)
+
+        streaming = True
+        # Leave on close too: a generator closed before it started never runs its finally
+        return Response(ClosingIterator(fan_out(), lambda: flight.leave(sub)), status=flight.status,
+                        content_type=flight.content_type, direct_passthrough=True)
+    finally:
+        if not streaming:
+            flight.leave(sub)
 
 @proxy_app.route('/', defaults={'path': ''}, methods=['GET', 'POST', 'PUT', 'DELETE', 'PATCH'])
 @proxy_app.route('/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE', 'PATCH'])
 def proxy_handler(path):
-    """Transparent proxy: forward to Ollama, capture token stats from responses."""
-    target_url = f"{OLLAMA_URL}/{path}"
+    """Transparent proxy: forward to an Ollama backend, capture token stats from responses."""
     client_ip = flask_request.remote_addr or "unknown"
     method = flask_request.method
     start_ts = time.time()
 
     # Forward headers (skip hop-by-hop)
-    skip_headers = {'host', 'transfer-encoding', 'connection'}
-    fwd_headers = {k: v for k, v in flask_request.headers if k.lower() not in skip_headers}
+    fwd_headers = {k: v for k, v in flask_request.headers if k.lower() not in PROXY_SKIP_HEADERS}
 
-    # Determine if this is a chat/generate request we should track
-    is_trackable = path in ('api/chat', 'api/generate')
-
-    # Get request body
+    # Get request body; chat/generate requests are tracked
     body = flask_request.get_data()
-    body_json = None
-    is_streaming = True  # Ollama defaults to streaming
-
-    if body and is_trackable:
-        try:
-            body_json = json.loads(body)
-            is_streaming = body_json.get('stream', True)
-        except:
-            pass
+    is_trackable, body_json, is_streaming = classify_proxy_request(path, body)
+    model = request_model(path, body, body_json)
 
     # Capture path now (request context won't be available inside generators)
     req_path = f"/{path}"
 
+    # Answer repeated deterministic requests from the cache (no-op unless enabled)
+    fingerprint, fingerprint_req = request_fingerprint(path, body) if method == 'POST' else (None, None)
+    cache_key = fingerprint if response_cache.enabled else None
+    if cache_key:
+        item = response_cache.get(cache_key)
+        if item:
+            log_request(cache_hit_entry(item, fingerprint_req, start_ts, client_ip, method, req_path))
+            if item.streamed:
+                return Response(iter_ndjson_lines(item.body), status=200,
+                                content_type=item.content_type, direct_passthrough=True)
+            return Response(item.body, status=200, content_type=item.content_type)
+
+    # Identical deterministic requests already in flight share one upstream call
+    if fingerprint and coalescer.enabled:
+        flight, sub, is_leader = coalescer.join(fingerprint)
+        if is_leader:
+            ticket = None
+            if is_trackable and admission.enabled:
+                try:
+                    ticket = admission.acquire(client_ip, client_weight(client_ip))
+                except AdmissionRejected as e:
+                    flight.fail(e.status, e.reason, e.retry_after)
+                    coalescer.done(flight)
+            if not flight.done:
+                threading.Thread(target=run_flight, name="flight", daemon=True,
+                                 args=(flight, method, path, fwd_headers, body, model, ticket, cache_key,
+                                       is_trackable and is_streaming)).start()
+        return flight_response(flight, sub, is_leader, is_trackable, is_streaming, body_json,
+                               start_ts, client_ip, method, req_path)
+
+    # Generations wait their turn in the admission scheduler (no-op unless limits are set)
+    ticket = None
+    if is_trackable and admission.enabled:
+        try:
+            ticket = admission.acquire(client_ip, client_weight(client_ip))
+        except AdmissionRejected as e:
+            return jsonify({"error": e.reason}), e.status, {"Retry-After": str(e.retry_after)}
+    queue_ms = ticket.queue_ms if ticket else None
+
     try:
-        # Forward the request to Ollama
-        ollama_resp = requests.request(
-            method=method,
-            url=target_url,
-            headers=fwd_headers,
-            data=body,
-            stream=True,
-            timeout=600
-        )
+        # Forward the request to the best backend (fails over on connection errors)
+        backend, ollama_resp = forward_to_backend(method, path, fwd_headers, body, model)
+    except requests.exceptions.ConnectionError:
+        admission.release(ticket)
+        return jsonify({"error": "Cannot connect to Ollama"}), 502
+    except requests.exceptions.Timeout:
+        admission.release(ticket)
+        return jsonify({"error": "Ollama request timed out"}), 504
+    except Exception as e:
+        admission.release(ticket)
+        return jsonify({"error": str(e)}), 500
+
+    # Runs once, from whichever comes first: the stream ending, the server
+    # closing the body (also when the client left before it was iterated, so
+    # the generator never started), or an error before a Response was built
+    finished = []
+    def finish():
+        if finished:
+            return
+        finished.append(True)
+        # Return the connection to the pool even if the client hung up
+        ollama_resp.close()
+        release_backend(backend)
+        admission.release(ticket)
 
+    try:
         if is_trackable and is_streaming:
-            # ── Streaming: raw byte passthrough, parse stats after ──
+            # ── Streaming: raw byte passthrough, stats parsed incrementally ──
             def stream_and_capture():
-                accumulated = b''
-                for chunk in ollama_resp.iter_content(chunk_size=None):
-                    if chunk:
-                        yield chunk
-                        accumulated += chunk
-
-                # Parse accumulated NDJSON for final stats
-                model_name = body_json.get('model', '—') if body_json else '—'
-                elapsed_ms = (time.time() - start_ts) * 1000
-                eval_tokens = 0
-                prompt_tokens = 0
-                tok_per_sec = 0
-                prompt_tok_per_sec = 0
-                done_reason = ""
-
+                stats = NDJSONStreamStats(start_ts)
+                capture = CacheCapture(cache_key, ollama_resp.status_code)
                 try:
-                    lines = accumulated.decode('utf-8', errors='replace').strip().split('\n')
-                    for line in reversed(lines):
-                        try:
-                            data = json.loads(line)
-                            if data.get('done'):
-                                eval_tokens = data.get('eval_count', 0)
-                                prompt_tokens = data.get('prompt_eval_count', 0)
-                                eval_dur = data.get('eval_duration', 0)
-                                prompt_dur = data.get('prompt_eval_duration', 0)
-                                done_reason = data.get('done_reason', '')
-                                if eval_dur > 0:
-                                    tok_per_sec = round(eval_tokens / max(eval_dur / 1e9, 0.001), 2)
-                                if prompt_dur > 0:
-                                    prompt_tok_per_sec = round(prompt_tokens / max(prompt_dur / 1e9, 0.001), 2)
-                                model_name = data.get('model', model_name)
-                                break
-                        except:
-                            continue
-                except:
-                    pass
+                    for chunk in ollama_resp.iter_content(chunk_size=None):
+                        if chunk:
+                            yield chunk
+                            stats.feed(chunk)
+                            capture.feed(chunk)
+                except GeneratorExit:
+                    # Client hung up: closing upstream below stops the generation
+                    stats.close()
+                    log_request(build_proxy_entry(
+                        stats.final, body_json, ollama_resp.status_code, start_ts, client_ip, method,
+                        req_path, timing=stats.timing(), backend=backend.name, queue_ms=queue_ms,
+                        cancelled=True))
+                    raise
+                finally:
+                    finish()
+                stats.close()
+                if stats.final and stats.final.get('done'):
+                    capture.store(ct, stats.final, streamed=True)
 
-                entry = {
-                    "time": datetime.now().isoformat(),
-                    "time_display": datetime.now().strftime("%Y/%m/%d - %H:%M:%S"),
-                    "status": ollama_resp.status_code,
-                    "duration": _fmt_duration(elapsed_ms),
-                    "duration_ms": round(elapsed_ms, 1),
-                    "client_ip": client_ip,
-                    "method": method,
-                    "path": req_path,
-                    "model": model_name,
-                    "tokens": eval_tokens,
-                    "prompt_tokens": prompt_tokens,
-                    "total_tokens": eval_tokens + prompt_tokens,
-                    "tokens_per_sec": tok_per_sec,
-                    "prompt_tok_per_sec": prompt_tok_per_sec,
-                    "done_reason": done_reason,
-                    "source": "proxy",
-                }
-                log_request(entry)
+                log_request(build_proxy_entry(
+                    stats.final, body_json, ollama_resp.status_code, start_ts,
+                    client_ip, method, req_path, timing=stats.timing(), backend=backend.name,
+                    queue_ms=queue_ms))
 
             # Mirror Ollama's content type exactly
             ct = ollama_resp.headers.get('Content-Type', 'application/x-ndjson')
-            return Response(stream_and_capture(), status=ollama_resp.status_code,
-                           content_type=ct, direct_passthrough=True)
+            return Response(ClosingIterator(stream_and_capture(), finish), status=ollama_resp.status_code,
+                            content_type=ct, direct_passthrough=True)
 
         elif is_trackable and not is_streaming:
             # ── Non-streaming: read full response, capture stats ──
-            resp_data = ollama_resp.content
-            elapsed_ms = (time.time() - start_ts) * 1000
-
-            model_name = body_json.get('model', '—') if body_json else '—'
-            eval_tokens = 0
-            prompt_tokens = 0
-            tok_per_sec = 0
-            prompt_tok_per_sec = 0
-            done_reason = ""
-
+            try:
+                resp_data = ollama_resp.content
+            finally:
+                finish()
             try:
                 data = json.loads(resp_data)
-                model_name = data.get('model', model_name)
-                eval_tokens = data.get('eval_count', 0)
-                prompt_tokens = data.get('prompt_eval_count', 0)
-                eval_dur = data.get('eval_duration', 0)
-                prompt_dur = data.get('prompt_eval_duration', 0)
-                done_reason = data.get('done_reason', '')
-                if eval_dur > 0:
-                    tok_per_sec = round(eval_tokens / max(eval_dur / 1e9, 0.001), 2)
-                if prompt_dur > 0:
-                    prompt_tok_per_sec = round(prompt_tokens / max(prompt_dur / 1e9, 0.001), 2)
             except:
-                pass
+                data = None
+            if cache_key and ollama_resp.status_code == 200 and isinstance(data, dict):
+                response_cache.put(cache_key, resp_data, ollama_resp.headers.get('Content-Type', 'application/json'),
+                                   data, streamed=False)
 
-            entry = {
-                "time": datetime.now().isoformat(),
-                "time_display": datetime.now().strftime("%Y/%m/%d - %H:%M:%S"),
-                "status": ollama_resp.status_code,
-                "duration": _fmt_duration(elapsed_ms),
-                "duration_ms": round(elapsed_ms, 1),
-                "client_ip": client_ip,
-                "method": method,
-                "path": req_path,
-                "model": model_name,
-                "tokens": eval_tokens,
-                "prompt_tokens": prompt_tokens,
-                "total_tokens": eval_tokens + prompt_tokens,
-                "tokens_per_sec": tok_per_sec,
-                "prompt_tok_per_sec": prompt_tok_per_sec,
-                "done_reason": done_reason,
-                "source": "proxy",
-            }
-            log_request(entry)
+            log_request(build_proxy_entry(
+                data, body_json, ollama_resp.status_code, start_ts,
+                client_ip, method, req_path, backend=backend.name, queue_ms=queue_ms))
 
             # Return exact response from Ollama
             ct = ollama_resp.headers.get('Content-Type', 'application/json')
@@ -426,76 +3046,543 @@ def proxy_handler(path):
         else:
             # ── Non-trackable: pure passthrough ──
             def passthrough():
-                for chunk in ollama_resp.iter_content(chunk_size=None):
-                    if chunk:
-                        yield chunk
+                capture = CacheCapture(cache_key, ollama_resp.status_code)
+                try:
+                    for chunk in ollama_resp.iter_content(chunk_size=None):
+                        if chunk:
+                            yield chunk
+                            capture.feed(chunk)
+                finally:
+                    finish()
+                capture.store(ct)
 
             ct = ollama_resp.headers.get('Content-Type', 'application/json')
-            return Response(passthrough(), status=ollama_resp.status_code,
-                           content_type=ct, direct_passthrough=True)
+            return Response(ClosingIterator(passthrough(), finish), status=ollama_resp.status_code,
+                            content_type=ct, direct_passthrough=True)
 
     except requests.exceptions.ConnectionError:
+        finish()
         return jsonify({"error": "Cannot connect to Ollama"}), 502
     except requests.exceptions.Timeout:
+        finish()
         return jsonify({"error": "Ollama request timed out"}), 504
     except Exception as e:
+        finish()
         return jsonify({"error": str(e)}), 500
 
 
+# ── Async proxy engine (PROXY_MODE=async) ───────────────────────
+# Same passthrough and token capture as proxy_handler, served by uvicorn with
+# non-blocking upstream I/O (httpx), so an in-flight stream costs a coroutine
+# instead of an OS thread. Needs the optional uvicorn + httpx packages.
+PROXY_MODE = os.environ.get('PROXY_MODE', 'threaded').lower()
+ASYNC_PROXY_MAX_CONNECTIONS = int(os.environ.get('ASYNC_PROXY_MAX_CONNECTIONS', 1000))
+
+_async_upstream = None
+
+def _make_async_upstream():
+    import httpx
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(UPSTREAM_READ_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT, pool=None),
+        limits=httpx.Limits(max_connections=ASYNC_PROXY_MAX_CONNECTIONS,
+                            max_keepalive_connections=UPSTREAM_POOL_SIZE),
+    )
+
+async def _asgi_json(send, status, obj, headers=()):
+    body = json.dumps(obj).encode()
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"),
+                            (b"content-length", str(len(body)).encode()), *headers]})
+    await send({"type": "http.response.body", "body": body})
+
+async def _wait_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+async def _until_disconnect(receive, pump):
+    """Run the `pump` coroutine unless the client disconnects first (then it is cancelled).
+
+    uvicorn drops sends to a closed connection silently, so without this the
+    upstream generation would run to the end for nobody. True if pump finished."""
+    pump_task = asyncio.ensure_future(pump)
+    watch = asyncio.ensure_future(_wait_disconnect(receive))
+    try:
+        await asyncio.wait({pump_task, watch}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        pump_task.cancel()
+        raise
+    finally:
+        watch.cancel()
+    if pump_task.done():
+        pump_task.result()
+        return True
+    pump_task.cancel()
+    try:
+        await pump_task
+    except asyncio.CancelledError:
+        pass
+    return False
+
+async def _async_forward_to_backend(method, path, headers, body, model=None):
+    """Async forward_to_backend: (backend, streamed httpx response), failing over on connect errors."""
+    import httpx
+    tried = []
+    while True:
+        backend = pick_backend(model, exclude=tried)
+        if backend is None:
+            raise last_error
+        tried.append(backend)
+        try:
+            upstream_req = _async_upstream.build_request(method, f"{backend.url}/{path}",
+                                                         headers=headers, content=body)
+            return backend, await _async_upstream.send(upstream_req, stream=True)
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            release_backend(backend, error=e)
+            last_error = e
+        except BaseException:
+            release_backend(backend)
+            raise
+
+_flight_tasks = set()
+
+async def _async_run_flight(flight, method, path, headers, body, model, ticket, cache_key, streamed):
+    """Async run_flight: the pump runs as a task on the server's event loop."""
+    import httpx
+    try:
+        try:
+            backend, ollama_resp = await _async_forward_to_backend(method, path, headers, body, model)
+        except (httpx.ConnectError, httpx.ConnectTimeout):
+            return flight.fail(502, "Cannot connect to Ollama")
+        except httpx.TimeoutException:
+            return flight.fail(504, "Ollama request timed out")
+        default_ct = 'application/x-ndjson' if streamed else 'application/json'
+        try:
+            flight.start(ollama_resp.status_code, ollama_resp.headers.get('content-type', default_ct),
+                         backend.name, ticket.queue_ms if ticket else None, cache_key, streamed)
+            async for chunk in ollama_resp.aiter_bytes():
+                if chunk and not flight.publish(chunk):
+                    break
+        finally:
+            await ollama_resp.aclose()
+            release_backend(backend)
+        flight.store()
+    except Exception as e:
+        if flight.status is None:
+            flight.fail(500, str(e))
+    finally:
+        admission.release(ticket)
+        coalescer.done(flight)
+        flight.finish()
+
+async def _asgi_flight_response(receive, send, flight, sub, is_leader, is_trackable, is_streaming, body_json,
+                                start_ts, client_ip, method, req_path):
+    """ASGI counterpart of flight_response."""
+    try:
+        if not await _until_disconnect(receive, flight.await_started()):
+            return
+        failure = flight.failure()
+        if failure:
+            status, message, retry_after = failure
+            return await _asgi_json(send, status, {"error": message},
+                                    headers=[(b"retry-after", str(retry_after).encode())] if retry_after else ())
+        ct = flight.content_type.encode('latin-1')
+
+        if is_trackable and not is_streaming:
+            parts = []
+
+            async def collect():
+                parts.extend([chunk async for chunk in flight.aiter_chunks(sub)])
+
+            if not await _until_disconnect(receive, collect()):
+                log_request(flight_entry(None, body_json, flight, is_leader, start_ts, client_ip,
+                                         method, req_path, cancelled=True))
+                return
+            resp_data = b''.join(parts)
+            try:
+                data = json.loads(resp_data)
+            except:
+                data = None
+            log_request(flight_entry(data, body_json, flight, is_leader, start_ts, client_ip, method, req_path))
+            await send({"type": "http.response.start", "status": flight.status,
+                        "headers": [(b"content-type", ct), (b"content-length", str(len(resp_data)).encode())]})
+            await send({"type": "http.response.body", "body": resp_data})
+            return
+
+        await send({"type": "http.response.start", "status": flight.status, "headers": [(b"content-type", ct)]})
+        stats = NDJSONStreamStats(start_ts) if is_trackable else None
+
+        async def pump():
+            async for chunk in flight.aiter_chunks(sub):
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                if stats:
+                    stats.feed(chunk)
+
+        if not await _until_disconnect(receive, pump()):
+            # Client hung up; the last subscriber out cancels the upstream call
+            if stats:
+                stats.close()
+                log_request(flight_entry(stats.final, body_json, flight, is_leader, start_ts, client_ip,
+                                         method, req_path, timing=stats.timing(), cancelled=True))
+            return
+        await send({"type": "http.response.body", "body": b""})
+        if stats:
+            stats.close()
+            log_request(flight_entry(stats.final, body_json, flight, is_leader, start_ts, client_ip,
+                                     method, req_path, timing=stats.timing()))
+    finally:
+        flight.leave(sub)
+
+async def asgi_proxy(scope, receive, send):
+    """ASGI counterpart of proxy_handler."""
+    global _async_upstream
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                _async_upstream = _make_async_upstream()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if _async_upstream is not None:
+                    await _async_upstream.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    import httpx
+    if _async_upstream is None:
+        _async_upstream = _make_async_upstream()
+
+    path = scope["path"].lstrip('/')
+    client_ip = scope["client"][0] if scope.get("client") else "unknown"
+    method = scope["method"]
+    start_ts = time.time()
+    req_path = f"/{path}"
+
+    fwd_headers = [(k.decode('latin-1'), v.decode('latin-1')) for k, v in scope["headers"]
+                   if k.decode('latin-1').lower() not in PROXY_SKIP_HEADERS]
+
+    body_parts = []
+    while True:
+        message = await receive()
+        body_parts.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    body = b''.join(body_parts)
+    is_trackable, body_json, is_streaming = classify_proxy_request(path, body)
+    model = request_model(path, body, body_json)
+
+    fingerprint, fingerprint_req = request_fingerprint(path, body) if method == 'POST' else (None, None)
+    cache_key = fingerprint if response_cache.enabled else None
+    if cache_key:
+        item = response_cache.get(cache_key)
+        if item:
+            log_request(cache_hit_entry(item, fingerprint_req, start_ts, client_ip, method, req_path))
+            headers = [(b"content-type", item.content_type.encode('latin-1'))]
+            if not item.streamed:
+                headers.append((b"content-length", str(len(item.body)).encode()))
+            await send({"type": "http.response.start", "status": 200, "headers": headers})
+            if item.streamed:
+                for line in iter_ndjson_lines(item.body):
+                    await send({"type": "http.response.body", "body": line, "more_body": True})
+                await send({"type": "http.response.body", "body": b""})
+            else:
+                await send({"type": "http.response.body", "body": item.body})
+            return
+
+    if fingerprint and coalescer.enabled:
+        flight, sub, is_leader = coalescer.join(fingerprint)
+        if is_leader:
+            ticket = None
+            if is_trackable and admission.enabled:
+                try:
+                    ticket = await admission.acquire_async(client_ip, client_weight(client_ip))
+                except AdmissionRejected as e:
+                    flight.fail(e.status, e.reason, e.retry_after)
+                    coalescer.done(flight)
+            if not flight.done:
+                task = asyncio.create_task(_async_run_flight(
+                    flight, method, path, fwd_headers, body, model, ticket, cache_key,
+                    is_trackable and is_streaming))
+                _flight_tasks.add(task)
+                task.add_done_callback(_flight_tasks.discard)
+                flight.task = task
+        return await _asgi_flight_response(receive, send, flight, sub, is_leader, is_trackable, is_streaming, body_json,
+                                           start_ts, client_ip, method, req_path)
+
+    ticket = None
+    if is_trackable and admission.enabled:
+        try:
+            ticket = await admission.acquire_async(client_ip, client_weight(client_ip))
+        except AdmissionRejected as e:
+            return await _asgi_json(send, e.status, {"error": e.reason},
+                                    headers=[(b"retry-after", str(e.retry_after).encode())])
+    queue_ms = ticket.queue_ms if ticket else None
+
+    forwarded = []
+
+    async def forward():
+        forwarded.extend(await _async_forward_to_backend(method, path, fwd_headers, body, model))
+
+    try:
+        # Non-streaming calls only get response headers once generation is done
+        if not await _until_disconnect(receive, forward()):
+            admission.release(ticket)
+            if is_trackable:
+                log_request(build_proxy_entry(None, body_json, 499, start_ts, client_ip, method, req_path,
+                                              queue_ms=queue_ms, cancelled=True))
+            return
+        backend, ollama_resp = forwarded
+    except (httpx.ConnectError, httpx.ConnectTimeout):
+        admission.release(ticket)
+        return await _asgi_json(send, 502, {"error": "Cannot connect to Ollama"})
+    except httpx.TimeoutException:
+        admission.release(ticket)
+        return await _asgi_json(send, 504, {"error": "Ollama request timed out"})
+    except Exception as e:
+        admission.release(ticket)
+        return await _asgi_json(send, 500, {"error": str(e)})
+
+    try:
+        if is_trackable and not is_streaming:
+            if not await _until_disconnect(receive, ollama_resp.aread()):
+                log_request(build_proxy_entry(
+                    None, body_json, ollama_resp.status_code, start_ts, client_ip, method, req_path,
+                    backend=backend.name, queue_ms=queue_ms, cancelled=True))
+                return
+            resp_data = ollama_resp.content
+            try:
+                data = json.loads(resp_data)
+            except:
+                data = None
+            log_request(build_proxy_entry(
+                data, body_json, ollama_resp.status_code, start_ts,
+                client_ip, method, req_path, backend=backend.name, queue_ms=queue_ms))
+            ct = ollama_resp.headers.get('content-type', 'application/json')
+            if cache_key and ollama_resp.status_code == 200 and isinstance(data, dict):
+                response_cache.put(cache_key, resp_data, ct, data, streamed=False)
+            await send({"type": "http.response.start", "status": ollama_resp.status_code,
+                        "headers": [(b"content-type", ct.encode('latin-1')),
+                                    (b"content-length", str(len(resp_data)).encode())]})
+            await send({"type": "http.response.body", "body": resp_data})
+            return
+
+        default_ct = 'application/x-ndjson' if is_trackable else 'application/json'
+        ct = ollama_resp.headers.get('content-type', default_ct)
+        await send({"type": "http.response.start", "status": ollama_resp.status_code,
+                    "headers": [(b"content-type", ct.encode('latin-1'))]})
+        stats = NDJSONStreamStats(start_ts) if is_trackable else None
+        capture = CacheCapture(cache_key, ollama_resp.status_code)
+
+        async def pump():
+            async for chunk in ollama_resp.aiter_bytes():
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                    capture.feed(chunk)
+                    if stats:
+                        stats.feed(chunk)
+
+        if not await _until_disconnect(receive, pump()):
+            # Client hung up: the finally below closes upstream so Ollama stops generating
+            if stats:
+                stats.close()
+                log_request(build_proxy_entry(
+                    stats.final, body_json, ollama_resp.status_code, start_ts, client_ip, method,
+                    req_path, timing=stats.timing(), backend=backend.name, queue_ms=queue_ms, cancelled=True))
+            return
+        await send({"type": "http.response.body", "body": b""})
+
+        if not stats:
+            capture.store(ct)
+        else:
+            stats.close()
+            if stats.final and stats.final.get('done'):
+                capture.store(ct, stats.final, streamed=True)
+            log_request(build_proxy_entry(
+                stats.final, body_json, ollama_resp.status_code, start_ts,
+                client_ip, method, req_path, timing=stats.timing(), backend=backend.name,
+                queue_ms=queue_ms))
+    except httpx.TimeoutException:
+        pass  # headers already sent; the client sees a truncated stream
+    finally:
+        await ollama_resp.aclose()
+        release_backend(backend)
+        admission.release(ticket)
+
+def run_async_proxy(host='0.0.0.0', port=PROXY_PORT):
+    import httpx  # fail fast here rather than at lifespan startup
+    import uvicorn
+    uvicorn.run(asgi_proxy, host=host, port=port, log_level='warning',
+                lifespan='on', timeout_keep_alive=30)
+
 # ── Background poller ────────────────────────────────────────────
+# Each backend's /api/ps is fetched every tick (it doubles as the health
+# check). /api/tags and /api/version rarely change, so they run on their own
+# slower per-backend schedule — concurrently with /api/ps when due — and tags
+# are re-fetched early when /api/ps shows that backend's model set changed.
+# The tags interval backs off (doubling up to POLL_TAGS_INTERVAL_MAX) while
+# the list stays the same and drops back once it changes.
+poll_executor = ThreadPoolExecutor(max_workers=3 * len(backends), thread_name_prefix="poll")
 last_running = set()
+poll_stats = {name: {"count": 0, "errors": 0, "last_ms": None, "avg_ms": None, "max_ms": 0}
+              for name in ("ps", "tags", "version", "tick")}
+_poll_stats_lock = threading.Lock()
+
+def _record_poll(name, ms, ok=True):
+    with _poll_stats_lock:
+        s = poll_stats[name]
+        s["count"] += 1
+        if not ok:
+            s["errors"] += 1
+        s["last_ms"] = round(ms, 1)
+        s["avg_ms"] = round(ms if s["avg_ms"] is None else s["avg_ms"] * 0.8 + ms * 0.2, 1)
+        s["max_ms"] = round(max(s["max_ms"], ms), 1)
+
+def get_poll_stats():
+    with _poll_stats_lock:
+        stats = {name: dict(s) for name, s in poll_stats.items()}
+    stats["tags_interval_s"] = backends[0].poll["tags_interval"]
+    return stats
+
+def poll_upstream(backend, name, path, read_timeout):
+    """GET an Ollama endpoint on backend, recording its latency. JSON body, or None on a non-2xx."""
+    t0 = time.perf_counter()
+    ok = False
+    try:
+        resp = upstream.get(f"{backend.url}{path}", timeout=upstream_timeout(read_timeout))
+        data = resp.json() if resp.ok else None
+        ok = data is not None
+        return data
+    finally:
+        ms = (time.perf_counter() - t0) * 1000
+        _record_poll(name, ms, ok)
+        if name == "ps":
+            backend.ps_ms = round(ms, 1)
+
+def _update_tags(backend, future):
+    cache = backend.poll
+    now = time.monotonic()
+    try:
+        tags_data = future.result()
+    except Exception:
+        tags_data = None
+    if tags_data is None:
+        # Retry on the base schedule rather than every tick
+        cache["tags_next"] = now + POLL_TAGS_INTERVAL
+        return
+    sig = hashlib.md5(json.dumps([(m.get("name"), m.get("digest"), m.get("modified_at"))
+                                  for m in tags_data.get("models", [])]).encode()).hexdigest()
+    if sig == cache["tags_sig"]:
+        cache["tags_interval"] = min(cache["tags_interval"] * 2, POLL_TAGS_INTERVAL_MAX)
+    else:
+        cache["tags_interval"] = POLL_TAGS_INTERVAL
+    cache.update(tags=tags_data, tags_sig=sig, tags_next=now + cache["tags_interval"])
+    installed = {_model_key(m["name"]) for m in tags_data.get("models", []) if isinstance(m.get("name"), str)}
+    with _backends_lock:
+        backend.installed = installed
+
+def _update_version(backend, future):
+    try:
+        data = future.result()
+    except Exception:
+        data = None
+    if data is None:
+        return  # due again next tick
+    backend.poll["version"] = data.get("version", "unknown")
+    backend.poll["version_next"] = time.monotonic() + POLL_VERSION_INTERVAL
+
+def poll_backends():
+    """One concurrent poll of every backend; updates each backend's state in place."""
+    now = time.monotonic()
+    pending = []
+    for b in backends:
+        tags_future = version_future = None
+        if now >= b.poll["tags_next"]:
+            tags_future = poll_executor.submit(poll_upstream, b, "tags", "/api/tags", 5)
+        if now >= b.poll["version_next"]:
+            version_future = poll_executor.submit(poll_upstream, b, "version", "/api/version", 3)
+        pending.append((b, poll_executor.submit(poll_upstream, b, "ps", "/api/ps", 5),
+                        tags_future, version_future))
+
+    for b, ps_future, tags_future, version_future in pending:
+        try:
+            ps_data = ps_future.result() or {"models": []}
+        except Exception as e:
+            # Ollama may come back upgraded or with new models — refresh everything then
+            b.online = False
+            b.last_error = str(e)
+            b.loaded = set()
+            b.poll.update(ps={"models": []}, tags_next=0.0, version_next=0.0,
+                          tags_interval=POLL_TAGS_INTERVAL)
+            continue
+        loaded = {_model_key(m.get("name", "unknown")) for m in ps_data.get("models", [])}
+        if tags_future is None and loaded != b.loaded:
+            tags_future = poll_executor.submit(poll_upstream, b, "tags", "/api/tags", 5)
+        if tags_future is not None:
+            _update_tags(b, tags_future)
+        if version_future is not None:
+            _update_version(b, version_future)
+        with _backends_lock:
+            if not b.online:
+                b.down_until = 0.0  # reachable again: back into rotation
+            b.online = True
+            b.loaded = loaded
+        b.poll["ps"] = ps_data
 
 def poll_loop():
     global current_status, last_running, active_model
+    multi = len(backends) > 1
     while True:
+        tick_start = time.perf_counter()
         try:
-            ps_resp = requests.get(f"{OLLAMA_URL}/api/ps", timeout=5)
-            tags_resp = requests.get(f"{OLLAMA_URL}/api/tags", timeout=5)
-            ps_data = ps_resp.json() if ps_resp.ok else {"models": []}
-            tags_data = tags_resp.json() if tags_resp.ok else {"models": []}
+            poll_backends()
+            online = [b for b in backends if b.online]
+            if not online:
+                raise RuntimeError("; ".join(f"{b.name}: {b.last_error}" for b in backends) if multi
+                                   else backends[0].last_error)
+
+            # Merge backends: running models tagged with their backend, tags de-duplicated by name
+            running_models, tag_models, seen_tags = [], [], {}
+            for b in online:
+                running_models += [dict(m, backend=b.name) for m in b.poll["ps"].get("models", [])]
+                for m in b.poll["tags"].get("models", []):
+                    if m.get("name") in seen_tags:
+                        seen_tags[m.get("name")]["backends"].append(b.name)
+                        continue
+                    seen_tags[m.get("name")] = dict(m, backends=[b.name])
+                    tag_models.append(seen_tags[m.get("name")])
+            ps_data = {"models": running_models}
 
-            running_models = ps_data.get("models", [])
             if running_models:
                 active_model = running_models[0].get("name", "—")
             else:
                 active_model = "—"
 
-            model_details = get_model_details(ps_data)
-            ollama_version = get_ollama_version()
-
             current_status = {
                 "status": "online",
                 "running": ps_data,
-                "models": tags_data,
-                "model_details": model_details,
-                "ollama_version": ollama_version,
+                "models": {"models": tag_models},
+                "model_details": [dict(d, backend=m["backend"]) for d, m in
+                                  zip(get_model_details(ps_data), running_models)],
+                "ollama_version": online[0].poll["version"],
                 "active_model": active_model,
                 "polled_at": datetime.now().isoformat()
             }
 
-            current_running = {m.get("name", "unknown") for m in running_models}
+            current_running = {(m["backend"], m.get("name", "unknown")) for m in running_models}
             loaded = current_running - last_running
             unloaded = last_running - current_running
 
-            with history_lock:
-                history = load_history()
-                now = datetime.now().isoformat()
-                changed = False
-
-                for model in loaded:
-                    history["events"].append({"time": now, "type": "load", "model": model})
-                    changed = True
-                for model in unloaded:
-                    history["events"].append({"time": now, "type": "unload", "model": model})
-                    changed = True
-
-                new_requests = parse_docker_logs()
-                if new_requests:
-                    history["requests"].extend(new_requests)
-                    changed = True
-
-                if changed:
-                    save_history(history)
+            now = datetime.now().isoformat()
+            events = []
+            for kind, changes in (("load", loaded), ("unload", unloaded)):
+                for backend_name, model in sorted(changes):
+                    event = {"time": now, "type": kind, "model": model}
+                    if multi:
+                        event["backend"] = backend_name
+                    events.append(event)
+            warmup.classify(events)
+            enqueue_history("events", events)
 
             last_running = current_running
 
@@ -511,7 +3598,247 @@ def poll_loop():
                 "polled_at": datetime.now().isoformat()
             }
 
-        time.sleep(get_poll_interval())
+        elapsed = time.perf_counter() - tick_start
+        _record_poll("tick", elapsed * 1000, current_status.get("status") == "online")
+        broadcaster.publish("status", build_status())
+        time.sleep(max(0.0, get_poll_interval() - elapsed))
+
+# ── Model warm-up ────────────────────────────────────────────────
+# Opt-in (WARMUP_VRAM_BUDGET_GB > 0). Learns when each model is used from the
+# hourly rollups of the last WARMUP_HISTORY_DAYS days: the share of days on
+# which a model was requested in a given hour of the day is its probability
+# of being wanted in that hour. Models likely to be needed within the next
+# WARMUP_LOOKAHEAD_MIN minutes are preloaded (an empty generate with
+# keep_alive) or have their keep_alive extended; everything else is left to
+# expire, and idle unpredicted models are unloaded early only when a predicted
+# one needs their VRAM. Loads the poller sees are tagged "warm-up" when the
+# scheduler caused them, otherwise "cold start" (a request found its model
+# unloaded) and counted as a miss; the first request a preload serves is a hit.
+WARMUP_VRAM_BUDGET_GB = float(os.environ.get('WARMUP_VRAM_BUDGET_GB', 0))
+WARMUP_INTERVAL = float(os.environ.get('WARMUP_INTERVAL', 60))
+WARMUP_LOOKAHEAD_MIN = float(os.environ.get('WARMUP_LOOKAHEAD_MIN', 15))
+WARMUP_HISTORY_DAYS = int(os.environ.get('WARMUP_HISTORY_DAYS', 14))
+WARMUP_MIN_PROBABILITY = float(os.environ.get('WARMUP_MIN_PROBABILITY', 0.5))
+WARMUP_KEEP_ALIVE = os.environ.get('WARMUP_KEEP_ALIVE', '30m')
+WARMUP_IDLE_MIN = float(os.environ.get('WARMUP_IDLE_MIN', 10))
+WARMUP_LOAD_TIMEOUT = 600  # a preload must show up in /api/ps within this to count as ours
+
+_OLLAMA_TIME_RE = re.compile(r'(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|[+-]\d\d:\d\d)?$')
+
+def _parse_ollama_time(value):
+    """Epoch seconds for an Ollama RFC3339 timestamp (nanosecond fraction), or None."""
+    m = _OLLAMA_TIME_RE.match(value or '')
+    if not m:
+        return None
+    base, frac, tz = m.groups()
+    iso = base + ('.' + (frac + '000000')[:6] if frac else '') + ('+00:00' if tz == 'Z' else tz or '')
+    try:
+        return datetime.fromisoformat(iso).timestamp()
+    except ValueError:
+        return None
+
+class WarmupScheduler:
+    def __init__(self, budget_bytes):
+        self.budget = int(budget_bytes)
+        self.lock = threading.Lock()
+        self.pending = {}       # (backend name, model key) → monotonic deadline of a preload we sent
+        self.preloaded = {}     # model key → {"backend", "at", "used"} while our preload is resident
+        self.last_request = {}  # model key → epoch of its latest request
+        self.sizes = {}         # model key → size_vram when last seen loaded
+        self.predictions = []
+        self.primed = False
+        self.stats = {"runs": 0, "preloads": 0, "refreshes": 0, "evictions": 0, "hits": 0, "misses": 0,
+                      "wasted": 0, "over_budget": 0, "errors": 0, "last_run": None, "last_ms": None}
+
+    @property
+    def enabled(self):
+        return self.budget > 0
+
+    # ── Feedback from the proxy, log follower and poller ──
+    def observe_requests(self, entries):
+        if not self.enabled:
+            return
+        with self.lock:
+            for e in entries:
+                model = e.get("model")
+                if not model or model == "—" or e.get("source") in SAVED_SOURCES:
+                    continue
+                key = _model_key(model)
+                self.last_request[key] = time.time()
+                preload = self.preloaded.get(key)
+                if preload and not preload["used"]:
+                    preload["used"] = True
+                    self.stats["hits"] += 1
+
+    def classify(self, events):
+        """Tag the poller's load events as warm-up or cold start (in place); track unused preloads."""
+        if not self.enabled:
+            return
+        with self.lock:
+            if not self.primed:
+                # The first poll reports every model that was already loaded
+                self.primed = True
+                return
+            now = time.monotonic()
+            for e in events:
+                key = _model_key(e["model"])
+                if e["type"] == "unload":
+                    preload = self.preloaded.pop(key, None)
+                    if preload and not preload["used"]:
+                        self.stats["wasted"] += 1
+                    continue
+                backend = e.get("backend", backends[0].name)
+                if self.pending.pop((backend, key), 0) > now:
+                    self.preloaded[key] = {"backend": backend, "at": time.time(), "used": False}
+                    e.update(warmup="preload", detail="warm-up")
+                else:
+                    self.stats["misses"] += 1
+                    e.update(warmup="miss", detail="cold start")
+
+    # ── Scheduling ──
+    def predict(self):
+        """[(model, probability)] of models likely to be requested within the lookahead, best first."""
+        now = time.time()
+        since = _bucket_start(now - WARMUP_HISTORY_DAYS * 86400, "hour")
+        slots, names, first = {}, {}, None
+        for r in query_rollups("hour", since=since, group_by=("model", "source")):
+            if not r["model"] or r["model"] == "—" or r["source"] in SAVED_SOURCES or not r["requests"]:
+                continue
+            key = _model_key(r["model"])
+            names.setdefault(key, r["model"])
+            t = datetime.fromtimestamp(r["bucket"])
+            slots.setdefault(key, {}).setdefault(t.hour, set()).add(t.date())
+            first = r["bucket"] if first is None else min(first, r["bucket"])
+        if first is None:
+            return []
+        days = max(1, min(WARMUP_HISTORY_DAYS, int((now - first) // 86400) + 1))
+        lookahead = WARMUP_LOOKAHEAD_MIN * 60
+        hours = {datetime.fromtimestamp(now + s).hour for s in range(0, int(lookahead) + 1, 900)}
+        hours.add(datetime.fromtimestamp(now + lookahead).hour)
+        scored = []
+        for key, by_hour in slots.items():
+            p = max(len(by_hour.get(h, ())) / days for h in hours)
+            if p >= WARMUP_MIN_PROBABILITY:
+                scored.append((names[key], round(min(p, 1.0), 3)))
+        return sorted(scored, key=lambda s: -s[1])
+
+    def _send(self, backend, model, keep_alive):
+        resp = upstream.post(f"{backend.url}/api/generate", json={"model": model, "keep_alive": keep_alive},
+                             timeout=upstream_timeout(WARMUP_LOAD_TIMEOUT))
+        resp.close()
+        resp.raise_for_status()
+
+    def run(self):
+        t0 = time.perf_counter()
+        online = [b for b in backends if b.online]
+        resident = {}  # backend name → {model key: ps entry}
+        for b in online:
+            resident[b.name] = {_model_key(m.get("name", "")): m for m in b.poll["ps"].get("models", [])}
+            for key, m in resident[b.name].items():
+                if m.get("size_vram"):
+                    self.sizes[key] = m["size_vram"]
+        tag_sizes = {_model_key(m.get("name", "")): m.get("size", 0)
+                     for b in online for m in b.poll["tags"].get("models", [])}
+        used = {b.name: sum(m.get("size_vram", 0) for m in resident[b.name].values()) for b in online}
+
+        predictions = self.predict()
+        wanted = {_model_key(model) for model, _ in predictions}
+        horizon = time.time() + WARMUP_LOOKAHEAD_MIN * 60 + WARMUP_INTERVAL
+        results = []
+        for model, probability in predictions:
+            key = _model_key(model)
+            state = self._schedule(model, key, online, resident, used, wanted, tag_sizes, horizon)
+            results.append({"model": model, "probability": probability, "state": state})
+
+        with self.lock:
+            self.predictions = results
+            self.stats["runs"] += 1
+            self.stats["last_run"] = datetime.now().isoformat()
+            self.stats["last_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+
+    def _schedule(self, model, key, online, resident, used, wanted, tag_sizes, horizon):
+        """Make sure one predicted model is resident; returns its state for the status page."""
+        for b in online:
+            m = resident[b.name].get(key)
+            if m is None:
+                continue
+            expires = _parse_ollama_time(m.get("expires_at"))
+            if expires is None or expires >= horizon:
+                return "loaded"
+            try:
+                self._send(b, model, WARMUP_KEEP_ALIVE)
+                self._count("refreshes")
+                return "refreshed"
+            except Exception as e:
+                self._count("errors")
+                print(f"[WARMUP] Could not extend keep_alive of {model} on {b.name}: {e}")
+                return "error"
+        if not online:
+            return "offline"
+
+        size = self.sizes.get(key) or tag_sizes.get(key) or 0
+        if not size:
+            return "unknown size"
+        # Most free VRAM first; evict idle, unpredicted models only if that makes it fit
+        for b in sorted(online, key=lambda b: used[b.name]):
+            free = self.budget - used[b.name]
+            idle_before = time.time() - WARMUP_IDLE_MIN * 60
+            evictable = sorted(((k, m) for k, m in resident[b.name].items()
+                                if k not in wanted and self.last_request.get(k, 0) < idle_before),
+                               key=lambda km: -km[1].get("size_vram", 0))
+            if free + sum(m.get("size_vram", 0) for _, m in evictable) < size:
+                continue
+            for k, m in evictable:
+                if free >= size:
+                    break
+                try:
+                    self._send(b, m.get("name", k), 0)
+                except Exception as e:
+                    print(f"[WARMUP] Could not unload {k} on {b.name}: {e}")
+                    continue
+                self._count("evictions")
+                free += m.get("size_vram", 0)
+                used[b.name] -= m.get("size_vram", 0)
+                del resident[b.name][k]
+                print(f"[WARMUP] Unloaded idle {k} on {b.name} to make room for {model}")
+            if free < size:
+                continue
+            with self.lock:
+                self.pending[(b.name, key)] = time.monotonic() + WARMUP_LOAD_TIMEOUT
+            try:
+                self._send(b, model, WARMUP_KEEP_ALIVE)
+            except Exception as e:
+                with self.lock:
+                    self.pending.pop((b.name, key), None)
+                self._count("errors")
+                print(f"[WARMUP] Preload of {model} on {b.name} failed: {e}")
+                return "error"
+            self._count("preloads")
+            used[b.name] += size
+            print(f"[WARMUP] Preloaded {model} on {b.name}")
+            return "preloaded"
+        self._count("over_budget")
+        return "over budget"
+
+    def _count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, enabled=self.enabled, budget_bytes=self.budget,
+                        predictions=list(self.predictions),
+                        preloaded={k: dict(v) for k, v in self.preloaded.items()})
+
+warmup = WarmupScheduler(WARMUP_VRAM_BUDGET_GB * 1024 ** 3)
+
+def warmup_loop():
+    while True:
+        time.sleep(WARMUP_INTERVAL)
+        try:
+            warmup.run()
+        except Exception as e:
+            print(f"[WARMUP] Run failed: {e}")
 
 # ── Dashboard API Endpoints ──────────────────────────────────────
 
@@ -570,7 +3897,7 @@ def api_settings_get():
     defaults = {
         'poll_interval': POLL_INTERVAL,
         'client_map': CLIENT_MAP,
-        'retention_months': 6,
+        'retention_months': DEFAULT_RETENTION_MONTHS,
         'theme': 'terminal',
         'mode': 'dark',
     }
@@ -594,18 +3921,117 @@ def api_settings_save():
 @app.route('/api/status')
 @login_required
 def api_status():
+    return jsonify(build_status())
+
+def build_status():
     data = dict(current_status)
     data["dashboard_start"] = start_time
     data["ollama_url"] = OLLAMA_URL
     data["proxy_port"] = PROXY_PORT
     data["proxy_ip"] = proxy_self_ip or "unknown"
-    return jsonify(data)
+    data["proxy_mode"] = PROXY_MODE
+    data["upstream_pool"] = get_pool_stats()
+    data["backends"] = get_backends_status()
+    data["admission"] = admission.snapshot()
+    data["response_cache"] = response_cache.snapshot()
+    data["coalescing"] = coalescer.snapshot()
+    data["warmup"] = warmup.snapshot()
+    data["poll"] = get_poll_stats()
+    data["stream_subscribers"] = len(broadcaster)
+    return data
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape target. With METRICS_TOKEN set, send it as a Bearer token;
+    otherwise it follows the dashboard login (open when no password is set)."""
+    if METRICS_TOKEN:
+        auth = flask_request.headers.get('Authorization', '')
+        if not (secrets.compare_digest(auth, f"Bearer {METRICS_TOKEN}") or session.get('authenticated')):
+            return Response("unauthorized\n", status=401, mimetype='text/plain')
+    elif DASHBOARD_PASSWORD and not session.get('authenticated'):
+        return Response("unauthorized\n", status=401, mimetype='text/plain')
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/stream')
+@login_required
+def api_stream():
+    """SSE push channel: `status` snapshots, new `history` entries, `resync` hints."""
+    sub = broadcaster.subscribe()
+
+    def events():
+        try:
+            yield b"retry: 5000\n\n"
+            yield EventBroadcaster.format("status", build_status())
+            while True:
+                try:
+                    yield sub.get(timeout=SSE_HEARTBEAT)
+                except queue.Empty:
+                    yield b": ping\n\n"  # keeps proxies open, detects closed tabs
+        finally:
+            broadcaster.unsubscribe(sub)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# The dashboard keeps only a recent window of raw entries (for the per-request
+# charts and the event/benchmark lists); totals and long-range charts come
+# from /api/history/stats, rollups and percentiles.
+HISTORY_SYNC_LIMIT = 1000
 
 @app.route('/api/history')
 @login_required
 def api_history():
-    with history_lock:
-        return jsonify(load_history())
+    """The newest ?limit= entries of each kind, or only what is new since ?since=<cursor>
+    (again at most limit per kind). ETag/304 when unchanged. Full copies: /api/history/export."""
+    limit = flask_request.args.get('limit', HISTORY_SYNC_LIMIT, type=int)
+    if limit is None or limit < 1:
+        return jsonify({"error": "limit must be a positive integer"}), 400
+    conn = get_db()
+    conn.execute("BEGIN")  # one read snapshot for the cursor and the rows
+    try:
+        cursor = history_cursor()
+        etag = f'"{cursor}"'
+        if flask_request.headers.get('If-None-Match') == etag:
+            return Response(status=304, headers={'ETag': etag})
+
+        since = parse_cursor(flask_request.args.get('since', ''))
+        if since and since[0] == cursor.split(".")[0]:
+            data = load_history_since(since[1], limit)
+            data["reset"] = False
+        else:
+            data = load_history_since(limit=limit)
+            data["reset"] = True
+    finally:
+        conn.execute("COMMIT")
+    data["cursor"] = cursor
+    data["limit"] = limit
+    resp = jsonify(data)
+    resp.headers['ETag'] = etag
+    return resp
+
+@app.route('/api/history/requests')
+@login_required
+def api_history_requests():
+    """Filtered, sorted, paginated request history (newest first by default)."""
+    args = flask_request.args
+    try:
+        page = query_requests(
+            since=_parse_time_arg(args.get('since')),
+            until=_parse_time_arg(args.get('until')),
+            model=args.get('model'),
+            client_ip=args.get('client_ip'),
+            source=args.get('source'),
+            status=args.get('status'),
+            sort=args.get('sort', 'time'),
+            direction=args.get('dir', 'desc'),
+            limit=args.get('limit', 50, type=int),
+            offset=args.get('offset', 0, type=int),
+            after=args.get('after'),
+            with_total=args.get('total', '1') != '0',
+        )
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(page)
 
 @app.route('/api/benchmark', methods=['POST'])
 @login_required
@@ -617,13 +4043,14 @@ def api_benchmark():
     if not model:
         return jsonify({"error": "No model specified"}), 400
 
+    backend = pick_backend(model)
     try:
-        resp = requests.post(f"{OLLAMA_URL}/api/generate", json={
+        resp = upstream.post(f"{backend.url}/api/generate", json={
             "model": model,
             "prompt": prompt,
             "stream": False,
             "options": {"num_predict": 128}
-        }, timeout=300)
+        }, timeout=upstream_timeout(300))
 
         if not resp.ok:
             return jsonify({"error": f"Ollama returned {resp.status_code}"}), 502
@@ -645,11 +4072,10 @@ def api_benchmark():
             "tokens_per_sec": round(data.get("eval_count", 0) / max(eval_dur / 1e9, 0.001), 2),
             "response_preview": data.get("response", "")[:200]
         }
+        if len(backends) > 1:
+            result["backend"] = backend.name
 
-        with history_lock:
-            history = load_history()
-            history["benchmarks"].append(result)
-            save_history(history)
+        append_history("benchmarks", [result])
 
         return jsonify(result)
 
@@ -657,35 +4083,332 @@ def api_benchmark():
         return jsonify({"error": "Benchmark timed out (300s)"}), 504
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    finally:
+        release_backend(backend)
+
+# ── Benchmark sweeps ─────────────────────────────────────────────
+# /api/benchmark times a single request. A sweep is a load test run as a
+# background job: for every concurrency × prompt length × output length cell,
+# `concurrency` workers each stream `rounds` generate requests straight to the
+# backend. Per cell it reports TTFT and inter-token latency percentiles and
+# aggregate throughput (generated tokens / wall time). The cold-load cost is
+# measured once up front (model unloaded, then one request); later requests
+# that still had to load the model are counted as cold and kept out of the
+# latency percentiles. Finished sweeps are stored in the `sweeps` history list.
+SWEEP_MAX_REQUESTS = int(os.environ.get('SWEEP_MAX_REQUESTS', 2000))
+SWEEP_LIMITS = {"concurrency": 64, "prompt_tokens": 32768, "output_tokens": 8192, "rounds": 50, "num_ctx": 131072}
+SWEEP_COLD_LOAD_MS = 250   # load_duration above this means the request paid for a model load
+SWEEP_JOBS_KEEP = 20
+_SWEEP_WORDS = ("the quick brown fox jumps over a lazy dog while seven wizards "
+                "quietly judge every box of mixed liquor near our old river bank").split()
+
+sweep_jobs = OrderedDict()
+_sweep_lock = threading.Lock()
+
+def _percentiles(values, ps=(50, 95, 99)):
+    s = sorted(values)
+    if not s:
+        return {f"p{p}": None for p in ps}
+    return {f"p{p}": round(s[min(len(s) - 1, int(round(p / 100 * (len(s) - 1))))], 2) for p in ps}
+
+def _sweep_prompt(n_tokens):
+    """Roughly n_tokens of filler (common words are ~1 token), unique so no prompt cache is reused."""
+    words = [_SWEEP_WORDS[i % len(_SWEEP_WORDS)] for i in range(max(1, n_tokens - 8))]
+    return f"[{secrets.token_hex(4)}] Continue this text: " + " ".join(words)
+
+def _sweep_request(backend, model, prompt_tokens, output_tokens, num_ctx):
+    """Stream one generate request; timing measured as the client sees it."""
+    t0 = time.perf_counter()
+    result = {"ok": False}
+    try:
+        resp = upstream.post(f"{backend.url}/api/generate", stream=True, json={
+            "model": model,
+            "prompt": _sweep_prompt(prompt_tokens),
+            "stream": True,
+            "options": {"num_predict": output_tokens, "num_ctx": num_ctx},
+        }, timeout=upstream_timeout(600))
+        try:
+            if not resp.ok:
+                result["error"] = f"Ollama returned {resp.status_code}"
+                return result
+            first = last = final = None
+            gaps, partial = [], b''
+            for chunk in resp.iter_content(chunk_size=None):
+                now = time.perf_counter()
+                lines = (partial + chunk).split(b'\n')
+                partial = lines.pop()
+                for line in lines:
+                    if not line.strip():
+                        continue
+                    if b'"done":true' in line or b'"done": true' in line:
+                        final = json.loads(line)
+                        continue
+                    if first is None:
+                        first = now
+                    else:
+                        gaps.append((now - last) * 1000)
+                    last = now
+            if partial.strip():
+                final = json.loads(partial)
+        finally:
+            resp.close()
+    except Exception as e:
+        result["error"] = str(e)
+        return result
+    final = final or {}
+    eval_dur = final.get("eval_duration", 0)
+    result.update({
+        "ok": first is not None and final.get("done", False),
+        "wall_ms": (time.perf_counter() - t0) * 1000,
+        "ttft_ms": (first - t0) * 1000 if first is not None else None,
+        "gaps_ms": gaps,
+        "load_ms": final.get("load_duration", 0) / 1e6,
+        "eval_count": final.get("eval_count", 0),
+        "prompt_eval_count": final.get("prompt_eval_count", 0),
+        "tokens_per_sec": final.get("eval_count", 0) / (eval_dur / 1e9) if eval_dur else None,
+    })
+    if not result["ok"]:
+        result["error"] = final.get("error", "stream ended without a final frame")
+    return result
+
+class SweepJob:
+    def __init__(self, model, params):
+        self.id = secrets.token_hex(6)
+        self.model = model
+        self.params = params
+        self.status = "queued"
+        self.cells = []
+        self.cold_start = None
+        self.current = None
+        self.error = None
+        self.cancelled = False
+        self.created = datetime.now().isoformat()
+        self.started = self.finished = None
+        self.backend = None
+        shapes = len(params["prompt_tokens"]) * len(params["output_tokens"])
+        self.total = len(params["concurrency"]) * shapes
+        self.requests_total = sum(params["concurrency"]) * params["rounds"] * shapes
+        self.requests_done = 0
+
+    def snapshot(self):
+        return {
+            "id": self.id, "model": self.model, "status": self.status, "params": self.params,
+            "created": self.created, "started": self.started, "finished": self.finished,
+            "backend": self.backend, "error": self.error, "current": self.current,
+            "progress": {"cells_done": len(self.cells), "cells_total": self.total,
+                         "requests_done": self.requests_done, "requests_total": self.requests_total,
+                         "percent": round(100 * self.requests_done / max(self.requests_total, 1), 1)},
+            "cold_start": self.cold_start, "cells": list(self.cells),
+        }
+
+    def result(self):
+        """History entry for the finished sweep."""
+        entry = {"time": self.started, "finished": self.finished, "model": self.model, "status": self.status,
+                 "params": self.params, "cold_start": self.cold_start, "cells": self.cells}
+        if len(backends) > 1:
+            entry["backend"] = self.backend
+        return entry
+
+def _measure_cold_start(job, backend):
+    """Unload the model, then time one request that has to load it."""
+    try:
+        upstream.post(f"{backend.url}/api/generate", json={"model": job.model, "keep_alive": 0},
+                      timeout=upstream_timeout(60)).close()
+        key = _model_key(job.model)
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            ps = upstream.get(f"{backend.url}/api/ps", timeout=upstream_timeout(5)).json()
+            if key not in {_model_key(m.get("name", "")) for m in ps.get("models", [])}:
+                break
+            time.sleep(0.5)
+    except Exception as e:
+        print(f"[SWEEP] Could not unload {job.model} before the cold start: {e}")
+    r = _sweep_request(backend, job.model, job.params["prompt_tokens"][0], job.params["output_tokens"][0],
+                       job.params["num_ctx"])
+    return {"ok": r["ok"], "load_ms": round(r.get("load_ms", 0), 1),
+            "ttft_ms": round(r["ttft_ms"], 1) if r.get("ttft_ms") is not None else None,
+            "wall_ms": round(r.get("wall_ms", 0), 1), "error": r.get("error")}
+
+def _run_sweep_cell(job, backend, concurrency, prompt_tokens, output_tokens):
+    results, lock = [], threading.Lock()
+
+    def worker():
+        for _ in range(job.params["rounds"]):
+            if job.cancelled:
+                return
+            r = _sweep_request(backend, job.model, prompt_tokens, output_tokens, job.params["num_ctx"])
+            with lock:
+                results.append(r)
+            with _sweep_lock:
+                job.requests_done += 1
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="sweep") as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    wall = time.perf_counter() - t0
+
+    ok = [r for r in results if r["ok"]]
+    warm = [r for r in ok if r["load_ms"] < SWEEP_COLD_LOAD_MS]
+    generated = sum(r["eval_count"] for r in ok)
+    errors = [r.get("error") for r in results if not r["ok"]]
+    return {
+        "concurrency": concurrency, "prompt_tokens": prompt_tokens, "output_tokens": output_tokens,
+        "requests": len(results), "errors": len(errors), "error_sample": errors[0] if errors else None,
+        "cold_requests": len(ok) - len(warm),
+        "wall_s": round(wall, 2),
+        "throughput_tok_s": round(generated / wall, 2) if wall > 0 else 0,
+        "requests_per_s": round(len(ok) / wall, 3) if wall > 0 else 0,
+        "ttft_ms": _percentiles([r["ttft_ms"] for r in warm]),
+        "inter_token_ms": _percentiles([g for r in warm for g in r["gaps_ms"]]),
+        "tokens_per_sec": _percentiles([r["tokens_per_sec"] for r in warm if r["tokens_per_sec"]]),
+        "avg_prompt_eval_count": round(sum(r["prompt_eval_count"] for r in ok) / len(ok), 1) if ok else 0,
+        "avg_eval_count": round(generated / len(ok), 1) if ok else 0,
+    }
+
+def run_sweep(job):
+    """Run a sweep job; its fields are only changed under _sweep_lock, which pollers snapshot under."""
+    backend = pick_backend(job.model)
+    with _sweep_lock:
+        job.backend = backend.name
+        job.status = "running"
+        job.started = datetime.now().isoformat()
+    print(f"[SWEEP] {job.id}: {job.model} on {backend.name}, {job.total} cells, {job.requests_total} requests")
+    try:
+        if job.params["cold_start"]:
+            with _sweep_lock:
+                job.current = {"phase": "cold start"}
+            cold_start = _measure_cold_start(job, backend)
+            with _sweep_lock:
+                job.cold_start = cold_start
+        else:
+            # Load the model outside the measured cells
+            _sweep_request(backend, job.model, 8, 1, job.params["num_ctx"])
+        for c in job.params["concurrency"]:
+            for p in job.params["prompt_tokens"]:
+                for o in job.params["output_tokens"]:
+                    if job.cancelled:
+                        break
+                    with _sweep_lock:
+                        job.current = {"phase": "cell", "concurrency": c, "prompt_tokens": p, "output_tokens": o}
+                    cell = _run_sweep_cell(job, backend, c, p, o)
+                    with _sweep_lock:
+                        job.cells.append(cell)
+        with _sweep_lock:
+            job.status = "cancelled" if job.cancelled else "done"
+    except Exception as e:
+        with _sweep_lock:
+            job.status, job.error = "failed", str(e)
+        print(f"[SWEEP] {job.id} failed: {e}")
+    finally:
+        release_backend(backend)
+        with _sweep_lock:
+            job.current = None
+            job.finished = datetime.now().isoformat()
+    if job.cells or job.cold_start:
+        append_history("sweeps", [job.result()])
+    print(f"[SWEEP] {job.id}: {job.status} ({len(job.cells)}/{job.total} cells)")
+
+def _sweep_int(key, v):
+    return isinstance(v, int) and not isinstance(v, bool) and 1 <= v <= SWEEP_LIMITS[key]
+
+def _sweep_int_list(body, key, default):
+    values = body.get(key, default)
+    values = values if isinstance(values, list) else [values]
+    if not values or not all(_sweep_int(key, v) for v in values):
+        raise ValueError(f"{key} must be integers between 1 and {SWEEP_LIMITS[key]}")
+    return sorted(set(values))
+
+@app.route('/api/benchmark/sweeps', methods=['POST'])
+@login_required
+def api_sweep_start():
+    """Start a load-test sweep; poll GET /api/benchmark/sweeps/<id> for progress."""
+    body = flask_request.json or {}
+    if not isinstance(body, dict):
+        return jsonify({"error": "Body must be a JSON object"}), 400
+    model = body.get('model', '')
+    if not model or not isinstance(model, str):
+        return jsonify({"error": "No model specified"}), 400
+    try:
+        params = {
+            "concurrency": _sweep_int_list(body, "concurrency", [1, 2, 4, 8]),
+            "prompt_tokens": _sweep_int_list(body, "prompt_tokens", [128, 1024]),
+            "output_tokens": _sweep_int_list(body, "output_tokens", [128]),
+            "rounds": _sweep_int_list(body, "rounds", 2)[0],
+            "cold_start": bool(body.get("cold_start", True)),
+        }
+        # One context size for the whole sweep; changing num_ctx would reload the model
+        num_ctx = body.get("num_ctx") or max(params["prompt_tokens"]) + max(params["output_tokens"]) + 256
+        if not _sweep_int("num_ctx", num_ctx):
+            raise ValueError(f"num_ctx must be an integer between 1 and {SWEEP_LIMITS['num_ctx']}")
+        params["num_ctx"] = num_ctx
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    job = SweepJob(model, params)
+    if job.requests_total > SWEEP_MAX_REQUESTS:
+        return jsonify({"error": f"Sweep would send {job.requests_total} requests (limit {SWEEP_MAX_REQUESTS})"}), 400
+    with _sweep_lock:
+        if any(j.status in ("queued", "running") for j in sweep_jobs.values()):
+            return jsonify({"error": "A sweep is already running"}), 409
+        sweep_jobs[job.id] = job
+        while len(sweep_jobs) > SWEEP_JOBS_KEEP:
+            sweep_jobs.popitem(last=False)
+    with _sweep_lock:
+        snapshot = job.snapshot()
+    threading.Thread(target=run_sweep, args=(job,), name=f"sweep-{job.id}", daemon=True).start()
+    return jsonify(snapshot), 202
+
+@app.route('/api/benchmark/sweeps')
+@login_required
+def api_sweep_list():
+    """Sweep jobs since startup (finished results are also in the `sweeps` history list)."""
+    with _sweep_lock:
+        jobs = [j.snapshot() for j in reversed(sweep_jobs.values())]
+    return jsonify({"jobs": [{k: v for k, v in j.items() if k != "cells"} for j in jobs]})
+
+@app.route('/api/benchmark/sweeps/<job_id>', methods=['GET', 'DELETE'])
+@login_required
+def api_sweep_job(job_id):
+    with _sweep_lock:
+        job = sweep_jobs.get(job_id)
+        if job is None:
+            return jsonify({"error": "Unknown sweep"}), 404
+        if flask_request.method == 'DELETE':
+            job.cancelled = True
+        snapshot = job.snapshot()
+    return jsonify(snapshot)
 
 @app.route('/api/trim', methods=['POST'])
 @login_required
 def api_trim():
+    """Delete old history now (same chunked path as the retention worker; rollups are kept)."""
     body = flask_request.json or {}
     mode = body.get('mode', 'count')
 
-    with history_lock:
-        history = load_history()
-
-        if mode == 'count':
-            keep = body.get('keep', 500)
-            for key in ["requests", "benchmarks", "events"]:
-                if key in history and len(history[key]) > keep:
-                    history[key] = history[key][-keep:]
-            save_history(history)
-            return jsonify({"status": "trimmed", "mode": "count", "kept": keep})
-
-        elif mode == 'time':
-            months = body.get('months', 6)
-            cutoff = (datetime.now() - timedelta(days=months * 30)).isoformat()
-            for key in ["requests", "benchmarks", "events"]:
-                if key in history:
-                    history[key] = [
-                        entry for entry in history[key]
-                        if entry.get("time", "") >= cutoff
-                    ]
-            save_history(history)
-            return jsonify({"status": "trimmed", "mode": "time", "months": months})
+    if mode == 'count':
+        try:
+            keep = int(body.get('keep', 500))
+        except (TypeError, ValueError):
+            return jsonify({"error": "keep must be an integer"}), 400
+        if keep < 1:
+            return jsonify({"error": "keep must be at least 1"}), 400
+        result = run_retention(keep=keep)
+        if result is None:
+            return jsonify({"error": "A retention run is in progress"}), 409
+        return jsonify({"status": "trimmed", "mode": "count", "kept": keep, **result})
+
+    elif mode == 'time':
+        try:
+            months = float(body.get('months', 6))
+        except (TypeError, ValueError):
+            return jsonify({"error": "months must be a number"}), 400
+        if not months >= 0:
+            return jsonify({"error": "months must be zero or more"}), 400
+        result = run_retention(months=months)
+        if result is None:
+            return jsonify({"error": "A retention run is in progress"}), 409
+        return jsonify({"status": "trimmed", "mode": "time", "months": months, **result})
 
     return jsonify({"error": "Invalid mode"}), 400
 
@@ -693,49 +4416,156 @@ def api_trim():
 @login_required
 def api_clear():
     with history_lock:
-        save_history({"requests": [], "benchmarks": [], "events": []})
+        save_history({kind: [] for kind in HISTORY_KINDS})
     return jsonify({"status": "cleared"})
 
 @app.route('/api/history/export')
 @login_required
 def api_export():
-    with history_lock:
-        history = load_history()
-    return jsonify(history), 200, {
-        'Content-Disposition': f'attachment; filename=ollama-history-{datetime.now().strftime("%Y%m%d")}.json'
-    }
+    """Streamed export, e.g. ?format=ndjson&compress=gzip&since=<epoch|iso>&model=llama3
+
+    format is json (default, the original document), ndjson (all kinds, one
+    entry per line) or csv (one kind, ?kind=requests). ?kinds=requests,events
+    narrows json/ndjson."""
+    args = flask_request.args
+    fmt = args.get('format', 'json')
+    compress = args.get('compress') or None
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+    if compress is not None and compress not in EXPORT_COMPRESSIONS:
+        return jsonify({"error": f"compress must be one of {', '.join(EXPORT_COMPRESSIONS)}"}), 400
+    try:
+        filters = {
+            "since": _parse_time_arg(args.get('since')),
+            "until": _parse_time_arg(args.get('until')),
+            "model": args.get('model'),
+            "client_ip": args.get('client_ip'),
+        }
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    kinds = [k for k in args.get('kinds', ','.join(HISTORY_KINDS)).split(',') if k in HISTORY_KINDS]
+    try:
+        compressor = export_compressor(compress) if compress else None
+    except ImportError:
+        return jsonify({"error": "zstd export needs the zstandard package"}), 400
+
+    stamp = datetime.now().strftime("%Y%m%d")
+    if fmt == 'csv':
+        kind = args.get('kind', 'requests')
+        if kind not in HISTORY_KINDS:
+            return jsonify({"error": f"kind must be one of {', '.join(HISTORY_KINDS)}"}), 400
+        chunks, mimetype = _export_csv(kind, filters), 'text/csv'
+        filename = f'ollama-{kind}-{stamp}.csv'
+    elif fmt == 'ndjson':
+        chunks, mimetype = _export_ndjson(kinds, filters), 'application/x-ndjson'
+        filename = f'ollama-history-{stamp}.ndjson'
+    else:
+        chunks, mimetype = _export_json(kinds, filters), 'application/json'
+        filename = f'ollama-history-{stamp}.json'
+    if compress:
+        mimetype = 'application/gzip' if compress == 'gzip' else 'application/zstd'
+        filename += '.gz' if compress == 'gzip' else '.zst'
+    return Response(export_stream(chunks, compressor), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@app.route('/api/history/import', methods=['POST'])
+@login_required
+def api_import():
+    """Bulk import of an NDJSON export (plain, gzip or zstd) streamed from the request body."""
+    try:
+        result = import_history(flask_request.stream)
+    except ImportError:
+        return jsonify({"error": "zstd import needs the zstandard package"}), 400
+    except Exception as e:
+        # Chunks committed before the failure stay imported
+        return jsonify({"error": f"Import failed: {e}"}), 400
+    print(f"[HISTORY] Imported {sum(result['imported'].values())} entries "
+          f"({result['duplicates']} already present, {result['skipped']} skipped)")
+    return jsonify({"status": "imported", **result})
 
 @app.route('/api/history/stats')
 @login_required
 def api_history_stats():
-    with history_lock:
-        history = load_history()
-        file_size = 0
-        try:
-            file_size = os.path.getsize(HISTORY_FILE)
-        except:
-            pass
-        # Token stats from both proxied requests and benchmarks
-        req_gen_tokens = sum(r.get("tokens", 0) for r in history.get("requests", []))
-        req_prompt_tokens = sum(r.get("prompt_tokens", 0) for r in history.get("requests", []))
-        bench_gen_tokens = sum(b.get("eval_count", 0) for b in history.get("benchmarks", []))
-        bench_prompt_tokens = sum(b.get("prompt_eval_count", 0) for b in history.get("benchmarks", []))
-        total_gen = req_gen_tokens + bench_gen_tokens
-        total_prompt = req_prompt_tokens + bench_prompt_tokens
-        proxied = sum(1 for r in history.get("requests", []) if r.get("source") == "proxy")
-        direct = sum(1 for r in history.get("requests", []) if r.get("source") == "direct")
-        return jsonify({
-            "requests": len(history.get("requests", [])),
-            "benchmarks": len(history.get("benchmarks", [])),
-            "events": len(history.get("events", [])),
-            "file_size_bytes": file_size,
-            "file_size": _fmt_bytes(file_size),
-            "total_tokens": total_gen + total_prompt,
-            "total_gen_tokens": total_gen,
-            "total_prompt_tokens": total_prompt,
-            "proxied_requests": proxied,
-            "direct_requests": direct,
-        })
+    # Served from running counters — constant cost regardless of history size
+    c = {k: int(v) for k, v in get_counters().items()}
+    file_size = history_size_bytes()
+    total_gen = c.get("req_gen_tokens", 0) + c.get("bench_gen_tokens", 0)
+    total_prompt = c.get("req_prompt_tokens", 0) + c.get("bench_prompt_tokens", 0)
+    return jsonify({
+        "requests": c.get("requests", 0),
+        "benchmarks": c.get("benchmarks", 0),
+        "events": c.get("events", 0),
+        "sweeps": c.get("sweeps", 0),
+        "file_size_bytes": file_size,
+        "file_size": _fmt_bytes(file_size),
+        "total_tokens": total_gen + total_prompt,
+        "total_gen_tokens": total_gen,
+        "total_prompt_tokens": total_prompt,
+        "proxied_requests": c.get("source:proxy", 0),
+        "direct_requests": c.get("source:direct", 0),
+        "cache_hits": c.get("source:cache", 0),
+        "cache_tokens_saved": c.get("source_tokens:cache", 0),
+        "coalesced_requests": c.get("source:coalesced", 0),
+        "coalesced_tokens_saved": c.get("source_tokens:coalesced", 0),
+        "writer": get_writer_stats(),
+        "log_follower": dict(log_follower_stats),
+        "retention": dict(retention_stats),
+    })
+
+@app.route('/api/history/rollups')
+@login_required
+def api_history_rollups():
+    """Time-bucketed request totals, e.g. ?granularity=hour&since=<epoch>&group=model,client_ip"""
+    granularity = flask_request.args.get('granularity', 'hour')
+    if granularity not in ROLLUP_GRANULARITIES:
+        return jsonify({"error": f"granularity must be one of {', '.join(ROLLUP_GRANULARITIES)}"}), 400
+    since = flask_request.args.get('since', type=float)
+    until = flask_request.args.get('until', type=float)
+    if since is not None:
+        # Count the bucket the range starts in, as /api/history/percentiles does
+        since = _bucket_start(since, granularity)
+    group = [g for g in flask_request.args.get('group', 'model').split(',') if g]
+    return jsonify({
+        "granularity": granularity,
+        "buckets": query_rollups(granularity, since, until, group),
+    })
+
+@app.route('/api/history/percentiles')
+@login_required
+def api_history_percentiles():
+    """Quantiles from the stored sketches, e.g. ?metric=duration_ms&since=<epoch|iso>&group=model&q=0.5,0.99
+
+    Ranges are matched on bucket starts; granularity defaults to hour for
+    ranges up to three days and day otherwise."""
+    args = flask_request.args
+    try:
+        since, until = _parse_time_arg(args.get('since')), _parse_time_arg(args.get('until'))
+        quantiles = [float(q) for q in args.get('q', '0.5,0.95,0.99').split(',') if q]
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not quantiles or not all(0 <= q <= 1 for q in quantiles):
+        return jsonify({"error": "q must be quantiles between 0 and 1"}), 400
+    metrics_arg = [m for m in args.get('metric', ','.join(SKETCH_METRICS)).split(',') if m]
+    unknown = [m for m in metrics_arg if m not in SKETCH_METRICS]
+    if unknown:
+        return jsonify({"error": f"metric must be one of {', '.join(SKETCH_METRICS)}"}), 400
+    granularity = args.get('granularity')
+    if granularity is None:
+        span = (until or time.time()) - since if since is not None else None
+        granularity = "hour" if span is not None and span <= 3 * 86400 else "day"
+    if granularity not in SKETCH_GRANULARITIES:
+        return jsonify({"error": f"granularity must be one of {', '.join(SKETCH_GRANULARITIES)}"}), 400
+    if since is not None:
+        since = _bucket_start(since, granularity)
+    group = [g for g in args.get('group', '').split(',') if g]
+    return jsonify({
+        "granularity": granularity,
+        "since": since,
+        "until": until,
+        "accuracy": SKETCH_ACCURACY,
+        "metrics": {m: query_percentiles(m, granularity, since, until, args.get('model'), args.get('client_ip'),
+                                         group, quantiles) for m in metrics_arg},
+    })
 
 # ── Update Checker ───────────────────────────────────────────────
 @app.route('/api/updates')
@@ -816,31 +4646,49 @@ def detect_self_ip():
 # ── Start ────────────────────────────────────────────────────────
 if __name__ == '__main__':
     os.makedirs(DATA_DIR, exist_ok=True)
+    init_history_store()
     try:
-        history = load_history()
-        for r in history.get("requests", [])[-2000:]:
-            seen_entries.add(entry_hash(r))
-        print(f"[DASHBOARD] Loaded {len(seen_entries)} existing entry hashes for dedup")
-    except:
-        pass
+        seed_seen_entries()
+    except Exception as e:
+        print(f"[DASHBOARD] Could not seed dedup index: {e}")
 
     detect_self_ip()
 
+    # Start batched history writer; flush it on exit (docker stop sends SIGTERM)
+    start_history_writer()
+    atexit.register(stop_history_writer)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     # Start background poller
     threading.Thread(target=poll_loop, daemon=True).start()
 
+    # Tail Ollama's container logs for requests that bypass the proxy
+    start_log_follower()
+
+    # Enforce retention_months in the background (chunked deletes + incremental vacuum)
+    threading.Thread(target=retention_loop, daemon=True).start()
+
+    # Preload models ahead of their usual demand (no-op unless a VRAM budget is set)
+    if warmup.enabled:
+        threading.Thread(target=warmup_loop, daemon=True).start()
+
     # Start proxy on port 11434 in background thread
     def run_proxy():
-        print(f"[PROXY] Ollama API Proxy starting on port {PROXY_PORT}")
-        print(f"[PROXY] Forwarding to: {OLLAMA_URL}")
+        print(f"[PROXY] Ollama API Proxy starting on port {PROXY_PORT} ({PROXY_MODE} mode)")
+        print(f"[PROXY] Forwarding to: {', '.join(OLLAMA_URLS)}")
+        if PROXY_MODE == 'async':
+            try:
+                return run_async_proxy()
+            except ImportError as e:
+                print(f"[PROXY] Async mode unavailable ({e}) — falling back to threaded")
         proxy_app.run(host='0.0.0.0', port=PROXY_PORT, debug=False, threaded=True)
 
     threading.Thread(target=run_proxy, daemon=True).start()
 
     # Start dashboard on port 8088
     print(f"[DASHBOARD] Ollama Monitor v1.0 starting on port 8088")
-    print(f"[DASHBOARD] Monitoring: {OLLAMA_URL}")
+    print(f"[DASHBOARD] Monitoring: {', '.join(OLLAMA_URLS)}")
     print(f"[DASHBOARD] Container: {OLLAMA_CONTAINER}")
-    print(f"[DASHBOARD] History: {HISTORY_FILE}")
-    print(f"[DASHBOARD] Proxy: port {PROXY_PORT} → {OLLAMA_URL}")
+    print(f"[DASHBOARD] History: {HISTORY_DB}")
+    print(f"[DASHBOARD] Proxy: port {PROXY_PORT} → {', '.join(OLLAMA_URLS)}")
     app.run(host='0.0.0.0', port=8088, debug=False, threaded=True)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""Throughput benchmark for the GIN log parser.
+
+Builds a synthetic multi-megabyte Ollama container log (docker timestamps,
+GIN request lines mixed with llama.cpp / server noise) and runs it through the
+same per-line path the log follower uses. The pre-module parser (regex search
+and strptime on every line) is measured alongside as a baseline.
+
+    python benchmarks/gin_parser_throughput.py --size-mb 16 --min-lines-per-sec 200000
+
+Exits non-zero when the parser falls below --min-lines-per-sec, so it can gate
+a CI job against throughput regressions.
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import gin_parser
+
+PATHS = ['/api/chat', '/api/generate', '/api/embed', '/v1/chat/completions', '/api/tags', '/api/ps', '/api/show']
+DURATIONS = ['512µs', '1.2ms', '48.37ms', '850.1ms', '1.5s', '12.04s', '1m2.5s']
+NOISE = [
+    'time={iso} level=INFO source=server.go:619 msg="llama runner started in 2.51 seconds"',
+    'llama_new_context_with_model: n_ctx      = 8192',
+    'time={iso} level=DEBUG source=sched.go:466 msg="context for request finished"',
+    'print_info: model type       = 8B',
+    'load_tensors: offloaded 33/33 layers to GPU',
+    'time={iso} level=INFO source=routes.go:1298 msg="Listening on [::]:11434 (version 0.6.2)"',
+]
+
+
+# ── Synthetic log ────────────────────────────────────────────────
+def build_log(size_mb, gin_ratio, seed=1):
+    rnd = random.Random(seed)
+    t = datetime(2026, 1, 1, 12, 0, 0)
+    lines, size = [], 0
+    while size < size_mb * 1024 * 1024:
+        t += timedelta(microseconds=rnd.randint(200, 20000))
+        docker_ts = t.strftime('%Y-%m-%dT%H:%M:%S.') + f'{t.microsecond:06d}{rnd.randint(0, 999):03d}Z'
+        if rnd.random() < gin_ratio:
+            text = (f'[GIN] {t:%Y/%m/%d - %H:%M:%S} | {rnd.choice([200, 200, 200, 400, 500])} | '
+                    f'{rnd.choice(DURATIONS):>12} | {"172.17.0." + str(rnd.randint(2, 30)):>15} | '
+                    f'POST     "{rnd.choice(PATHS)}"')
+        else:
+            text = rnd.choice(NOISE).format(iso=t.isoformat())
+        line = f'{docker_ts} {text}'
+        lines.append(line)
+        size += len(line) + 1
+    return lines, size
+
+
+# ── Parsers under test ───────────────────────────────────────────
+def run_parser(lines):
+    found = 0
+    parse_ts, parse_line = gin_parser.parse_docker_ts, gin_parser.parse_line
+    for line in lines:
+        ts, _, text = line.partition(' ')
+        parse_ts(ts)
+        if parse_line(text, skip_ip='172.17.0.1') is not None:
+            found += 1
+    return found
+
+
+def _legacy_duration(dur_str):
+    dur_str = dur_str.strip()
+    try:
+        if 'µs' in dur_str:
+            return float(dur_str.replace('µs', '').strip()) / 1000
+        elif 'ms' in dur_str:
+            return float(dur_str.replace('ms', '').strip())
+        elif 's' in dur_str:
+            parts = dur_str.replace('s', '').strip()
+            if 'm' in parts:
+                mp = parts.split('m')
+                return (float(mp[0]) * 60 + float(mp[1])) * 1000
+            return float(parts) * 1000
+    except ValueError:
+        pass
+    return 0
+
+
+def run_legacy(lines):
+    """The parser as it was inlined in app.py before gin_parser existed."""
+    found = 0
+    for line in lines:
+        ts, _, text = line.partition(' ')
+        base = ts.rstrip('Z').partition('.')[0]
+        time.strptime(base, "%Y-%m-%dT%H:%M:%S")
+        gin = re.search(
+            r'\[GIN\]\s+(\d{4}/\d{2}/\d{2}\s+-\s+\d{2}:\d{2}:\d{2})\s+\|\s+(\d+)\s+\|\s+(.+?)\s+\|\s+(.+?)\s+\|\s+(\w+)\s+"(.+?)"',
+            text
+        )
+        if not gin:
+            continue
+        gts, status, duration, client_ip, method, path = gin.groups()
+        if path.strip() in ['/', '/api/tags', '/api/ps', '/api/version', '/api/show']:
+            continue
+        _legacy_duration(duration)
+        datetime.strptime(gts.strip(), "%Y/%m/%d - %H:%M:%S").isoformat()
+        found += 1
+    return found
+
+
+def bench(fn, lines, rounds):
+    best, found = None, 0
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        found = fn(lines)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size-mb', type=float, default=8.0, help='synthetic log size')
+    parser.add_argument('--gin-ratio', type=float, default=0.3, help='fraction of lines that are GIN requests')
+    parser.add_argument('--rounds', type=int, default=3, help='best-of rounds per parser')
+    parser.add_argument('--no-baseline', action='store_true', help='skip the legacy parser')
+    parser.add_argument('--min-lines-per-sec', type=float, default=0, help='fail below this parser throughput')
+    args = parser.parse_args()
+
+    lines, size = build_log(args.size_mb, args.gin_ratio)
+    print(f"Synthetic log: {len(lines):,} lines, {size / 1024 / 1024:.1f} MB, GIN ratio {args.gin_ratio}")
+
+    runs = [('gin_parser', run_parser)]
+    if not args.no_baseline:
+        runs.append(('legacy', run_legacy))
+
+    print(f"{'parser':<11} {'entries':>8} {'seconds':>8} {'lines/s':>11} {'MB/s':>7}")
+    results = {}
+    for name, fn in runs:
+        elapsed, found = bench(fn, lines, args.rounds)
+        results[name] = len(lines) / elapsed
+        print(f"{name:<11} {found:>8,} {elapsed:>8.3f} {results[name]:>11,.0f} {size / 1024 / 1024 / elapsed:>7.1f}")
+    if 'legacy' in results:
+        print(f"speedup: {results['gin_parser'] / results['legacy']:.1f}x")
+
+    if args.min_lines_per_sec and results['gin_parser'] < args.min_lines_per_sec:
+        print(f"FAIL: {results['gin_parser']:,.0f} lines/s is below {args.min_lines_per_sec:,.0f}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""Concurrent-stream benchmark for the threaded and async proxy modes.
+
+Starts a fake Ollama server that streams NDJSON tokens slowly, puts the proxy
+in front of it (threaded Flask or async uvicorn), then opens N long-lived
+/api/chat streams at once and reports how many finished cleanly.
+
+    python benchmarks/proxy_concurrency.py --mode both --levels 50,200,500
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+FAKE_OLLAMA_PORT = 18434
+os.environ.setdefault('DATA_DIR', tempfile.mkdtemp(prefix='ollama-bench-'))
+os.environ['OLLAMA_URL'] = f'http://127.0.0.1:{FAKE_OLLAMA_PORT}'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+# ── Fake Ollama (asyncio, keep-alive, chunked NDJSON) ────────────
+async def _fake_ollama_conn(reader, writer, frames, delay):
+    try:
+        while True:
+            head = await reader.readuntil(b'\r\n\r\n')
+            length = 0
+            for line in head.split(b'\r\n')[1:]:
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':', 1)[1])
+            body = json.loads(await reader.readexactly(length) or b'{}')
+            model = body.get('model', 'fake')
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n'
+                         b'Transfer-Encoding: chunked\r\n\r\n')
+            for _ in range(frames):
+                line = json.dumps({"model": model, "message": {"content": "tok"}, "done": False}).encode() + b'\n'
+                writer.write(b'%x\r\n%s\r\n' % (len(line), line))
+                await writer.drain()
+                await asyncio.sleep(delay)
+            final = json.dumps({"model": model, "done": True, "eval_count": frames,
+                                "eval_duration": int(frames * delay * 1e9),
+                                "prompt_eval_count": 8, "prompt_eval_duration": 1000000}).encode() + b'\n'
+            writer.write(b'%x\r\n%s\r\n0\r\n\r\n' % (len(final), final))
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def start_fake_ollama(port, frames, delay):
+    loop = asyncio.new_event_loop()
+
+    async def serve():
+        server = await asyncio.start_server(
+            lambda r, w: _fake_ollama_conn(r, w, frames, delay), '127.0.0.1', port, backlog=4096)
+        async with server:
+            await server.serve_forever()
+
+    threading.Thread(target=loop.run_until_complete, args=(serve(),), daemon=True).start()
+
+
+# ── Proxy under test ─────────────────────────────────────────────
+def start_proxy(mode, port):
+    import app
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    if mode == 'async':
+        target = lambda: app.run_async_proxy(host='127.0.0.1', port=port)
+    else:
+        target = lambda: app.proxy_app.run(host='127.0.0.1', port=port, debug=False, threaded=True)
+    threading.Thread(target=target, daemon=True).start()
+
+
+# ── Client ───────────────────────────────────────────────────────
+async def one_stream(port, timeout):
+    start = time.perf_counter()
+    body = json.dumps({"model": "bench", "messages": [{"role": "user", "content": "hi"}]}).encode()
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'POST /api/chat HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n'
+                     b'Content-Type: application/json\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body))
+        await writer.drain()
+        await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+        first = await asyncio.wait_for(reader.read(65536), timeout)
+        ttft = time.perf_counter() - start
+        data = first
+        while True:
+            chunk = await asyncio.wait_for(reader.read(65536), timeout)
+            if not chunk:
+                break
+            data += chunk
+        writer.close()
+        ok = b'"done": true' in data or b'"done":true' in data
+        return ok, ttft, time.perf_counter() - start
+    except Exception:
+        return False, None, time.perf_counter() - start
+
+
+async def run_level(port, n, timeout):
+    peak_threads = threading.active_count()
+
+    async def sample_threads():
+        nonlocal peak_threads
+        while True:
+            peak_threads = max(peak_threads, threading.active_count())
+            await asyncio.sleep(0.1)
+
+    sampler = asyncio.create_task(sample_threads())
+    results = await asyncio.gather(*(one_stream(port, timeout) for _ in range(n)))
+    sampler.cancel()
+    ok = [r for r in results if r[0]]
+    ttfts = sorted(r[1] for r in ok)
+    return {
+        "streams": n,
+        "completed": len(ok),
+        "failed": n - len(ok),
+        "ttft_p50_ms": round(statistics.median(ttfts) * 1000, 1) if ttfts else None,
+        "ttft_p99_ms": round(ttfts[int(len(ttfts) * 0.99) - 1] * 1000, 1) if ttfts else None,
+        "wall_s": round(max(r[2] for r in results), 2),
+        "peak_threads": peak_threads,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--mode', choices=['threaded', 'async', 'both'], default='both')
+    parser.add_argument('--levels', default='50,200,500', help='comma-separated concurrent stream counts')
+    parser.add_argument('--frames', type=int, default=50, help='tokens per stream')
+    parser.add_argument('--delay', type=float, default=0.05, help='seconds between tokens')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    args = parser.parse_args()
+
+    # Each stream needs a client socket, a proxy socket and an upstream socket
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    import app
+    app.init_history_store()
+    app.start_history_writer()
+
+    start_fake_ollama(FAKE_OLLAMA_PORT, args.frames, args.delay)
+
+    modes = ['threaded', 'async'] if args.mode == 'both' else [args.mode]
+    ports = {'threaded': 18435, 'async': 18436}
+    for mode in modes:
+        start_proxy(mode, ports[mode])
+    time.sleep(1.5)
+
+    print(f"{'mode':<9} {'streams':>7} {'done':>6} {'failed':>6} {'ttft p50':>9} {'ttft p99':>9} {'wall s':>7} {'threads':>7}")
+    for mode in modes:
+        for n in [int(x) for x in args.levels.split(',')]:
+            r = asyncio.run(run_level(ports[mode], n, args.timeout))
+            print(f"{mode:<9} {r['streams']:>7} {r['completed']:>6} {r['failed']:>6} "
+                  f"{str(r['ttft_p50_ms']):>9} {str(r['ttft_p99_ms']):>9} {r['wall_s']:>7} {r['peak_threads']:>7}")
+
+    app.stop_history_writer()
+
+
+if __name__ == '__main__':
+    main()
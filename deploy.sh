@@ -26,7 +26,7 @@ mkdir -p "$TEMPLATE_DIR"
 echo "[2/5] Copying build files..."
 cp Dockerfile "$BUILD_DIR/"
 cp requirements.txt "$BUILD_DIR/"
-cp app.py "$BUILD_DIR/"
+cp app.py gin_parser.py "$BUILD_DIR/"
 cp templates/dashboard.html "$BUILD_DIR/templates/"
 echo "  → Files copied to $BUILD_DIR"
 
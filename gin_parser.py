@@ -0,0 +1,106 @@
+"""GIN request-log parsing for Ollama container logs.
+
+Busy hosts emit tens of thousands of log lines a minute, most of them not GIN
+request lines, so the hot path is kept cheap:
+
+- a plain substring test rejects non-GIN lines before any regex runs
+- the pattern is compiled once and anchored at the marker with ``match``
+- timestamps repeat for every line within the same second, so the last
+  parsed second is cached instead of calling ``strptime`` per line
+"""
+
+import calendar
+import re
+import time
+from datetime import datetime
+
+GIN_MARKER = '[GIN]'
+
+GIN_LINE_RE = re.compile(
+    r'\[GIN\]\s+(\d{4}/\d{2}/\d{2}\s+-\s+\d{2}:\d{2}:\d{2})\s+\|\s+(\d+)\s+\|\s+(.+?)\s+\|\s+(.+?)\s+\|\s+(\w+)\s+"(.+?)"'
+)
+
+# Polling/status endpoints that would otherwise drown out real traffic
+SKIP_PATHS = frozenset({'/', '/api/tags', '/api/ps', '/api/version', '/api/show'})
+
+# Go time.Duration suffixes → milliseconds
+_DURATION_UNITS = (('ns', 1e-6), ('µs', 1e-3), ('us', 1e-3), ('ms', 1.0), ('s', 1000.0),
+                   ('m', 60000.0), ('h', 3600000.0))
+_DURATION_PART_RE = re.compile(r'([\d.]+)(ns|µs|us|ms|s|m|h)')
+_DURATION_SCALE = dict(_DURATION_UNITS)
+
+
+def parse_duration(dur_str):
+    """Parse a GIN duration string ("512µs", "12.3ms", "1m2.5s") to milliseconds."""
+    dur_str = dur_str.strip()
+    for suffix, scale in _DURATION_UNITS[:5]:
+        # Fast path: a single unit, which is every request under a minute
+        if dur_str.endswith(suffix):
+            try:
+                return float(dur_str[:-len(suffix)]) * scale
+            except ValueError:
+                break
+    try:
+        return sum(float(num) * _DURATION_SCALE[unit] for num, unit in _DURATION_PART_RE.findall(dur_str))
+    except ValueError:
+        return 0
+
+
+class _SecondCache:
+    """Remembers the last parsed second; log lines arrive in time order."""
+    __slots__ = ('key', 'value', 'parse')
+
+    def __init__(self, parse):
+        self.key = None
+        self.value = None
+        self.parse = parse
+
+    def __call__(self, key):
+        if key != self.key:
+            self.value = self.parse(key)
+            self.key = key
+        return self.value
+
+
+def _gin_iso(ts):
+    try:
+        return datetime.strptime(ts, "%Y/%m/%d - %H:%M:%S").isoformat()
+    except ValueError:
+        return ts
+
+
+_gin_time = _SecondCache(_gin_iso)
+_docker_seconds = _SecondCache(lambda base: calendar.timegm(time.strptime(base, "%Y-%m-%dT%H:%M:%S")))
+
+
+def parse_docker_ts(ts):
+    """Docker RFC3339Nano timestamp ("2024-05-01T12:00:00.123456789Z") → int nanoseconds since epoch."""
+    base, _, frac = ts.rstrip('Z').partition('.')
+    return _docker_seconds(base) * 1_000_000_000 + int((frac + '000000000')[:9])
+
+
+def parse_line(line, skip_ip=None):
+    """Fields of one GIN request line, or None for other lines, polling paths and ``skip_ip``."""
+    idx = line.find(GIN_MARKER)
+    if idx < 0:
+        return None
+    gin = GIN_LINE_RE.match(line, idx)
+    if not gin:
+        return None
+
+    ts, status, duration, client_ip, method, path = gin.groups()
+    if path in SKIP_PATHS:
+        return None
+    if skip_ip and client_ip == skip_ip:
+        return None
+
+    return {
+        "time": _gin_time(ts),
+        "time_display": ts,
+        "status": int(status),
+        "duration": duration,
+        "duration_ms": round(parse_duration(duration), 1),
+        "client_ip": client_ip,
+        "method": method,
+        "path": path,
+    }